@@ -2,6 +2,9 @@
 -- DROP SCHEMA public CASCADE;
 CREATE SCHEMA IF NOT EXISTS public AUTHORIZATION pg_database_owner;
 
+-- coordinates as int32 micro-degrees (degrees * 10^6) - exact equality keys, same as messages (see common_utils/utils.to_e6)
+CREATE DOMAIN public.coord_e6 AS INTEGER CHECK (VALUE BETWEEN -180000000 AND 180000000);
+
 -- Users Table
 CREATE TABLE public.users (
     user_id SERIAL PRIMARY KEY,
@@ -23,22 +26,33 @@ CREATE TABLE public.routes_req (
 );
 CREATE INDEX idx_routes_user_id ON public.routes_req(user_id);
 
--- Attractions Table
+-- Attractions Table - partitioned by week of created_at, so the cleaner drops old weeks instead of deleting rows
+-- (weekly partitions are created by common_utils/lambda_rds_cleaner.py, rows of weeks without a partition go to default)
 CREATE TABLE public.attractions_res (
-    attraction_id SERIAL PRIMARY KEY,
+    attraction_id SERIAL,
     route_id INT NOT NULL,
     attraction_name VARCHAR(255) NOT NULL, -- Renamed from "name" to avoid reserved keyword issues
     latitude NUMERIC(9,6) NOT NULL,
     longitude NUMERIC(9,6) NOT NULL,
+    lat_e6 public.coord_e6 GENERATED ALWAYS AS (round(latitude * 1000000)::int) STORED, -- exact key, filled by postgres
+    lng_e6 public.coord_e6 GENERATED ALWAYS AS (round(longitude * 1000000)::int) STORED,
+    wp_latitude NUMERIC(9,6), -- route waypoint the attraction was found for
+    wp_longitude NUMERIC(9,6),
     address TEXT,
     category VARCHAR(100),
     audience_type VARCHAR(50),
     popularity NUMERIC(3,1), -- Optimized from VARCHAR to NUMERIC
     opening_hours JSONB CHECK (jsonb_typeof(opening_hours) = 'array'), -- Ensures JSON array format
+    website VARCHAR(255),
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (attraction_id, created_at), -- partition key must be part of primary key
     FOREIGN KEY (route_id) REFERENCES public.routes_req(route_id) ON DELETE CASCADE
-);
+) PARTITION BY RANGE (created_at);
+CREATE TABLE public.attractions_res_default PARTITION OF public.attractions_res DEFAULT;
 CREATE INDEX idx_attractions_route_id ON public.attractions_res(route_id);
+CREATE INDEX idx_attractions_created_at ON public.attractions_res(created_at);
+CREATE INDEX idx_attractions_location ON public.attractions_res USING gist (point(longitude::float8, latitude::float8)); -- find_nearby
+CREATE INDEX idx_attractions_coord_e6 ON public.attractions_res(lat_e6, lng_e6); -- exact location lookups
 
 -- Breaks Table
 CREATE TABLE public.breaks_res (
@@ -49,6 +63,8 @@ CREATE TABLE public.breaks_res (
     break_address VARCHAR(255),
     latitude NUMERIC(9,6),
     longitude NUMERIC(9,6),
+    lat_e6 public.coord_e6 GENERATED ALWAYS AS (round(latitude * 1000000)::int) STORED, -- exact key, filled by postgres
+    lng_e6 public.coord_e6 GENERATED ALWAYS AS (round(longitude * 1000000)::int) STORED,
     working_hours JSONB CHECK (jsonb_typeof(working_hours) = 'array'), -- Ensures JSON array format
     rating NUMERIC(3,1) CHECK (rating BETWEEN 0 AND 5), -- Ensures valid rating between 0 and 5
     url VARCHAR(255),
@@ -65,6 +81,8 @@ CREATE TABLE public.gas_stations_res (
     address VARCHAR(255),
     latitude NUMERIC(9,6),
     longitude NUMERIC(9,6),
+    lat_e6 public.coord_e6 GENERATED ALWAYS AS (round(latitude * 1000000)::int) STORED, -- exact key, filled by postgres
+    lng_e6 public.coord_e6 GENERATED ALWAYS AS (round(longitude * 1000000)::int) STORED,
     working_hours VARCHAR(255),
     rating NUMERIC(3,1) CHECK (rating BETWEEN 0 AND 5), -- Ensures valid rating between 0 and 5
     url VARCHAR(255),
@@ -77,6 +95,8 @@ CREATE TABLE public.gas_stations_res (
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 CREATE INDEX idx_gas_station_id ON public.gas_stations_res(place_id);
+CREATE INDEX idx_gas_stations_res_created_at ON public.gas_stations_res(created_at); -- cleaner chunked deletes
+CREATE INDEX idx_gas_stations_res_location ON public.gas_stations_res USING gist (point(longitude::float8, latitude::float8)); -- find_nearby
 
 
 -- gas-stations Table
@@ -86,6 +106,8 @@ CREATE TABLE public.restaurants_res (
     address VARCHAR(255),
     latitude NUMERIC(9,6),
     longitude NUMERIC(9,6),
+    lat_e6 public.coord_e6 GENERATED ALWAYS AS (round(latitude * 1000000)::int) STORED, -- exact key, filled by postgres
+    lng_e6 public.coord_e6 GENERATED ALWAYS AS (round(longitude * 1000000)::int) STORED,
     working_hours VARCHAR(255),
     rating NUMERIC(3,1) CHECK (rating BETWEEN 0 AND 5), -- Ensures valid rating between 0 and 5
     url VARCHAR(255),
@@ -97,5 +119,27 @@ CREATE TABLE public.restaurants_res (
     created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
 );
 CREATE INDEX idx_restaurant_id ON public.restaurants_res(place_id);
+CREATE INDEX idx_restaurants_res_created_at ON public.restaurants_res(created_at); -- cleaner chunked deletes
+CREATE INDEX idx_restaurants_res_location ON public.restaurants_res USING gist (point(longitude::float8, latitude::float8)); -- find_nearby
+
+-- static vendors gas-stations Table (loaded from offline_utils/*_stations_transformed.csv, used by spark enrichment)
+CREATE TABLE IF NOT EXISTS public.gas_stations (
+    name VARCHAR(255),
+    city VARCHAR(100),
+    address VARCHAR(255),
+    latitude NUMERIC(9,6),
+    longitude NUMERIC(9,6),
+    lat_e6 public.coord_e6 GENERATED ALWAYS AS (round(latitude * 1000000)::int) STORED, -- exact key, filled by postgres
+    lng_e6 public.coord_e6 GENERATED ALWAYS AS (round(longitude * 1000000)::int) STORED,
+    services VARCHAR(255),
+    working_hours VARCHAR(255),
+    petrol98 BOOLEAN,
+    productgas BOOLEAN,
+    producturea BOOLEAN,
+    electric_charge BOOLEAN,
+    car_wash BOOLEAN,
+    convenient_store BOOLEAN
+);
+CREATE INDEX IF NOT EXISTS idx_gas_stations_location ON public.gas_stations USING gist (point(longitude::float8, latitude::float8)); -- find_nearby
 
 
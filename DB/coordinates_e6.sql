@@ -0,0 +1,26 @@
+-- Adds int32 micro-degrees coordinates (degrees * 10^6) next to the NUMERIC(9,6) latitude/longitude columns
+-- (new DBs get them from OptimizedPostgreSQLSchema.sql). the columns are generated by postgres, so writers don't change.
+-- services look up exact locations by (lat_e6, lng_e6) and send coordinates in messages in the same int form
+-- (see common_utils/utils.to_e6). run once (rewrites the tables), after partition_attractions.sql: psql -f DB/coordinates_e6.sql
+
+CREATE DOMAIN public.coord_e6 AS INTEGER CHECK (VALUE BETWEEN -180000000 AND 180000000);
+
+ALTER TABLE public.attractions_res
+    ADD COLUMN IF NOT EXISTS lat_e6 public.coord_e6 GENERATED ALWAYS AS (round(latitude * 1000000)::int) STORED,
+    ADD COLUMN IF NOT EXISTS lng_e6 public.coord_e6 GENERATED ALWAYS AS (round(longitude * 1000000)::int) STORED;
+ALTER TABLE public.restaurants_res
+    ADD COLUMN IF NOT EXISTS lat_e6 public.coord_e6 GENERATED ALWAYS AS (round(latitude * 1000000)::int) STORED,
+    ADD COLUMN IF NOT EXISTS lng_e6 public.coord_e6 GENERATED ALWAYS AS (round(longitude * 1000000)::int) STORED;
+ALTER TABLE public.gas_stations_res
+    ADD COLUMN IF NOT EXISTS lat_e6 public.coord_e6 GENERATED ALWAYS AS (round(latitude * 1000000)::int) STORED,
+    ADD COLUMN IF NOT EXISTS lng_e6 public.coord_e6 GENERATED ALWAYS AS (round(longitude * 1000000)::int) STORED;
+ALTER TABLE public.breaks_res
+    ADD COLUMN IF NOT EXISTS lat_e6 public.coord_e6 GENERATED ALWAYS AS (round(latitude * 1000000)::int) STORED,
+    ADD COLUMN IF NOT EXISTS lng_e6 public.coord_e6 GENERATED ALWAYS AS (round(longitude * 1000000)::int) STORED;
+ALTER TABLE public.gas_stations
+    ADD COLUMN IF NOT EXISTS lat_e6 public.coord_e6 GENERATED ALWAYS AS (round(latitude * 1000000)::int) STORED,
+    ADD COLUMN IF NOT EXISTS lng_e6 public.coord_e6 GENERATED ALWAYS AS (round(longitude * 1000000)::int) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_attractions_coord_e6 ON public.attractions_res(lat_e6, lng_e6);
+
+ANALYZE public.attractions_res;
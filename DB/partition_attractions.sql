@@ -0,0 +1,34 @@
+-- Converts an existing attractions_res table to a table partitioned by week of created_at
+-- (new DBs get it from OptimizedPostgreSQLSchema.sql). weekly partitions are created by the RDS cleaner lambda,
+-- which also drops partitions older than the retention period.
+-- restaurants_res / gas_stations_res are not partitioned - their unique place_id (used by upserts) can't be kept
+-- on a partitioned table - the cleaner deletes their old rows in small chunks (created_at indexes below).
+-- run once in a quiet time: psql -f DB/partition_attractions.sql
+
+BEGIN;
+
+ALTER TABLE public.attractions_res RENAME TO attractions_res_old;
+ALTER INDEX IF EXISTS idx_attractions_route_id RENAME TO idx_attractions_old_route_id;
+ALTER INDEX IF EXISTS idx_attractions_location RENAME TO idx_attractions_old_location;
+
+CREATE TABLE public.attractions_res (LIKE public.attractions_res_old INCLUDING DEFAULTS INCLUDING CONSTRAINTS)
+    PARTITION BY RANGE (created_at);
+ALTER TABLE public.attractions_res ADD PRIMARY KEY (attraction_id, created_at);
+ALTER TABLE public.attractions_res ADD FOREIGN KEY (route_id) REFERENCES public.routes_req(route_id) ON DELETE CASCADE;
+ALTER SEQUENCE IF EXISTS attractions_res_attraction_id_seq OWNED BY public.attractions_res.attraction_id;
+CREATE TABLE public.attractions_res_default PARTITION OF public.attractions_res DEFAULT;
+
+CREATE INDEX idx_attractions_route_id ON public.attractions_res(route_id);
+CREATE INDEX idx_attractions_created_at ON public.attractions_res(created_at);
+CREATE INDEX idx_attractions_location ON public.attractions_res USING gist (point(longitude::float8, latitude::float8));
+
+-- old rows go to the default partition. the cleaner creates weekly partitions from the current week on
+-- (moving rows of those weeks out of the default partition), and deletes expired rows from the default partition in chunks
+INSERT INTO public.attractions_res SELECT * FROM public.attractions_res_old;
+DROP TABLE public.attractions_res_old;
+
+COMMIT;
+
+CREATE INDEX IF NOT EXISTS idx_gas_stations_res_created_at ON public.gas_stations_res(created_at);
+CREATE INDEX IF NOT EXISTS idx_restaurants_res_created_at ON public.restaurants_res(created_at);
+ANALYZE public.attractions_res;
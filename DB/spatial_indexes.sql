@@ -0,0 +1,16 @@
+-- Spatial indexes used by db_utils.find_nearby (radius queries instead of exact coordinates equality).
+-- built-in GiST index on a point expression - no PostGIS extension needed.
+-- the expression must stay identical to the one in find_nearby: point(<lng column>::float8, <lat column>::float8)
+-- safe to run on an existing DB (run once, i.e. psql -f DB/spatial_indexes.sql)
+
+-- static vendors data (loaded by offline_utils)
+CREATE INDEX IF NOT EXISTS idx_gas_stations_location ON public.gas_stations USING gist (point(longitude::float8, latitude::float8));
+
+CREATE INDEX IF NOT EXISTS idx_gas_stations_res_location ON public.gas_stations_res USING gist (point(longitude::float8, latitude::float8));
+CREATE INDEX IF NOT EXISTS idx_restaurants_res_location ON public.restaurants_res USING gist (point(longitude::float8, latitude::float8));
+CREATE INDEX IF NOT EXISTS idx_attractions_location ON public.attractions_res USING gist (point(longitude::float8, latitude::float8));
+
+ANALYZE public.gas_stations;
+ANALYZE public.gas_stations_res;
+ANALYZE public.restaurants_res;
+ANALYZE public.attractions_res;
@@ -0,0 +1,170 @@
+"""
+asyncio mode of API Service - handles many user requests at the same time in one process
+(request time is mostly waiting for google/HERE apis and the DB). run instead of main.py:
+    python async_main.py
+API_ASYNC_CONCURRENCY bounds the number of requests in work. offsets are committed only over completed
+requests (as in main.py), failed requests go to the retry topics, which are consumed by the threaded handler.
+"""
+import asyncio
+import os
+import sys
+from aiokafka import AIOKafkaConsumer, ConsumerRebalanceListener
+from aiokafka.errors import KafkaError
+from common_utils.local_logger import logger
+import common_utils.kafka_common as kfk
+from common_utils import kafka_codec
+from common_utils import kafka_retry
+from common_utils import cache_metrics
+from common_utils import tracing
+from common_utils import async_db_utils as adb
+from common_utils.kafka_consumer import (KAFKA_BROKER, CONSUMER_GROUP_ID, SERVICE_INSTANCE_ID, CONSUMER_POLL_TIMEOUT_MS,
+                                         default_offset, start_retry_consumer, stop_retry_consumer)
+from common_utils.kafka_workers import OffsetTracker
+from common_utils.utils import UserRequestFieldNames, BreakPointName
+from message_handler import api_process_message, send_places_data_to_queue
+from main import SERVICE_GROUP_ID
+import async_places
+
+API_ASYNC_CONCURRENCY = int(os.getenv('API_ASYNC_CONCURRENCY', '50'))  # user requests handled at the same time
+
+# (request field, place type, next topic) - results are sent in this order, as in message_handler
+requested_place_types = [
+    (UserRequestFieldNames.FUEL_REQUIRED.value, BreakPointName.FUELING.value, kfk.TRANSFORMER_TOPIC_NAME),
+    (UserRequestFieldNames.FOOD_REQUIRED.value, BreakPointName.RESTAURANT.value, kfk.RESULTS_TOPIC_NAME),
+    (UserRequestFieldNames.ATTRACTION_REQUIRED.value, BreakPointName.ATTRACTION.value, kfk.RESULTS_TOPIC_NAME),
+]
+
+
+async def fetch_places(session, json_message, place_type):
+    """ returns (places, start time, end time) """
+    start_time = tracing.now()
+    if place_type == BreakPointName.FUELING.value:
+        places = await async_places.get_places_in_route(session, json_message, place_type, False, 1)
+    elif place_type == BreakPointName.RESTAURANT.value:
+        places = await async_places.get_places_in_route(session, json_message, place_type, True, 1)
+    else:
+        places = await async_places.fetch_attractions_from_route(session, json_message, 5)
+    return places, start_time, tracing.now()
+
+
+async def api_process_message_async(session, json_message):
+    """ same as message_handler.api_process_message, fetching all requested place types concurrently """
+    if not json_message:
+        logger.error("process_message was called with no message")
+        return False
+
+    requested = [(place_type, topic_name) for field, place_type, topic_name in requested_place_types if json_message[field]]
+    results = await asyncio.gather(*[fetch_places(session, json_message, place_type) for place_type, _ in requested])
+
+    was_sent = False
+    for (place_type, topic_name), (places, start_time, end_time) in zip(requested, results):
+        result_message = tracing.fork(json_message)  # fetch stamps of this place type only
+        tracing.mark(result_message, f"api_fetch_start:{place_type}", start_time)
+        tracing.mark(result_message, f"api_fetch_end:{place_type}", end_time)
+        if places:
+            was_sent = send_places_data_to_queue(result_message, place_type, places, topic_name)
+            logger.info(f"get {len(places)} api places of type {place_type}")
+
+    if not was_sent:
+        was_sent = send_places_data_to_queue(json_message, BreakPointName.NONE.value, None, kfk.RESULTS_TOPIC_NAME)
+    return was_sent
+
+
+async def commit_processed(consumer, tracker):
+    """ commit offsets of messages that were fully processed """
+    assigned = consumer.assignment()
+    tracker.drop_partitions([tp for tp in tracker.tracked_partitions() if tp not in assigned])
+    offsets = tracker.pop_committable()
+    if not offsets:
+        return
+    try:
+        await consumer.commit({tp: offset_and_metadata.offset for tp, offset_and_metadata in offsets.items()})
+    except KafkaError as e:
+        logger.error(f"failed to commit offsets {offsets}: {e}")
+
+
+class PartitionsAssignmentListener(ConsumerRebalanceListener):
+    """ commits processed offsets before partitions move to another instance """
+    def __init__(self, consumer, tracker, group_id):
+        self.consumer = consumer
+        self.tracker = tracker
+        self.group_id = group_id
+
+    async def on_partitions_revoked(self, revoked):
+        await commit_processed(self.consumer, self.tracker)
+        if revoked:
+            logger.info(f"group {self.group_id} instance {SERVICE_INSTANCE_ID} revoked partitions {sorted(tp.partition for tp in revoked)}")
+
+    async def on_partitions_assigned(self, assigned):
+        logger.info(f"group {self.group_id} instance {SERVICE_INSTANCE_ID} assigned partitions {sorted(tp.partition for tp in assigned)}")
+
+
+async def handle_message(session, slots, tracker, tp, message):
+    """ process one request and mark its offset as done (or forward it to the retry topic). frees its slot at the end """
+    try:
+        cache_metrics.set_current_partition(tp.partition)  # per task
+        tracing.mark(message.value, f"dequeue:{tp.topic}")
+        await api_process_message_async(session, message.value)
+        tracker.done(tp, message.offset)
+    except Exception as e:
+        logger.exception(f"handler failed on {tp.topic}:{tp.partition} offset {message.offset}: {e}")
+        kafka_retry.forward_or_drop(message, e, lambda: tracker.done(tp, message.offset))
+    finally:
+        slots.release()
+
+
+async def poll_and_process_messages(topic_name, group_id, concurrency=API_ASYNC_CONCURRENCY):
+    """ consume messages from topic and handle up to 'concurrency' of them at the same time. runs until cancelled """
+    group_id = CONSUMER_GROUP_ID or group_id
+    tracker = OffsetTracker()
+    consumer = AIOKafkaConsumer(
+        bootstrap_servers=KAFKA_BROKER,
+        value_deserializer=kafka_codec.decode,
+        auto_offset_reset=default_offset,
+        enable_auto_commit=False,  # offsets are committed only after the request was handled
+        group_id=group_id,
+        client_id=SERVICE_INSTANCE_ID
+    )
+    consumer.subscribe([topic_name], listener=PartitionsAssignmentListener(consumer, tracker, group_id))
+    slots = asyncio.Semaphore(concurrency)
+    tasks = set()
+    await consumer.start()
+    session = async_places.create_http_session(concurrency)
+    logger.info(f"Listening on topic {topic_name} for messages (up to {concurrency} in work)...")
+
+    try:
+        while True:
+            records = await consumer.getmany(timeout_ms=CONSUMER_POLL_TIMEOUT_MS, max_records=concurrency)
+            for tp, messages in records.items():
+                for message in messages:
+                    await slots.acquire()  # backpressure - wait for a request to finish before starting more
+                    while not tracker.has_room():  # requests done behind one still in work
+                        await asyncio.sleep(CONSUMER_POLL_TIMEOUT_MS / 1000)
+                    tracker.add(tp, message.offset)
+                    task = asyncio.create_task(handle_message(session, slots, tracker, tp, message))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+            await commit_processed(consumer, tracker)
+            cache_metrics.report_cache_stats()
+    finally:
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)  # let requests in work finish before final commit
+        await commit_processed(consumer, tracker)
+        cache_metrics.report_cache_stats(force=True)
+        await session.close()
+        await consumer.stop()
+        await adb.close_pool()
+
+
+if __name__ == "__main__":
+    logger.info("Staring API Service (asyncio mode)")
+    if kfk.TRANSPORT != kfk.TRANSPORT_KAFKA:
+        logger.error("asyncio mode requires PIPELINE_TRANSPORT=kafka - run main.py instead")
+        sys.exit(1)
+    retry_stop_event, retry_thread = start_retry_consumer(kfk.USER_REQUESTS_TOPIC_NAME, api_process_message, SERVICE_GROUP_ID)
+    try:
+        asyncio.run(poll_and_process_messages(kfk.USER_REQUESTS_TOPIC_NAME, SERVICE_GROUP_ID))
+    except KeyboardInterrupt:
+        logger.info(f"stopped listening on topic {kfk.USER_REQUESTS_TOPIC_NAME}")
+    finally:
+        stop_retry_consumer(retry_stop_event, retry_thread)
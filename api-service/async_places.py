@@ -0,0 +1,229 @@
+"""
+asyncio versions of google_places.get_places_in_route and heremaps_attractions.fetch_attractions_from_route,
+used by async_main.py. Same selection rules and DB/cache handling, with aiohttp for the APIs and asyncpg for the DB.
+google nearby searches of all waypoints (and details of the selected places) are sent together.
+Translation (blocking client) runs in a worker thread.
+"""
+import asyncio
+import aiohttp
+from common_utils.local_logger import logger
+from common_utils.utils import UserRequestFieldNames, get_waypoints, get_waypoint, coord_e6
+from common_utils import async_db_utils as adb
+from common_utils import cache_metrics
+from common_utils import place_cache
+from common_utils import search_cache
+from common_utils import rate_limiter
+import google_places
+import heremaps_attractions as here
+
+HTTP_TIMEOUT_SEC = 10
+
+
+def create_http_session(max_connections):
+    """ one session (connection pool) for all requests of the service """
+    return aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT_SEC),
+                                 connector=aiohttp.TCPConnector(limit=max_connections))
+
+
+async def get_json(session, url, params, rate_limit):
+    """ GET url and return parsed json (None on error or if refused by rate_limiter) """
+    if not await rate_limiter.acquire_async(rate_limit):
+        return None
+    try:
+        async with session.get(url, params=params) as response:
+            if response.status != 200:
+                logger.warning(f"GET {url} result {response.status}")
+                return None
+            return await response.json(content_type=None)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logger.error(f"ERROR: Request to {url} failed: {e}")
+        return None
+
+
+async def get_records_by_keys(table_name, column, values):
+    """ place_cache.get_records_by_keys over asyncpg """
+    result, missing = place_cache.lookup_records(table_name, column, values)
+    if not missing:
+        return result
+    return place_cache.put_db_records(table_name, column, missing, await adb.get_records_by_keys(table_name, column, missing), result)
+
+
+async def find_nearby(table_name, latitude, longitude, radius_m, limit=10):
+    """ place_cache.find_nearby over asyncpg """
+    if latitude is None or longitude is None:
+        return []
+    found, records = place_cache.lookup_nearby(table_name, latitude, longitude, radius_m, limit)
+    if found:
+        return records
+    return place_cache.put_nearby(table_name, latitude, longitude, radius_m, limit,
+                                  await adb.find_nearby(table_name, latitude, longitude, radius_m, limit))
+
+
+async def call_search_cache(func, *args):
+    """ search_cache calls block on mongo store - run them in a worker thread """
+    if search_cache.NEARBY_SEARCH_CACHE_STORE == search_cache.STORE_MONGO:
+        return await asyncio.to_thread(func, *args)
+    return func(*args)
+
+###################################################################################
+async def get_places_near_coordinates(session, latitude, longitude, place_type):
+    if place_type not in google_places.google_supported_place_types:
+        logger.error(f"place type {place_type} is not supported")
+        return None
+    found, results = await call_search_cache(search_cache.lookup, place_type, google_places.SEARCH_RADIUS_M, latitude, longitude)
+    if found:
+        return results
+    search_lat, search_lng = search_cache.get_search_point(latitude, longitude)
+    places = await get_json(session, google_places.SEARCH_URL, google_places.get_nearby_search_params(search_lat, search_lng, place_type),
+                            rate_limiter.GOOGLE_PLACES)
+    if not places:
+        return None
+    return await call_search_cache(google_places.get_search_results, places, latitude, longitude, place_type)
+
+
+async def get_place_details(session, place_id, place_type):
+    """ same as google_places.get_place_details """
+    cached_details, stale_fields = google_places.get_cached_details(place_id, place_type)
+    if not stale_fields:
+        return cached_details
+    place_details = await get_json(session, google_places.DETAILS_URL, google_places.get_details_params(place_id, stale_fields),
+                                   rate_limiter.GOOGLE_PLACES)
+    return google_places.merge_details(place_id, cached_details, stale_fields, (place_details or {}).get('result'))
+
+
+async def get_places_in_route(session, route_dict, place_type, fetch_details=False, max_places_per_location=2):
+    """ same as google_places.get_places_in_route """
+    route_id = route_dict[UserRequestFieldNames.ROUTE_ID.value]
+    waypoints, fetch_details = await asyncio.to_thread(google_places.apply_budget, route_id, get_waypoints(route_dict), fetch_details)
+    table_name = google_places.db_tables.get(place_type)
+
+    responses = await asyncio.gather(*[
+        get_places_near_coordinates(session, lat, lng, place_type) for lat, lng in waypoints])
+    if not all(responses):
+        logger.warning(f"Failed to get google api places for {responses.count(None)} waypoints of route-id {route_id}")
+
+    # places of all waypoints already stored in DB - one query for all candidates
+    db_places = dict()
+    if table_name:
+        candidate_ids = [place["place_id"] for places_response in responses for place in places_response or []]
+        db_places = await get_records_by_keys(table_name, "place_id", candidate_ids)
+
+    # select places waypoint by waypoint (same order and rules as the sync service)
+    places = []
+    place_ids = []
+    new_places = []  # places not found in DB - details are fetched together, then written to DB
+    for places_response in responses:
+        collected_places = 0
+        for place in places_response or []:
+            if "closed" in place.get("business_status", "").lower():  # skip places which are temporarily closed
+                continue
+            place_id = place["place_id"]
+            if place_id in place_ids:  # avoid duplications
+                continue
+            place_record = db_places.get(place_id) if table_name else None
+            if table_name:
+                cache_metrics.record(table_name, bool(place_record))
+            if place_record:
+                place_data = google_places.db_place_data(place_record)
+            else:
+                place_data = await asyncio.to_thread(google_places.make_place_data, place, place_type)
+                if place_data is None:
+                    continue
+                new_places.append(place_data)
+            place_ids.append(place_id)
+            places.append(place_data)
+            collected_places += 1
+            if collected_places >= max_places_per_location:
+                break
+
+    if new_places:
+        if fetch_details:
+            details = await asyncio.gather(*[get_place_details(session, place_data["place_id"], place_type) for place_data in new_places])
+        else:
+            details = [None] * len(new_places)
+        for place_data, place_details in zip(new_places, details):
+            google_places.add_place_details(place_data, place_details, place_type)
+        if table_name:
+            # single statement and commit for all new places. places saved meanwhile by another request are updated
+            stored_rows = await adb.upsert_many(table_name, new_places)
+            place_cache.store_records(table_name, "place_id", stored_rows)  # write-through
+    return places
+
+###################################################################################
+async def fetch_attractions(session, waypoints, route_id, max_results=20):
+    """ same as heremaps_attractions.fetch_attractions """
+    attractions = []
+    total_waypoints = len(waypoints)
+    if total_waypoints == 0:
+        logger.error("No waypoints available in the route.")
+        return []
+
+    unique_attractions = set()  # Track unique attractions (lat, lng)
+    new_attractions_rows = []  # New attractions are stored in DB together at the end
+    attraction_per_waypoint = max(1, max_results // total_waypoints)  # Spread results across waypoints
+    remaining_needed = max_results
+    max_fetches = await asyncio.to_thread(here.get_fetches_per_waypoint)
+
+    for waypoint in waypoints:
+        if remaining_needed <= 0:
+            break
+        wp_lat, wp_lng = get_waypoint(waypoint)
+
+        for retry_count in range(max_fetches):  # up to max_fetches calls per waypoint (1 when budget is low)
+            # Step 1: attractions in DB near the waypoint (nearest first)
+            existing_attractions = await find_nearby("attractions_res", wp_lat, wp_lng, here.ATTRACTION_REUSE_RADIUS_M, limit=max_results) or []
+            cache_metrics.record("attractions_res", bool(existing_attractions))
+            for attraction in existing_attractions:
+                attraction = here.normalize_attraction(attraction)
+                lat_lng = coord_e6(attraction["latitude"], attraction["longitude"])
+                if lat_lng in unique_attractions:
+                    continue
+                unique_attractions.add(lat_lng)
+                attractions.append(attraction)
+                remaining_needed -= 1
+                if remaining_needed == 0:
+                    break
+            if remaining_needed == 0:
+                break
+
+            # Step 2: fetch from API
+            places_data = await get_json(session, here.DISCOVER_URL, here.get_discover_params(wp_lat, wp_lng, attraction_per_waypoint + retry_count),
+                                         rate_limiter.HERE_DISCOVER)
+            if places_data is None:
+                break  # Exit retry loop if request fails
+            items = places_data.get("items", [])
+            items_lat_lng = [here.get_position_key(place) for place in items]
+            db_attractions = await get_records_by_keys("attractions_res", ("lat_e6", "lng_e6"), items_lat_lng)
+
+            for place, lat_lng in zip(items, items_lat_lng):
+                if lat_lng in unique_attractions or lat_lng in db_attractions:
+                    continue  # Skip duplicate
+                new_attraction = await asyncio.to_thread(here.make_attraction, place, route_id, wp_lat, wp_lng)
+                new_attractions_rows.append(new_attraction)
+                unique_attractions.add(lat_lng)
+                attractions.append(new_attraction)
+                remaining_needed -= 1
+                if remaining_needed == 0:
+                    break
+            if remaining_needed == 0:
+                break
+
+    stored_rows = await adb.insert_many("attractions_res", new_attractions_rows)  # One statement and commit for all new attractions
+    place_cache.store_records("attractions_res", ("lat_e6", "lng_e6"), stored_rows)  # Write-through
+    for wp_lat, wp_lng in {(row["wp_latitude"], row["wp_longitude"]) for row in new_attractions_rows}:
+        place_cache.invalidate_nearby("attractions_res", wp_lat, wp_lng, here.ATTRACTION_REUSE_RADIUS_M, max_results)
+    return attractions
+
+
+async def fetch_attractions_from_route(session, route_data, max_results=20):
+    """ same as heremaps_attractions.fetch_attractions_from_route """
+    try:
+        waypoints = route_data["waypoints"]
+        route_id = str(route_data["route_id"])
+    except KeyError as e:
+        logger.error(f"Invalid input: Missing key {e}")
+        return None
+    if not waypoints:
+        logger.error("Error: No valid waypoints found in JSON.")
+        return None
+    return await fetch_attractions(session, waypoints, route_id, max_results)
@@ -1,13 +1,21 @@
 
-import requests
+from requests.exceptions import RequestException
 from bs4 import BeautifulSoup
 import json
 import random
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from common_utils.local_logger import logger
-from common_utils.utils import UserRequestFieldNames, BreakPointName
+from common_utils.utils import UserRequestFieldNames, BreakPointName, get_waypoints, decode_coordinates
 import common_utils.translator as tr
 import common_utils.db_utils as db
+from common_utils import cache_metrics
+from common_utils import place_cache
+from common_utils import search_cache
+from common_utils import details_cache
+from common_utils.http_client import get_session
+from common_utils import rate_limiter
 
 # Google API Key
 API_KEY = os.getenv('GOOGLE_PLACES_KEY')
@@ -17,9 +25,18 @@ if not API_KEY:
 
 SEARCH_URL = 'https://maps.googleapis.com/maps/api/place/nearbysearch/json'
 DETAILS_URL = 'https://maps.googleapis.com/maps/api/place/details/json'
+SEARCH_RADIUS_M = 3000
+CACHEABLE_SEARCH_STATUS = ("OK", "ZERO_RESULTS")  # not errors/quota responses
+WORKING_HOURS_MAX_LEN = 255  # working_hours column of places tables is VARCHAR(255)
 
 save_routes = False
 
+# google calls of a route (waypoint searches, place details) run concurrently on this pool. shared by all messages
+# of the process, so it also bounds the number of google requests in flight
+GOOGLE_FANOUT_WORKERS = int(os.getenv('GOOGLE_FANOUT_WORKERS', '8'))
+fanout_pool = ThreadPoolExecutor(max_workers=GOOGLE_FANOUT_WORKERS, thread_name_prefix="google-fanout")
+http_session = get_session("google-places", pool_size=GOOGLE_FANOUT_WORKERS, rate_limit=rate_limiter.GOOGLE_PLACES)  # a kept-alive connection per fan-out worker
+
 google_supported_place_types = ["restaurant", "cafe", "gas_station", "shopping_mall", "tourist_attraction", "park", "lodging"]
 db_tables = { "restaurant":"restaurants_res", 
               "gas_station":"gas_stations_res"
@@ -39,141 +56,240 @@ def is_gas_station_valid(station_name):
     # first check if belong to one of the largest
 
 ##################################################################################
-def get_places_near_coordinates(latitude, longitude, place_type):
-    if place_type not in google_supported_place_types:
-        logger.error(f"place type {place_type} is not supported")
-        return None
-    
+def get_nearby_search_params(latitude, longitude, place_type):
     # Parameters for the Places API request
-    params = {
+    return {
         'key': API_KEY,
         'location': f'{latitude},{longitude}',
-        'radius': 3000,  # Radius in meters
+        'radius': SEARCH_RADIUS_M,  # Radius in meters
         'type': place_type  # 'restaurant' or 'lodging' (for hotels)
     }
 
-    response = requests.get(SEARCH_URL, params=params)
+
+def get_search_results(places, latitude, longitude, place_type):
+    """ results of search response, cached for the waypoint cell """
+    if places.get('status', 'OK') in CACHEABLE_SEARCH_STATUS:
+        search_cache.put(place_type, SEARCH_RADIUS_M, latitude, longitude, places['results'])
+    return places['results']
+
+
+def get_places_near_coordinates(latitude, longitude, place_type):
+    """ google nearby search around the grid cell of the waypoint - see search_cache """
+    if place_type not in google_supported_place_types:
+        logger.error(f"place type {place_type} is not supported")
+        return None
+
+    found, results = search_cache.lookup(place_type, SEARCH_RADIUS_M, latitude, longitude)
+    if found:
+        return results
+    search_lat, search_lng = search_cache.get_search_point(latitude, longitude)
+    try:
+        response = http_session.get(SEARCH_URL, params=get_nearby_search_params(search_lat, search_lng, place_type))
+    except RequestException as e:
+        logger.error(f"get_places_near_coordinates {latitude}:{longitude} for {place_type} failed: {e}")
+        return None
     if response.status_code == 200:
-        places = response.json()
-        return places['results']
+        return get_search_results(response.json(), latitude, longitude, place_type)
     else:
         logger.warning(f"get_places_near_coordinates {latitude}:{longitude} for {place_type} result {response.status_code}")
     return None
 
 ###################################################################################
-def get_place_details(place_id):
-    params = {
+# details api fields used by add_place_details. details are billed by the fields requested, so only these are asked
+details_fields = ["formatted_address", "opening_hours"]
+restaurant_details_fields = details_fields + ["serves_beer", "wheelchair_accessible_entrance", "price_level", "website"]
+
+
+def get_details_fields(place_type):
+    return restaurant_details_fields if place_type == 'restaurant' else details_fields
+
+
+def get_details_params(place_id, fields):
+    return {
         'place_id': place_id,
+        'fields': ','.join(fields),
         'key': API_KEY,
     }
-    response = requests.get(DETAILS_URL, params=params)
-    place_details = response.json().get('result', {})
 
-    # print(place_details)
-    return place_details
+
+def get_cached_details(place_id, place_type):
+    """ returns ({field: value} of fresh cached fields, [fields to request]) - see details_cache """
+    return details_cache.lookup(place_id, get_details_fields(place_type))
+
+
+def merge_details(place_id, cached_details, stale_fields, place_details):
+    """ cache fetched fields (None if request failed) and return them with the fresh cached ones """
+    if place_details is None:
+        return cached_details
+    details_cache.put(place_id, stale_fields, place_details)
+    return {**cached_details, **{field: place_details[field] for field in stale_fields if field in place_details}}
+
+
+def get_place_details(place_id, place_type):
+    """ details api result of the place type fields. only fields that are not fresh in details_cache are requested """
+    cached_details, stale_fields = get_cached_details(place_id, place_type)
+    if not stale_fields:
+        return cached_details
+    try:
+        response = http_session.get(DETAILS_URL, params=get_details_params(place_id, stale_fields))
+        place_details = response.json().get('result') if response.status_code == 200 else None
+    except (RequestException, ValueError) as e:
+        logger.error(f"get_place_details {place_id} failed: {e}")
+        place_details = None
+    return merge_details(place_id, cached_details, stale_fields, place_details)
 
 ###################################################################################
-def get_places_in_route(route_dict, place_type, fetch_details = False, max_places_per_location = 2):
-    # Extract total trip distance
+def make_place_data(place, place_type):
+    """ basic place details from nearby search result. returns None for gas stations we don't recommend """
+    place_id = place["place_id"]
+    place_data = dict()
+    place_data['place_id'] = place_id
+    name = place.get("name","NA")
+    if name == 'Дор Алон':
+        name_eng = "dor alon"
+    else:
+        name_eng = tr.translate_text(name).lower()
+    place_data["name"] = name_eng if name_eng else name.lower()
 
-    # Extract waypoints at 10% distance intervals
-    waypoints = route_dict[UserRequestFieldNames.WAYPOINTS.value]
+    # skip non familiar gas stations
+    if place_type == 'gas_station' and not is_gas_station_valid(place_data["name"]):
+        return None
+    place_data["latitude"] = place["geometry"]["location"].get("lat")
+    place_data["longitude"] = place["geometry"]["location"].get("lng")
+    place_data["rating"] = place.get("rating",1)
+    place_data["vicinity"] = place.get("vicinity","israel").lower()
+    place_data["url"] = f"https://www.google.com/maps/place/?q=place_id:{place_id}"
+    return place_data
+
+
+def format_working_hours(weekday_text):
+    """ google 'weekday_text' list as one text - stored the same by sync (psycopg2) and async (json) DB writers """
+    if not weekday_text:
+        return "Not Available"
+    return "; ".join(weekday_text)[:WORKING_HOURS_MAX_LEN]
+
+
+def add_place_details(place_data, place_details, place_type):
+    """ add fields of place details api result (None if details were not fetched) """
+    if place_details is None:
+        place_data["address"] = place_data["vicinity"]
+        return place_data
+    place_data["address"] = place_details.get("formatted_address", "Unknown")
+    place_data["working_hours"] = format_working_hours(place_details.get("opening_hours", {}).get("weekday_text"))
+#  place_data["types"] = place_details.get("types", [])
+
+    if place_type == 'restaurant':
+        place_data["serves_alcohol"] = place_details.get("serves_beer", False)
+        place_data["wheelchair_accessible"] = place_details.get("wheelchair_accessible_entrance", False)
+        place_data["price_level"] = place_details.get("price_level", 1)
+        place_data["website"] = place_details.get("website","www.unknown")
+    return place_data
 
-    # Fetch gas stations and their details
-    places = []
-    place_ids = []
-    total_id = 1
 
-    for waypoint in waypoints:
-        lat = waypoint[UserRequestFieldNames.LATITUDE.value]
-        lng = waypoint[UserRequestFieldNames.LONGITUDE.value]
-        # lat, lng = waypoint.split(",")
-        places_response = get_places_near_coordinates(lat, lng, place_type)
+def db_place_data(place_record):
+    """ DB record to place dict """
+    place_data = db.convert_record([decode_coordinates(place_record)])[0]
+    place_data.pop("created_at", None)  # Removes creation time which is in datetime format and not needed
+    return place_data
+
+###################################################################################
+def apply_budget(route_id, waypoints, fetch_details):
+    """ when today's google budget runs low - search every other waypoint and skip details """
+    if not rate_limiter.is_budget_low(rate_limiter.GOOGLE_PLACES):
+        return waypoints, fetch_details
+    logger.warning(f"google places budget is low - route-id {route_id} uses {len(waypoints[::2])} of {len(waypoints)} waypoints, no details")
+    return waypoints[::2], False
+
+
+def save_response(file_name, data):
+    """ debug - save api response (when 'save_routes' is set) """
+    with open(file_name, "w", encoding="utf-8") as file:
+        json.dump(data, file, indent=4, ensure_ascii=False)
+
+
+def get_places_in_route(route_dict, place_type, fetch_details = False, max_places_per_location = 2):
+    """ nearby places of 'place_type' along route waypoints, up to 'max_places_per_location' per waypoint.
+        waypoint searches (and details of new places) are sent together on the fan-out pool. places are selected
+        in waypoint order, so the result is the same as with sequential calls
+    """
+    route_id = route_dict[UserRequestFieldNames.ROUTE_ID.value]
+    # Extract waypoints at 10% distance intervals
+    waypoints, fetch_details = apply_budget(route_id, get_waypoints(route_dict), fetch_details)
+    phase_times = dict()
+
+    # phase 1: nearby search of all waypoints
+    phase_start = time.perf_counter()
+    responses = list(fanout_pool.map(lambda waypoint: get_places_near_coordinates(waypoint[0], waypoint[1], place_type), waypoints))
+    phase_times["search"] = time.perf_counter() - phase_start
+    for idx, ((lat, lng), places_response) in enumerate(zip(waypoints, responses)):
         if places_response:
-            logger.info(f"call google nearby places for route-id {route_dict[UserRequestFieldNames.ROUTE_ID.value]} - latitude:{lat} longitude:{lng}")
-            #print(json.dumps(places_response, indent=4, ensure_ascii=False))
+            logger.info(f"call google nearby places for route-id {route_id} - latitude:{lat} longitude:{lng}")
+            if save_routes:
+                save_response(f"./data/place-{place_type}-{idx + 1}.json", places_response)
         else:
-            logger.warning(f"Failed to get google api places for route-id {route_dict[UserRequestFieldNames.ROUTE_ID.value]}")
-            continue
+            logger.warning(f"Failed to get google api places for route-id {route_id}")
 
-        # Save gas stations response to file
-        if save_routes:
-            station_filename = f"./data/place-{place_type}-{total_id}.json"
-            with open(station_filename, "w", encoding="utf-8") as file:
-                json.dump(places_response, file, indent=4, ensure_ascii=False)
+    # phase 2: places of all waypoints already stored in DB - one query for all candidates
+    phase_start = time.perf_counter()
+    db_places = dict()
+    if place_type in db_tables:
+        candidate_ids = [place["place_id"] for places_response in responses for place in places_response or []]
+        db_places = place_cache.get_records_by_keys(db_tables[place_type], "place_id", candidate_ids)
+    phase_times["db_lookup"] = time.perf_counter() - phase_start
 
-        # collect basic details from 'places_response', and if 'fetch_details' required add extra info
+    # phase 3: select places waypoint by waypoint (deterministic dedupe and per waypoint cap). new places are translated
+    phase_start = time.perf_counter()
+    places = []
+    place_ids = []
+    new_places = []  # places not found in DB - details are fetched together, then written to DB at the end
+    for places_response in responses:
         collected_places = 0
-        for idx, place in enumerate(places_response):
+        for place in places_response or []:
             if "closed" in place.get("business_status", "").lower():  # skip places which are temporarily closed
                 continue
             place_id = place["place_id"]
             if place_id in place_ids:  # avoid duplications
                 continue
-            place_data = dict()
-            db_record_found = False
-            
+            place_record = None
             if place_type in db_tables:
-                # note that 'get record' returns all matching records, but since 'place-id' is unique we'll get only 1 record
-                place_record = db.get_record(db_tables[place_type], {'place_id' : place_id} )
-                if place_record:
-                    place_data = db.convert_record(place_record)[0]
-                    removed_value = place_data.pop("created_at", None)  # Removes creation time which is in datetime format and not needed
-                    db_record_found = True
-                    place_ids.append(place_id)
-            
-            if not db_record_found:
-                place_data['place_id'] = place_id
-                name = place.get("name","NA")
-                if name == 'Дор Алон':
-                    name_eng = "dor alon"
-                else:
-                    name_eng = tr.translate_text(name).lower()
-                place_data["name"] = name_eng if name_eng else name.lower()
-                
-                # skip non familiar gas stations
-                if place_type == 'gas_station' and not is_gas_station_valid(place_data["name"]):
+                # 'place-id' is unique so there is at most 1 record per place
+                place_record = db_places.get(place_id)
+                cache_metrics.record(db_tables[place_type], bool(place_record))
+            if place_record:
+                place_data = db_place_data(place_record)
+            else:
+                place_data = make_place_data(place, place_type)
+                if place_data is None:
                     continue
-                place_ids.append(place_id)
-                place_data["latitude"] = place["geometry"]["location"].get("lat")
-                place_data["longitude"] = place["geometry"]["location"].get("lng")
-                place_data["rating"] = place.get("rating",1)
-                place_data["vicinity"] = place.get("vicinity","israel").lower()
-                place_data["url"] = f"https://www.google.com/maps/place/?q=place_id:{place_id}"
-
-                if fetch_details:        
-                    place_details = get_place_details(place_id)
-                    
-                    # Save detailed gas station info
-                    if save_routes:
-                        station_filename = f"./data/place-{place_type}-{total_id}-{idx}.json"
-                        total_id += 1
-                        with open(station_filename, "w", encoding="utf-8") as file:
-                            json.dump(place_details, file, indent=4, ensure_ascii=False)
-                    
-                    place_data["address"] = place_details.get("formatted_address", "Unknown")
-                    place_data["working_hours"] = place_details.get("opening_hours", {}).get("weekday_text", "Not Available")
-                #  place_data["types"] = place_details.get("types", [])
-                    
-                    if place_type == 'restaurant':
-                        place_data["serves_alcohol"] = place_details.get("serves_beer", False)
-                        place_data["wheelchair_accessible"] = place_details.get("wheelchair_accessible_entrance", False)
-                        place_data["price_level"] = place_details.get("price_level", 1)
-                        place_data["website"] = place_details.get("website","www.unknown")
-                else:
-                    place_data["address"] = place_data["vicinity"]
-                    
-                # add place to DB - tbd check first if exists
-                if place_type in db_tables:
-                    # rating_type = type(place_data["rating"])
-                    # print(f"type: {rating_type}")
-                    db.insert_record(db_tables[place_type], place_data)
-                    
+                new_places.append(place_data)
+            place_ids.append(place_id)
             places.append(place_data)
             collected_places += 1
             if collected_places >= max_places_per_location:
                 break
+    phase_times["select"] = time.perf_counter() - phase_start
+
+    # phase 4: details of new places
+    phase_start = time.perf_counter()
+    details = [None] * len(new_places)
+    if fetch_details and new_places:
+        details = list(fanout_pool.map(lambda place_data: get_place_details(place_data["place_id"], place_type), new_places))
+    for idx, (place_data, place_details) in enumerate(zip(new_places, details)):
+        if save_routes and place_details is not None:
+            save_response(f"./data/place-{place_type}-details-{idx + 1}.json", place_details)
+        add_place_details(place_data, place_details, place_type)
+    phase_times["details"] = time.perf_counter() - phase_start
+
+    # phase 5: single statement and commit for all new places. places saved meanwhile by another request are updated
+    phase_start = time.perf_counter()
+    if new_places and place_type in db_tables:
+        stored_rows = db.upsert_many(db_tables[place_type], new_places)
+        place_cache.store_records(db_tables[place_type], "place_id", stored_rows)  # write-through
+    phase_times["db_write"] = time.perf_counter() - phase_start
 
+    timings = ' '.join(f"{phase}={seconds * 1000:.0f}ms" for phase, seconds in phase_times.items())
+    logger.info(f"google {place_type} places for route-id {route_id}: {len(places)} places ({len(new_places)} new) "
+                f"from {len(waypoints)} waypoints - {timings}")
     return places
     
             
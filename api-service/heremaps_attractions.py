@@ -1,10 +1,14 @@
-import requests
+from requests.exceptions import RequestException
 import os
 import common_utils.translator as tr  # Correct import
 from common_utils.local_logger import logger
-from common_utils.db_utils import connect_db, disconnect_db, get_record, insert_record
+from common_utils.db_utils import connect_db, disconnect_db, get_record, insert_many
+from common_utils import place_cache
+from common_utils import cache_metrics
+from common_utils.http_client import get_session
+from common_utils import rate_limiter
+from common_utils.utils import get_waypoint, get_coordinate, coord_e6
 import json
-from decimal import Decimal
 from datetime import datetime
 
 # HERE Maps API Key from environment variable
@@ -13,6 +17,12 @@ if not API_KEY:
     logger.error("Error: API Key not found! Set the 'HEREMAPS_ATTRACTIONS_KEY' environment variable.")
     raise ValueError("API Key not found!")
 
+DISCOVER_URL = "https://discover.search.hereapi.com/v1/discover"
+http_session = get_session("here", rate_limit=rate_limiter.HERE_DISCOVER)
+
+# attractions already in DB within this distance from a waypoint are reused (instead of calling HERE api)
+ATTRACTION_REUSE_RADIUS_M = float(os.getenv('ATTRACTION_REUSE_RADIUS_M', '3000'))
+
 CATEGORY_MAPPING = {
     "Amusement Park": "Children",
     "Zoo": "Children",
@@ -32,17 +42,17 @@ CATEGORY_MAPPING = {
 def normalize_attraction(attraction):
     """
     Ensures all attractions follow the same JSON structure.
-    - Converts Decimal to float
+    - Converts coordinates to float (from int micro-degrees columns when present)
     - Converts datetime to string
     - Removes extra DB-specific fields
     """
     return {
         "route_id": str(attraction.get("route_id")),
         "attraction_name": attraction.get("attraction_name"),
-        "latitude": float(attraction["latitude"]) if isinstance(attraction["latitude"], Decimal) else attraction["latitude"],
-        "longitude": float(attraction["longitude"]) if isinstance(attraction["longitude"], Decimal) else attraction["longitude"],
-        "wp_latitude": float(attraction["wp_latitude"]) if isinstance(attraction["wp_latitude"], Decimal) else attraction["wp_latitude"],
-        "wp_longitude": float(attraction["wp_longitude"]) if isinstance(attraction["wp_longitude"], Decimal) else attraction["wp_longitude"],
+        "latitude": get_coordinate(attraction, "latitude"),
+        "longitude": get_coordinate(attraction, "longitude"),
+        "wp_latitude": get_coordinate(attraction, "wp_latitude"),
+        "wp_longitude": get_coordinate(attraction, "wp_longitude"),
         "address": attraction.get("address", "N/A"),
         "category": attraction.get("category", "N/A"),
         "audience_type": attraction.get("audience_type", "General"),
@@ -51,6 +61,66 @@ def normalize_attraction(attraction):
         "website": attraction.get("website", "N/A")  # ✅ Added Website
     }
 
+def get_discover_params(wp_lat, wp_lng, limit):
+    return {
+        "q": "tourist attraction",
+        "at": f"{wp_lat},{wp_lng}",
+        "limit": limit,
+        "sort": "popularity",
+        "apiKey": API_KEY
+    }
+
+def get_website(place):
+    """ first website in place contacts ("N/A" if none) """
+    for contact in place.get("contacts", []):
+        if contact.get("www"):
+            return contact["www"][0].get("value", "N/A")
+    return "N/A"
+
+def get_position_key(place):
+    """ exact micro-degrees key of HERE item position """
+    position = place.get("position", {})
+    return coord_e6(position.get("lat"), position.get("lng"))
+
+def make_attraction(place, route_id, wp_lat, wp_lng):
+    """ attractions_res row from HERE discover item (translated) """
+    category = place.get("categories", [{}])[0].get("name", "N/A")
+    audience_type = CATEGORY_MAPPING.get(category, "General")
+
+    opening_hours_list = place.get("openingHours", [])
+    opening_hours = (
+        ', '.join(opening_hours_list[0]["text"])
+        if opening_hours_list
+        else "N/A"
+    )
+
+    popularity_value = place.get("popularity")
+    popularity_value = None if popularity_value in [None, "N/A"] else popularity_value
+
+    position = place.get("position", {})
+    return {
+        "route_id": route_id,
+        "attraction_name": safe_translate(place["title"]),
+        "latitude": position.get("lat", None),
+        "longitude": position.get("lng", None),
+        "wp_latitude": wp_lat,
+        "wp_longitude": wp_lng,
+        "address": safe_translate(place.get("address", {}).get("label", "N/A")),
+        "category": safe_translate(category),
+        "audience_type": safe_translate(audience_type),
+        "popularity": popularity_value,
+        "opening_hours": opening_hours,
+        "website": get_website(place)  # ✅ Added website column
+    }
+
+def get_fetches_per_waypoint():
+    """ api calls per waypoint - no retries for more attractions when today's HERE budget runs low """
+    if rate_limiter.is_budget_low(rate_limiter.HERE_DISCOVER):
+        logger.warning("HERE discover budget is low - one call per waypoint")
+        return 1
+    return 3
+
+
 def fetch_attractions(waypoints, route_id, max_results=20):
     """
     Fetches up to `max_results` unique attractions, ensuring they are evenly distributed across waypoints.
@@ -65,8 +135,10 @@ def fetch_attractions(waypoints, route_id, max_results=20):
     if total_waypoints == 0:
         logger.error("No waypoints available in the route.")
         return []
+    max_fetches = get_fetches_per_waypoint()
 
     unique_attractions = set()  # ✅ Track unique attractions (lat, lng)
+    new_attractions_rows = []  # ✅ New attractions are stored in DB together at the end
 
     connect_db()  # Establish DB connection
 
@@ -75,24 +147,26 @@ def fetch_attractions(waypoints, route_id, max_results=20):
 
     waypoint_index = 0
     while remaining_needed > 0 and waypoint_index < total_waypoints:
-        wp_lat, wp_lng = waypoints[waypoint_index]["lat"], waypoints[waypoint_index]["lng"]
+        wp_lat, wp_lng = get_waypoint(waypoints[waypoint_index])
         retry_count = 0  # ✅ Prevent infinite loop
 
-        while remaining_needed > 0 and retry_count < 3:  # ✅ Retry fetching only 3 times per waypoint
+        while remaining_needed > 0 and retry_count < max_fetches:  # ✅ up to max_fetches calls per waypoint (1 when budget is low)
             new_attractions = []
 
-            # ✅ Step 1: Fetch from DB using `wp_lat, wp_lng`
-            existing_attractions = get_record(
-                "attractions_res", {"wp_latitude": wp_lat, "wp_longitude": wp_lng}
-            )
+            # ✅ Step 1: Fetch from DB attractions near `wp_lat, wp_lng` (nearest first)
+            existing_attractions = place_cache.find_nearby(
+                "attractions_res", wp_lat, wp_lng, ATTRACTION_REUSE_RADIUS_M, limit=max_results
+            ) or []
+            cache_metrics.record("attractions_res", bool(existing_attractions))
 
             for attraction in existing_attractions:
-                lat_lng = (attraction["latitude"], attraction["longitude"])
+                attraction = normalize_attraction(attraction)
+                lat_lng = coord_e6(attraction["latitude"], attraction["longitude"])  # ✅ exact micro-degrees key
                 if lat_lng in unique_attractions:
                     continue  # Skip duplicate
 
                 unique_attractions.add(lat_lng)
-                attractions.append(normalize_attraction(attraction))
+                attractions.append(attraction)
                 remaining_needed -= 1
 
                 if remaining_needed == 0:
@@ -102,84 +176,37 @@ def fetch_attractions(waypoints, route_id, max_results=20):
                 break  # Stop processing if we have enough unique attractions
 
             # ✅ Step 2: Fetch from API if needed
-            places_url = "https://discover.search.hereapi.com/v1/discover"
-            params = {
-                "q": "tourist attraction",
-                "at": f"{wp_lat},{wp_lng}",
-                "limit": attraction_per_waypoint + retry_count,  # ✅ Increase limit on retries
-                "sort": "popularity",
-                "apiKey": API_KEY
-            }
+            params = get_discover_params(wp_lat, wp_lng, attraction_per_waypoint + retry_count)  # ✅ Increase limit on retries
 
             try:
-                response = requests.get(places_url, params=params, timeout=10)
+                response = http_session.get(DISCOVER_URL, params=params)
                 response.raise_for_status()
-            except requests.exceptions.RequestException as e:
+            except RequestException as e:
                 logger.error(f"ERROR: Request failed: {e}")
                 break  # Exit retry loop if request fails
             
             if response.status_code == 200:
                 places_data = response.json()
                 if "items" in places_data:
-                    for place in places_data["items"]:
-                        position = place.get("position", {})
-                        latitude = position.get("lat", None)
-                        longitude = position.get("lng", None)
-                        lat_lng = (latitude, longitude)
+                    # ✅ Attractions of this response already in DB - one query for all items
+                    items_lat_lng = [get_position_key(place) for place in places_data["items"]]
+                    db_attractions = place_cache.get_records_by_keys("attractions_res", ("lat_e6", "lng_e6"), items_lat_lng)
+
+                    for place, lat_lng in zip(places_data["items"], items_lat_lng):
 
                         if lat_lng in unique_attractions:
                             logger.info(f"Skipping duplicate attraction at {lat_lng}")
                             continue  # ✅ Skip duplicate
 
-                        # ✅ Extract Website (if available)
-                        website = "N/A"
-                        if "contacts" in place:
-                            for contact in place["contacts"]:
-                                if contact.get("www"):
-                                    website = contact["www"][0].get("value", "N/A")
-                                    break  # Take first available website
-
                         # ✅ **Check if attraction already exists in DB**
-                        existing_duplicate = get_record(
-                            "attractions_res", {"latitude": latitude, "longitude": longitude}
-                        )
-                        if existing_duplicate:
+                        if lat_lng in db_attractions:
                             logger.info(f"Skipping duplicate attraction at {lat_lng} (already in DB)")
                             continue  # ✅ Skip duplicate
 
-                        # ✅ **Prepare new attraction**
-                        category = place.get("categories", [{}])[0].get("name", "N/A")
-                        audience_type = CATEGORY_MAPPING.get(category, "General")
-
-                        opening_hours_list = place.get("openingHours", [])
-                        opening_hours = (
-                            ', '.join(opening_hours_list[0]["text"])
-                            if opening_hours_list
-                            else "N/A"
-                        )
-
-                        popularity_value = place.get("popularity")
-                        popularity_value = None if popularity_value in [None, "N/A"] else popularity_value
-
-                        attraction_name = safe_translate(place["title"])
-
-                        # ✅ Insert new attraction into DB
-                        new_attraction = {
-                            "route_id": route_id,
-                            "attraction_name": attraction_name,
-                            "latitude": latitude,
-                            "longitude": longitude,
-                            "wp_latitude": wp_lat,
-                            "wp_longitude": wp_lng,
-                            "address": safe_translate(place.get("address", {}).get("label", "N/A")),
-                            "category": safe_translate(category),
-                            "audience_type": safe_translate(audience_type),
-                            "popularity": popularity_value,
-                            "opening_hours": opening_hours,
-                            "website": website  # ✅ Added website column
-                        }
-
-                        insert_record("attractions_res", new_attraction)  # Store in DB
+                        # ✅ **Prepare new attraction** (inserted into DB at the end)
+                        new_attraction = make_attraction(place, route_id, wp_lat, wp_lng)
+
+                        new_attractions_rows.append(new_attraction)  # Store in DB (at the end)
                         unique_attractions.add(lat_lng)  # ✅ Track as unique
                         attractions.append(new_attraction)
                         remaining_needed -= 1
@@ -192,6 +219,10 @@ def fetch_attractions(waypoints, route_id, max_results=20):
         # ✅ Move to the next waypoint
         waypoint_index += 1
 
+    stored_rows = insert_many("attractions_res", new_attractions_rows)  # ✅ One statement and commit for all new attractions
+    place_cache.store_records("attractions_res", ("lat_e6", "lng_e6"), stored_rows)  # ✅ Write-through
+    for wp_lat, wp_lng in {(row["wp_latitude"], row["wp_longitude"]) for row in new_attractions_rows}:
+        place_cache.invalidate_nearby("attractions_res", wp_lat, wp_lng, ATTRACTION_REUSE_RADIUS_M, max_results)
     disconnect_db()  # ✅ Close DB connection
     return attractions  # ✅ Return only unique attractions
 
@@ -5,16 +5,21 @@ import sys
 import os
 from common_utils.local_logger import logger
 import common_utils.kafka_common as kfk
-from common_utils.kafka_consumer import poll_and_process_messages
-from message_handler import api_process_message
+from common_utils.kafka_consumer import poll_and_process_messages, poll_and_process_batches, CONSUMER_BATCH_MAX_RECORDS
+from message_handler import api_process_message, api_process_message_batch
 
 # Add the parent folder to sys.path
 #sys.path.append(os.path.abspath("../common_utils"))
 sys.path.append(os.path.abspath("."))
 #print(sys.path)
 
+SERVICE_GROUP_ID = "api-service"  # all api-service instances share this consumer group
+
 
 if __name__ == "__main__":
    logger.info("Staring API Service")
-   poll_and_process_messages(kfk.USER_REQUESTS_TOPIC_NAME, api_process_message)
+   if CONSUMER_BATCH_MAX_RECORDS > 1:
+      poll_and_process_batches(kfk.USER_REQUESTS_TOPIC_NAME, api_process_message_batch, group_id=SERVICE_GROUP_ID)
+   else:
+      poll_and_process_messages(kfk.USER_REQUESTS_TOPIC_NAME, api_process_message, group_id=SERVICE_GROUP_ID)
    
\ No newline at end of file
@@ -3,43 +3,67 @@ import json
 from datetime import datetime
 
 from common_utils.local_logger import logger
-from common_utils.utils import UserRequestFieldNames, BreakPointName
+from common_utils.utils import UserRequestFieldNames, BreakPointName, get_waypoints, coord_e6
 import google_places
 from heremaps_attractions import fetch_attractions_from_route
 import common_utils.kafka_common as kfk
 from common_utils.kafka_producer import send_request_to_queue
 import common_utils.db_utils as db
+from common_utils import tracing
+from common_utils.kafka_workers import handle_each, BatchMessagesFailed
 
 save_to_file = False
 
 def create_json_result(original_message, place_type, places_data):
-    """ takes user request message + places result and create json message """
-    next_message = original_message
+    """ takes user request message + places result and create message dict (serialized by kafka producer codec).
+        each place type result is a separate message (with its own trace) - original message is not changed
+    """
+    next_message = tracing.fork(original_message)
     #next_message[UserRequestFieldNames.CREATED_AT.value] = datetime.now().strftime("%d/%m/%Y %H:%M:%S")
     next_message['place_type'] = place_type
     if places_data:       
         next_message['places'] = places_data
         #print(next_message)
     
-     # Convert to pretty JSON
-    pretty_json = json.dumps(next_message, indent=4, ensure_ascii=False)
-    
     if save_to_file:
+        # Convert to pretty JSON
+        pretty_json = json.dumps(next_message, indent=4, ensure_ascii=False)
         origin = next_message[UserRequestFieldNames.ORIGIN.value].replace(" ", "_")
         destination = next_message[UserRequestFieldNames.DESTINATION.value].replace(" ", "_")
         file_name = f"route_{place_type}_{origin}_{destination}.json"
         with open(file_name, "w", encoding="utf-8") as json_file:
             json_file.write(pretty_json)       
-    return pretty_json
+    return next_message
 
 def send_places_data_to_queue(original_message, place_type, places_data, topic_name):
-    pretty_json = create_json_result(original_message, place_type, places_data)
-    return send_request_to_queue(pretty_json, topic_name)
+    next_message = create_json_result(original_message, place_type, places_data)
+    return send_request_to_queue(next_message, topic_name)
+
+
+def get_waypoints_key(json_message):
+    """ hashable key of route waypoints - requests with same waypoints get the same places """
+    return tuple(coord_e6(lat, lng) for lat, lng in get_waypoints(json_message))
+
+
+def get_route_places(json_message, place_type, places_cache, fetch_func, *args):
+    """ call 'fetch_func' to get places of 'place_type' along the route.
+        if 'places_cache' is given, result is saved there and reused for other requests with the same waypoints
+    """
+    with tracing.span(json_message, f"api_fetch:{place_type}"):
+        if places_cache is None:
+            return fetch_func(json_message, *args)
+        key = (place_type, get_waypoints_key(json_message))
+        if key in places_cache:
+            logger.info(f"reusing {place_type} places of same route for route-id {json_message[UserRequestFieldNames.ROUTE_ID.value]}")
+        else:
+            places_cache[key] = fetch_func(json_message, *args)
+        return places_cache[key]
 
 
-def api_process_message(json_message):
+def api_process_message(json_message, places_cache=None):
     """ check for route breakpoints requested by user and call proper method to fetch breakpoint details (places)
         if user choose direct route with no breakpoints it is also handled under 'send_places_data_to_queue'
+        'places_cache' (optional dict) allows sharing places between requests of the same batch
     """
     if not json_message:
         logger.error("process_message was called with no message")
@@ -48,48 +72,59 @@ def api_process_message(json_message):
     places = dict()
     was_sent = False
     
-    db.connect_db()
+    with db.connection():  # pooled connection, shared with the places fetchers of this message
+        # if user requested fueling breaks (note that google api gives limited data so we are enriching it using statics tables through an intermediate queue)
+        if json_message[UserRequestFieldNames.FUEL_REQUIRED.value]:
+            place_type = BreakPointName.FUELING.value
+            result_message = tracing.fork(json_message)  # fetch stamps of this place type only
+            places = get_route_places(result_message, place_type, places_cache, google_places.get_places_in_route, place_type, False, 1)
+            if places:
+                topic_name = kfk.TRANSFORMER_TOPIC_NAME
+                was_sent = send_places_data_to_queue(result_message, place_type, places, topic_name)
+                logger.info(f"get {len(places)} api places of type {place_type}")
     
-    # if user requested fueling breaks (note that google api gives limited data so we are enriching it using statics tables through an intermediate queue)
-    if json_message[UserRequestFieldNames.FUEL_REQUIRED.value]:
-        place_type = BreakPointName.FUELING.value
-        places = google_places.get_places_in_route(json_message, place_type, False, 1)
-        if places:
-            topic_name = kfk.TRANSFORMER_TOPIC_NAME
-            was_sent = send_places_data_to_queue(json_message, place_type, places, topic_name)
-            logger.info(f"get {len(places)} api places of type {place_type}")
+        # if user requested restaurant breaks
+        if json_message[UserRequestFieldNames.FOOD_REQUIRED.value]:
+            place_type = BreakPointName.RESTAURANT.value
+            result_message = tracing.fork(json_message)  # fetch stamps of this place type only
+            places = get_route_places(result_message, place_type, places_cache, google_places.get_places_in_route, place_type, True, 1)
+            if places:            
+                topic_name = kfk.RESULTS_TOPIC_NAME
+                was_sent = send_places_data_to_queue(result_message, place_type, places, topic_name)
+                logger.info(f"get {len(places)} api places of type {place_type}")
+
+        # if user requested for attraction breaks
+        if json_message[UserRequestFieldNames.ATTRACTION_REQUIRED.value]:
+            place_type = BreakPointName.ATTRACTION.value
+            result_message = tracing.fork(json_message)  # fetch stamps of this place type only
+            places = get_route_places(result_message, place_type, places_cache, fetch_attractions_from_route, 5)
+            if places:
+                topic_name = kfk.RESULTS_TOPIC_NAME            
+                was_sent = send_places_data_to_queue(result_message, place_type, places, topic_name)
+                logger.info(f"get {len(places)} api places of type {place_type}")
     
-    # if user requested restaurant breaks
-    if json_message[UserRequestFieldNames.FOOD_REQUIRED.value]:
-        place_type = BreakPointName.RESTAURANT.value
-        places = google_places.get_places_in_route(json_message, place_type, True, 1)
-        if places:            
-            topic_name = kfk.RESULTS_TOPIC_NAME
-            was_sent = send_places_data_to_queue(json_message, place_type, places, topic_name)
-            logger.info(f"get {len(places)} api places of type {place_type}")
-
-    # if user requested for attraction breaks
-    if json_message[UserRequestFieldNames.ATTRACTION_REQUIRED.value]:
-        place_type = BreakPointName.ATTRACTION.value
-        places = fetch_attractions_from_route(json_message, 5)
-        if places:
+        if not was_sent:
             topic_name = kfk.RESULTS_TOPIC_NAME            
-            was_sent = send_places_data_to_queue(json_message, place_type, places, topic_name)
-            logger.info(f"get {len(places)} api places of type {place_type}")
-    
-    if not was_sent:
-        topic_name = kfk.RESULTS_TOPIC_NAME            
-        place_type = BreakPointName.NONE.value
-        was_sent = send_places_data_to_queue(json_message, place_type, None, topic_name)
+            place_type = BreakPointName.NONE.value
+            was_sent = send_places_data_to_queue(json_message, place_type, None, topic_name)
 
-    db.disconnect_db()
-    
     return was_sent
             
     """ TBDs :
     check in DB for places ; save it if not
     """
 
+
+def api_process_message_batch(json_messages):
+    """ process a batch of user requests. identical routes (same waypoints) in the batch are fetched only once """
+    places_cache = dict()
+    with db.connection():  # one pooled connection for the whole batch
+        results, failures = handle_each(json_messages, lambda json_message: api_process_message(json_message, places_cache))
+    logger.info(f"processed batch of {len(json_messages)} requests with {len(places_cache)} distinct place searches")
+    if failures:
+        raise BatchMessagesFailed(failures)  # only failed requests are retried - others were already sent
+    return all(results)
+
 if __name__ == "__main__":
     # Load the JSON file
     with open("./json_samples/route_request_haifa_tel aviv.json", "r", encoding="utf-8") as file:
@@ -1,12 +1,14 @@
 
-import requests
+from requests.exceptions import RequestException
 from bs4 import BeautifulSoup
 import json
 import random
 import os
 import sys
-from common_utils.utils import UserRequestFieldNames
+from common_utils.utils import UserRequestFieldNames, make_waypoint
 from common_utils.local_logger import logger
+from common_utils.http_client import get_session
+from common_utils import rate_limiter
 
 # Google API Key
 API_KEY = os.getenv('GOOGLE_PLACES_KEY')
@@ -17,7 +19,11 @@ def get_route_raw(origin, destination):
     # Step 1: Get Route from Tel Aviv to Haifa
     # Get the route from Tel Aviv to Haifa
     route_url = f"https://maps.googleapis.com/maps/api/directions/json?origin={origin}&destination={destination}&language=en&key={API_KEY}"
-    route_response = requests.get(route_url).json()
+    try:
+        route_response = get_session("google-routes", rate_limit=rate_limiter.GOOGLE_DIRECTIONS).get(route_url).json()
+    except (RequestException, ValueError) as e:
+        logger.error(f"route from {origin} to {destination} failed: {e}")
+        return None, None
     if route_response['status'] != "OK":
         logger.error(f"route from {origin} to {destination} : {route_response['status']}")
         return None, None
@@ -66,10 +72,7 @@ def get_filtered_route(my_route, result:dict, max_wayouts = 5):
                 if cumulative_distance >= interval * len(waypoints):  
                     lat = step["start_location"]["lat"]
                     lng = step["start_location"]["lng"]
-                    tmp_leg = dict()
-                    tmp_leg[UserRequestFieldNames.LATITUDE.value] = lat
-                    tmp_leg[UserRequestFieldNames.LONGITUDE.value] = lng
-                    waypoints.append(tmp_leg)
+                    waypoints.append(make_waypoint(lat, lng))  # int micro-degrees
                     #waypoints.append(f"{lat},{lng}")
         
         result[UserRequestFieldNames.MAIN_ROUTE.value] = major_road
@@ -4,20 +4,21 @@ This file create JSON requests from User BOT data, save it in DB and send it to
 import json
 import common_utils.kafka_common as kfk
 from common_utils.kafka_producer import send_request_to_queue
-from common_utils.utils import UserRequestFieldNames
+from common_utils.utils import UserRequestFieldNames, get_corridor_key
 
 save_requests = False
 
 def process_user_request(user_request):
-    # Convert to pretty JSON
-    pretty_json = json.dumps(user_request, indent=4, ensure_ascii=False)
-
     # Save to a local file
     if save_requests:
+        # Convert to pretty JSON
+        pretty_json = json.dumps(user_request, indent=4, ensure_ascii=False)
         origin = user_request[UserRequestFieldNames.ORIGIN.value]
         destination = user_request[UserRequestFieldNames.DESTINATION.value]
         file_name = f"route_request_{origin}_{destination}.json"
         with open(file_name, "w", encoding="utf-8") as json_file:
             json_file.write(pretty_json)
         
-    send_request_to_queue(pretty_json, kfk.USER_REQUESTS_TOPIC_NAME)
+    # key by route corridor - same geography is handled by the same api-service instance, keeping its caches hot.
+    # the key only picks the partition - inside the instance requests are spread between workers by route id
+    send_request_to_queue(user_request, kfk.USER_REQUESTS_TOPIC_NAME, key=get_corridor_key(user_request))
@@ -16,6 +16,7 @@ import user_request
 import google_routes
 from common_utils.utils import UserRequestFieldNames
 from common_utils import mongodb_adapter
+from common_utils import tracing
 
 class BoolQuestion(Enum):
     UNKNOWN = 0
@@ -66,6 +67,7 @@ class UserRouteSession():
             user:UserInfo = get_user(self.user_id)    
             user.detailsCompleted = True
             if json_request:
+                tracing.mark(json_request, "bot_handler_done")
                 user_request.process_user_request(json_request)    
             else:
                 content = f"route or waypoints for user {self.user_id} not found. cancelled! "
@@ -149,6 +151,7 @@ class UserRouteSession():
             logger.info(f"get DB route for route {self.route_id} from {self.bot_brain.origin} to {self.bot_brain.destination}")
 
         mongodb_adapter.disconnect_db()
+        tracing.start_trace(request)  # added after route was cached in mongo, so cached routes don't hold a trace
         return request
 
 #####################################################################################################################
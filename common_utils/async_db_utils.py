@@ -0,0 +1,143 @@
+"""
+asyncpg versions of the db_utils helpers, used by the api-service asyncio mode (api-service/async_main.py).
+
+Same DB settings, pool sizes and SQL text (db_statements) as db_utils, so both modes read and write the same rows.
+asyncpg prepares each statement once per pooled connection by itself (its statement cache), unless
+RDS_DB_PREPARED_STATEMENTS = "0". Records are returned as dicts.
+"""
+import asyncio
+import json
+from decimal import Decimal
+import asyncpg
+from common_utils.local_logger import logger
+from common_utils import db_statements
+from common_utils.db_utils import (get_db_setting, convert_values, use_prepared_statements, BULK_PAGE_SIZE,
+                                   DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT_SEC, DB_CONNECT_TIMEOUT_SEC)
+
+pool = None
+pool_lock = None  # created in the event loop
+
+
+async def get_pool():
+    """ returns the connection pool (created on first call), None if DB is not available """
+    global pool, pool_lock
+    if pool is not None:
+        return pool
+    if pool_lock is None:
+        pool_lock = asyncio.Lock()
+    async with pool_lock:
+        if pool is None:
+            try:
+                pool = await asyncpg.create_pool(
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    database=get_db_setting('NAME'),
+                    user=get_db_setting('USER'),
+                    password=get_db_setting('PASSWORD'),
+                    host=get_db_setting('HOST'),
+                    port=int(get_db_setting('PORT', '5432')),
+                    timeout=DB_CONNECT_TIMEOUT_SEC,
+                    statement_cache_size=100 if use_prepared_statements else 0,
+                )
+                logger.info(f"Async database connection pool created (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+            except (OSError, asyncio.TimeoutError, asyncpg.PostgresError) as e:
+                logger.error(f"Error connecting to PostgreSQL: {e}")
+                return None
+    return pool
+
+
+async def close_pool():
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
+        logger.info("Async database connection pool closed")
+
+
+async def fetch(query, *params):
+    """ run query on a pooled connection and return records as dicts (None if DB is not available) """
+    db_pool = await get_pool()
+    if db_pool is None:
+        return None
+    async with db_pool.acquire(timeout=DB_POOL_TIMEOUT_SEC) as conn:
+        records = await conn.fetch(query, *params)
+    return [dict(record) for record in records]
+
+
+def to_param(value):
+    """ asyncpg encodes NUMERIC parameters from Decimal only (psycopg2 sends floats as literals) """
+    return Decimal(str(value)) if isinstance(value, float) else value
+
+
+async def get_records_by_keys(table_name, column, values):
+    """ same as db_utils.get_records_by_keys - returns {key value: record} of keys found in a single query """
+    values = list(dict.fromkeys(values))  # distinct, keeps order
+    if not values:
+        return dict()
+    if not db_statements.is_allowed(table_name, column if isinstance(column, (tuple, list)) else [column]):
+        return None
+    if isinstance(column, (tuple, list)):
+        # (a, b) IN (($1, $2), ($3, $4), ...) - parameter types are taken from the key columns
+        width = len(column)
+        rows = ', '.join('(' + ', '.join(f"${idx * width + pos + 1}" for pos in range(width)) + ')' for idx in range(len(values)))
+        query = f"SELECT * FROM {table_name} WHERE ({', '.join(column)}) IN ({rows})"
+        records = await fetch(query, *[to_param(value) for key in values for value in key])
+        get_key = lambda record: tuple(convert_values(record[name]) for name in column)
+    else:
+        statement = db_statements.select_by_keys_statement(table_name, column)
+        records = await fetch(statement.prepare_sql, values)
+        get_key = lambda record: convert_values(record[column])
+    if records is None:
+        return None
+    result = dict()
+    for record in records:
+        result.setdefault(get_key(record), record)
+    logger.debug(f"Retrieved {len(result)} of {len(values)} keys from {table_name}")
+    return result
+
+
+async def find_nearby(table_name, latitude, longitude, radius_m, limit=10, lat_column="latitude", lng_column="longitude"):
+    """ same as db_utils.find_nearby - records within 'radius_m' meters, nearest first, with 'distance_m' field """
+    if not db_statements.is_allowed(table_name, [lat_column, lng_column]):
+        return None
+    if latitude is None or longitude is None:
+        return []
+    statement = db_statements.nearby_statement(table_name, lat_column, lng_column)
+    params = db_statements.nearby_params(float(latitude), float(longitude), float(radius_m), int(limit))
+    records = await fetch(statement.prepare_sql, *params)
+    if records is not None:
+        logger.debug(f"Found {len(records)} records in {table_name} within {radius_m}m of {latitude},{longitude}")
+    return records
+
+
+async def insert_many(table_name, rows, on_conflict=""):
+    """
+    same as db_utils.insert_many. each page of rows is sent as one json parameter and converted by postgres to the
+    column types (asyncpg does not adapt python values to column types the way psycopg2 literals do)
+    """
+    if not rows:
+        return []
+    columns = db_statements.get_columns(rows)
+    if not db_statements.is_allowed(table_name, columns):
+        return None
+    column_list = ', '.join(columns)
+    query = (f"INSERT INTO {table_name} ({column_list}) SELECT {column_list} "
+             f"FROM json_populate_recordset(NULL::{table_name}, $1::json) {on_conflict} RETURNING *")
+    db_pool = await get_pool()
+    if db_pool is None:
+        return None
+    stored_records = []
+    async with db_pool.acquire(timeout=DB_POOL_TIMEOUT_SEC) as conn:
+        async with conn.transaction():  # single commit for all pages
+            for start in range(0, len(rows), BULK_PAGE_SIZE):
+                page = json.dumps(rows[start:start + BULK_PAGE_SIZE], default=str, ensure_ascii=False)
+                stored_records.extend(dict(record) for record in await conn.fetch(query, page))
+    logger.info(f"Inserted {len(stored_records)} records into {table_name}")
+    return stored_records
+
+
+async def upsert_many(table_name, rows, conflict_columns=("place_id",), refresh_created_at=True):
+    """ same as db_utils.upsert_many - rows with existing 'conflict_columns' key are updated """
+    rows = db_statements.dedupe_rows(rows, conflict_columns)
+    on_conflict = db_statements.upsert_clause(db_statements.get_columns(rows), conflict_columns, refresh_created_at)
+    return await insert_many(table_name, rows, on_conflict)
@@ -0,0 +1,63 @@
+"""
+Hit/miss counters for the in-process caches (places, translations, DB rows), kept per kafka partition.
+The consumer sets the partition of the message being handled, so caches don't need to know about kafka.
+Hit rate per partition shows whether partitioning by corridor keeps caches hot.
+"""
+import contextvars
+import os
+import threading
+import time
+from common_utils.local_logger import logger
+
+REPORT_INTERVAL_SEC = int(os.getenv('CACHE_STATS_REPORT_SEC', '300'))
+
+lock = threading.Lock()
+counters = dict()  # (cache_name, partition) -> [hits, misses]
+current_partition = contextvars.ContextVar('current_partition', default=None)  # per thread and per asyncio task
+last_report_time = time.monotonic()
+
+
+def set_current_partition(partition):
+    """ called by consumer before handling a message (None when not known) """
+    current_partition.set(partition)
+
+
+def get_current_partition():
+    return current_partition.get()
+
+
+def record(cache_name, hit):
+    key = (cache_name, get_current_partition())
+    with lock:
+        stats = counters.setdefault(key, [0, 0])
+        stats[0 if hit else 1] += 1
+
+
+def record_hit(cache_name):
+    record(cache_name, True)
+
+
+def record_miss(cache_name):
+    record(cache_name, False)
+
+
+def get_stats():
+    """ returns {cache_name: {partition: (hits, misses, hit_rate)}} """
+    result = dict()
+    with lock:
+        for (cache_name, partition), (hits, misses) in counters.items():
+            total = hits + misses
+            result.setdefault(cache_name, dict())[partition] = (hits, misses, hits / total if total else 0.0)
+    return result
+
+
+def report_cache_stats(force=False):
+    """ log hit rate per cache and partition. logs at most once every REPORT_INTERVAL_SEC unless forced """
+    global last_report_time
+    now = time.monotonic()
+    if not force and now - last_report_time < REPORT_INTERVAL_SEC:
+        return
+    last_report_time = now
+    for cache_name, partitions in sorted(get_stats().items()):
+        for partition, (hits, misses, hit_rate) in sorted(partitions.items(), key=lambda item: str(item[0])):
+            logger.info(f"cache {cache_name} partition {partition}: hits={hits} misses={misses} hit-rate={hit_rate:.1%}")
@@ -0,0 +1,163 @@
+"""
+SQL text cache and table/column allow-list for db_utils helpers.
+
+Statements are generated once per (table, columns) and kept, each with a stable name used for server-side
+PREPARE/EXECUTE (db_utils prepares a statement once per pooled connection, so Postgres parses and plans it once).
+Table and column names are interpolated into SQL text, so they are checked against the tables defined in
+DB/OptimizedPostgreSQLSchema.sql first.
+"""
+import math
+import os
+import re
+import zlib
+from collections import namedtuple
+from functools import lru_cache
+from common_utils.local_logger import logger
+
+SCHEMA_FILE = os.getenv('DB_SCHEMA_FILE', os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "DB", "OptimizedPostgreSQLSchema.sql"))
+
+# sql - with %s placeholders (plain execute), prepare_sql - with $n placeholders (PREPARE)
+Statement = namedtuple("Statement", ["name", "sql", "prepare_sql", "num_params"])
+
+create_table_pattern = re.compile(r"^\s*CREATE TABLE (?:IF NOT EXISTS )?(?:public\.)?(\w+)\s*\(", re.IGNORECASE)
+constraint_words = {"PRIMARY", "FOREIGN", "UNIQUE", "CHECK", "CONSTRAINT", "EXCLUDE", "LIKE"}
+
+
+def load_schema_columns(file_name=SCHEMA_FILE):
+    """ returns {table: set of columns} of tables created in schema file """
+    tables = dict()
+    current_table = None
+    with open(file_name, "r", encoding="utf-8") as file:
+        for line in file:
+            line = line.split("--")[0].strip()
+            match = create_table_pattern.match(line)
+            if match:
+                current_table = tables.setdefault(match.group(1).lower(), set())
+                continue
+            if current_table is None or not line:
+                continue
+            if line.startswith(")"):
+                current_table = None
+                continue
+            word = line.split()[0].strip(",").lower()
+            if word.upper() not in constraint_words:
+                current_table.add(word)
+    return tables
+
+
+@lru_cache(maxsize=1)
+def get_schema_columns():
+    try:
+        return load_schema_columns()
+    except OSError as e:
+        logger.error(f"DB schema file {SCHEMA_FILE} not found - tables/columns can't be validated: {e}")
+        return dict()
+
+
+def is_allowed(table_name, columns=()):
+    """ True if table and all columns are defined in schema file (logs an error otherwise) """
+    table_columns = get_schema_columns().get(table_name)
+    if table_columns is None:
+        logger.error(f"table '{table_name}' is not in DB schema")
+        return False
+    unknown = [column for column in columns if column not in table_columns]
+    if unknown:
+        logger.error(f"columns {unknown} are not in DB schema of table '{table_name}'")
+        return False
+    return True
+
+
+def make_statement(kind, table_name, sql):
+    """ name is derived from the SQL text, so equal statements share their prepared plan """
+    num_params = sql.count("%s")
+    prepare_sql = sql
+    for idx in range(1, num_params + 1):
+        prepare_sql = prepare_sql.replace("%s", f"${idx}", 1)
+    name = f"{kind}_{table_name}_{zlib.crc32(sql.encode('utf-8')):08x}"
+    return Statement(name, sql, prepare_sql, num_params)
+
+
+def where_clause(filter_columns):
+    return " AND ".join([f"{column} = %s" for column in filter_columns])
+
+
+@lru_cache(maxsize=1024)
+def select_statement(table_name, filter_columns):
+    sql = f"SELECT * FROM {table_name} WHERE {where_clause(filter_columns)}" if filter_columns else f"SELECT * FROM {table_name}"
+    return make_statement("select", table_name, sql)
+
+
+@lru_cache(maxsize=1024)
+def select_by_keys_statement(table_name, column):
+    return make_statement("select_keys", table_name, f"SELECT * FROM {table_name} WHERE {column} = ANY(%s)")
+
+
+@lru_cache(maxsize=1024)
+def insert_statement(table_name, columns):
+    sql = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))}) RETURNING *"
+    return make_statement("insert", table_name, sql)
+
+
+@lru_cache(maxsize=1024)
+def update_statement(table_name, set_columns, filter_columns):
+    set_clause = ', '.join([f"{column} = %s" for column in set_columns])
+    sql = f"UPDATE {table_name} SET {set_clause} WHERE {where_clause(filter_columns)} RETURNING *"
+    return make_statement("update", table_name, sql)
+
+
+@lru_cache(maxsize=1024)
+def delete_statement(table_name, filter_columns):
+    return make_statement("delete", table_name, f"DELETE FROM {table_name} WHERE {where_clause(filter_columns)} RETURNING *")
+
+
+EARTH_RADIUS_M = 6371000
+METERS_PER_DEGREE_LAT = 111320
+
+
+@lru_cache(maxsize=1024)
+def nearby_statement(table_name, lat_column, lng_column):
+    """ records within radius, nearest first. params - see nearby_params() """
+    # point expression must be the same as in the index definition (DB/spatial_indexes.sql)
+    sql = f"""
+        SELECT * FROM (
+            SELECT *, 2 * {EARTH_RADIUS_M} * asin(sqrt(
+                power(sin(radians({lat_column}::float8 - %s::float8) / 2), 2) +
+                cos(radians(%s::float8)) * cos(radians({lat_column}::float8)) * power(sin(radians({lng_column}::float8 - %s::float8) / 2), 2)
+            )) AS distance_m
+            FROM {table_name}
+            WHERE point({lng_column}::float8, {lat_column}::float8) <@ box(point(%s::float8, %s::float8), point(%s::float8, %s::float8))
+        ) AS candidates
+        WHERE distance_m <= %s::float8
+        ORDER BY distance_m
+        LIMIT %s::int"""
+    return make_statement("nearby", table_name, sql)
+
+
+def nearby_params(latitude, longitude, radius_m, limit):
+    """ nearby_statement params - point, its bounding box, radius and limit """
+    lat_delta = radius_m / METERS_PER_DEGREE_LAT
+    lng_delta = radius_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(latitude)), 0.01))
+    return (latitude, latitude, longitude,
+            longitude - lng_delta, latitude - lat_delta, longitude + lng_delta, latitude + lat_delta,
+            radius_m, limit)
+
+
+def get_columns(rows):
+    """ union of row keys, in first seen order. missing values are stored as NULL """
+    columns = dict()
+    for row in rows:
+        columns.update(dict.fromkeys(row))
+    return list(columns)
+
+
+def dedupe_rows(rows, conflict_columns):
+    """ same key twice in one upsert statement fails ("cannot affect row a second time") - last row wins """
+    return list({tuple(row.get(column) for column in conflict_columns): row for row in rows}.values())
+
+
+def upsert_clause(columns, conflict_columns, refresh_created_at=True):
+    """ ON CONFLICT clause updating all non key columns (and created_at if 'refresh_created_at') """
+    set_clause = [f"{column} = EXCLUDED.{column}" for column in columns if column not in conflict_columns]
+    if refresh_created_at:
+        set_clause.append("created_at = CURRENT_TIMESTAMP")
+    return f"ON CONFLICT ({', '.join(conflict_columns)}) " + (f"DO UPDATE SET {', '.join(set_clause)}" if set_clause else "DO NOTHING")
@@ -1,115 +1,448 @@
 import psycopg2
 import psycopg2.extras
+import psycopg2.pool
+import psycopg2.errors
+import psycopg2.extensions
+import atexit
 import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
 from decimal import Decimal
 from common_utils.local_logger import logger
+from common_utils import db_statements
+
+
+def get_db_setting(name, default=None):
+    """ RDS_DB_<name> env variable. AWS Lambda cleaner sets DB_<name> instead """
+    return os.getenv(f'RDS_DB_{name}', os.getenv(f'DB_{name}', default))
+
+
+# Connection pool settings - connections are opened once and reused by all messages (and threads) of a service
+DB_POOL_MIN_SIZE = int(os.getenv('RDS_DB_POOL_MIN', '1'))
+DB_POOL_MAX_SIZE = int(os.getenv('RDS_DB_POOL_MAX', '10'))
+DB_POOL_TIMEOUT_SEC = float(os.getenv('RDS_DB_POOL_TIMEOUT_SEC', '30'))       # max wait for a free connection
+DB_CONNECT_TIMEOUT_SEC = int(os.getenv('RDS_DB_CONNECT_TIMEOUT_SEC', '10'))
+DB_HEALTH_CHECK_SEC = float(os.getenv('RDS_DB_HEALTH_CHECK_SEC', '60'))       # idle connections are checked before reuse
+DB_ITERSIZE = int(os.getenv('RDS_DB_ITERSIZE', '2000'))                      # rows per round trip of iter_records
+# CRUD helpers run as server-side prepared statements. set to '0' behind a transaction pooling proxy (i.e. pgbouncer)
+use_prepared_statements = os.getenv('RDS_DB_PREPARED_STATEMENTS', '1') == '1'
+
+pool = None
+pool_lock = threading.Lock()
+pool_slots = threading.BoundedSemaphore(DB_POOL_MAX_SIZE)  # ThreadedConnectionPool raises instead of waiting when exhausted
+last_used = dict()  # id(connection) -> time it was returned to the pool
+
+# connection and cursor of current thread. connect_db/disconnect_db calls may be nested (i.e. message handler
+# and the places fetcher it calls) - connection goes back to the pool when outermost scope ends
+session = threading.local()
+
+
+class PreparingConnection(psycopg2.extensions.connection):
+    """ connection that remembers which statements were already prepared on it (prepared statements are per session) """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+def get_pool():
+    global pool
+    with pool_lock:
+        if pool is None:
+            pool = psycopg2.pool.ThreadedConnectionPool(
+                DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE,
+                dbname=get_db_setting('NAME'),
+                user=get_db_setting('USER'),
+                password=get_db_setting('PASSWORD'),
+                host=get_db_setting('HOST'),
+                port=get_db_setting('PORT', '5432'),
+                connect_timeout=DB_CONNECT_TIMEOUT_SEC,
+                keepalives=1,           # detect connections dropped by RDS/NAT while idle in the pool
+                keepalives_idle=30,
+                connection_factory=PreparingConnection
+            )
+            logger.info(f"Database connection pool created (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+        return pool
+
+
+def is_healthy(connection):
+    """ closed connections are dropped. connections idle for long are checked with a trivial query """
+    if connection.closed:
+        return False
+    returned_at = last_used.get(id(connection))
+    if returned_at is None or time.monotonic() - returned_at < DB_HEALTH_CHECK_SEC:
+        return True  # new connection or recently used
+    try:
+        with connection.cursor() as check_cur:
+            check_cur.execute("SELECT 1")
+        connection.rollback()
+        return True
+    except psycopg2.Error as e:
+        logger.error(f"Dropping broken database connection: {e}")
+        return False
+
+
+def acquire_connection():
+    """ take a healthy connection from the pool (waits up to DB_POOL_TIMEOUT_SEC if all are in use) """
+    if not pool_slots.acquire(timeout=DB_POOL_TIMEOUT_SEC):
+        raise psycopg2.pool.PoolError(f"no free database connection after {DB_POOL_TIMEOUT_SEC} sec")
+    try:
+        db_pool = get_pool()
+        for _ in range(DB_POOL_MAX_SIZE + 1):
+            connection = db_pool.getconn()
+            if is_healthy(connection):
+                return connection
+            last_used.pop(id(connection), None)
+            db_pool.putconn(connection, close=True)
+        raise psycopg2.OperationalError("could not get a healthy database connection")
+    except Exception:
+        pool_slots.release()
+        raise
+
+
+def release_connection(connection):
+    """ return connection to the pool. open transaction (i.e. after an error) is rolled back first """
+    broken = connection.closed != 0
+    if not broken:
+        try:
+            if connection.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                connection.rollback()
+        except psycopg2.Error:
+            broken = True
+    if broken:
+        last_used.pop(id(connection), None)
+    else:
+        last_used[id(connection)] = time.monotonic()
+    try:
+        get_pool().putconn(connection, close=broken)
+    finally:
+        pool_slots.release()
+
+
+def get_connection():
+    return getattr(session, 'conn', None)
+
+
+def get_cursor():
+    return getattr(session, 'cur', None)
 
-# Global connection and cursor variables
-conn = None
-cur = None
 
 def is_connected():
-    if conn and cur:
+    if get_connection() and get_cursor():
         return True
     return False
 
 def connect_db():
     """
-    Establishes a connection to the PostgreSQL database and sets the global connection and cursor.
+    Takes a connection from the pool for current thread (or joins the connection thread already holds).
+    Every connect_db() call must be matched with disconnect_db(). returns True if connected.
     """
-    global conn, cur
-    if conn is None or cur is None:
-        try:
-            conn = psycopg2.connect(
-                dbname=os.getenv('RDS_DB_NAME'),
-                user=os.getenv('RDS_DB_USER'),
-                password=os.getenv('RDS_DB_PASSWORD'),
-                host=os.getenv('RDS_DB_HOST'),
-                port=os.getenv('RDS_DB_PORT')
-            )
-            cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-            logger.info("Database connection established successfully.")
-        except psycopg2.Error as e:
-            logger.error(f"Error connecting to PostgreSQL: {e}")
-            exit(1)
+    if getattr(session, 'depth', 0) > 0:
+        session.depth += 1
+        return True
+    try:
+        session.conn = acquire_connection()
+        session.cur = session.conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        session.depth = 1
+        logger.debug("Database connection taken from pool.")
+        return True
+    except psycopg2.Error as e:
+        session.conn = session.cur = None
+        logger.error(f"Error connecting to PostgreSQL: {e}")
+        return False
 
 def disconnect_db():
     """
-    Closes the global database connection and cursor.
+    Ends current connect_db() scope. connection goes back to the pool when outermost scope ends.
     """
-    global conn, cur
-    if cur:
-        cur.close()
-        cur = None
-    if conn:
-        conn.close()
-        conn = None
-    logger.info("Database connection closed.")
+    depth = getattr(session, 'depth', 0)
+    if depth == 0:
+        return
+    session.depth = depth - 1
+    if session.depth > 0:
+        return
+    connection, cursor = session.conn, session.cur
+    session.conn = session.cur = None
+    try:
+        if cursor and not cursor.closed:
+            cursor.close()
+    except psycopg2.Error:
+        pass
+    release_connection(connection)
+    logger.debug("Database connection returned to pool.")
+
+
+@contextmanager
+def connection():
+    """
+    Context manager around connect_db()/disconnect_db(). yields the (RealDict) cursor, or None if DB is not available:
+        with db_utils.connection() as cur:
+            records = get_record("gas_stations", {...})
+    """
+    depth_before = getattr(session, 'depth', 0)
+    connect_db()
+    try:
+        yield get_cursor()
+    finally:
+        while getattr(session, 'depth', 0) > depth_before:  # also ends inner scopes left open by an exception
+            disconnect_db()
+
+
+def execute(query, params=(), commit=False):
+    """ run query on current thread connection. on error the transaction is rolled back (so connection stays usable) """
+    conn, cur = get_connection(), get_cursor()
+    try:
+        cur.execute(query, params)
+        if commit:
+            conn.commit()
+    except psycopg2.Error:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    return cur
+
+
+def execute_statement(statement, params=(), commit=False):
+    """
+    run a db_statements.Statement on current thread connection. prepared once per connection (PREPARE), then
+    executed by name, so Postgres reuses the parsed statement and plan.
+    """
+    conn = get_connection()
+    if not use_prepared_statements or not hasattr(conn, 'prepared'):
+        return execute(statement.sql, params, commit)
+    if statement.name not in conn.prepared:
+        try:
+            execute(f"PREPARE {statement.name} AS {statement.prepare_sql}")
+        except psycopg2.errors.DuplicatePreparedStatement:
+            pass  # prepared before an error cleared our bookkeeping
+        conn.prepared.add(statement.name)
+    args = f" ({', '.join(['%s'] * statement.num_params)})" if statement.num_params else ""
+    try:
+        return execute(f"EXECUTE {statement.name}{args}", params, commit)
+    except psycopg2.errors.InvalidSqlStatementName:
+        conn.prepared.discard(statement.name)
+        raise
+
+
+def close_pool():
+    """ close all pooled connections. registered to run on process exit """
+    global pool
+    with pool_lock:
+        if pool is not None:
+            pool.closeall()
+            pool = None
+            logger.info("Database connection pool closed.")
+
+atexit.register(close_pool)
 
 def get_record(table_name, filters):
     """
     Fetches records from the given table that match the filters.
-    Assumes that `conn` and `cur` are already valid.
+    Assumes that DB is connected (connect_db / connection()).
     """
     if not is_connected():
         logger.error("get_record: DB is not connected")
         return None
+    if not db_statements.is_allowed(table_name, filters.keys()):
+        return None
+    statement = db_statements.select_statement(table_name, tuple(filters.keys()))
+    records = execute_statement(statement, tuple(filters.values())).fetchall()
+    logger.debug(f"Retrieved {len(records)} records from {table_name}")
+    return records
+
+row_cursor_factories = {
+    "dict": psycopg2.extras.RealDictCursor,
+    "namedtuple": psycopg2.extras.NamedTupleCursor,
+    "tuple": None,  # plain tuples - no per row dict allocation
+}
+
+@contextmanager
+def iter_records(table_name, filters=None, columns=None, row_mode="dict", itersize=DB_ITERSIZE):
+    """
+    Iterator over records of the given table that match the filters, read with a server-side (named) cursor,
+    so only 'itersize' rows are held in memory at a time. for scanning full tables:
+        with db_utils.iter_records("gas_stations", columns=["name"], row_mode="tuple") as records:
+            for record in records: ...
+    'columns' - list of columns to read (default all). with row_mode 'tuple' values are in 'columns' order.
+    'row_mode' - 'dict', 'namedtuple' or 'tuple'.
+    the cursor has its own pooled connection (not the one current thread holds), so commits of other statements
+    while iterating don't close it. the connection goes back to the pool when the 'with' block ends, also if
+    iteration stopped early. yields an empty iterator if DB is not available.
+    """
+    if row_mode not in row_cursor_factories:
+        raise ValueError(f"iter_records: unknown row mode '{row_mode}'")
+    filters = filters or dict()
+    if not db_statements.is_allowed(table_name, list(filters.keys()) + list(columns or [])):
+        yield iter(())
+        return
+    select = ', '.join(columns) if columns else '*'
     where_clause = " AND ".join([f"{k} = %s" for k in filters.keys()])
-    query = f"SELECT * FROM {table_name} WHERE {where_clause}" if filters else f"SELECT * FROM {table_name}"
-    cur.execute(query, tuple(filters.values()))
-    records = cur.fetchall()
-    logger.debug(f"Retrieved records from {table_name}: {records}")
+    query = f"SELECT {select} FROM {table_name}" + (f" WHERE {where_clause}" if filters else "")
+    try:
+        conn = acquire_connection()
+    except psycopg2.Error as e:
+        logger.error(f"iter_records: DB is not connected: {e}")
+        yield iter(())
+        return
+    named_cursor = conn.cursor(name=f"iter_{table_name}_{uuid.uuid4().hex[:8]}", cursor_factory=row_cursor_factories[row_mode])
+    named_cursor.itersize = itersize
+    counter = {'count': 0}
+
+    def read_records():
+        named_cursor.execute(query, tuple(filters.values()))
+        for record in named_cursor:
+            counter['count'] += 1
+            yield record
+
+    try:
+        yield read_records()
+    finally:
+        try:
+            if not named_cursor.closed and not conn.closed:
+                named_cursor.close()
+        except psycopg2.Error:
+            pass  # cursor is already gone with a failed transaction
+        release_connection(conn)  # ends (rolls back) the read only transaction
+        logger.debug(f"Iterated {counter['count']} records from {table_name}")
+
+def get_records_by_keys(table_name, column, values):
+    """
+    Fetches records whose 'column' is one of 'values' in a single query. returns {key value: record}.
+    'column' may be a tuple of columns (composite key) - then values (and returned keys) are tuples.
+    if several records have the same key, the first is returned. Decimal key values are converted like convert_values().
+    Assumes that DB is connected (connect_db / connection()).
+    """
+    if not is_connected():
+        logger.error("get_records_by_keys: DB is not connected")
+        return None
+    values = list(dict.fromkeys(values))  # distinct, keeps order
+    if not values:
+        return dict()
+    if not db_statements.is_allowed(table_name, column if isinstance(column, (tuple, list)) else [column]):
+        return None
+    if isinstance(column, (tuple, list)):
+        arrays = [list(column_values) for column_values in zip(*values)]
+        unnest_args = ', '.join(['%s'] * len(column))
+        query = f"SELECT * FROM {table_name} WHERE ({', '.join(column)}) IN (SELECT * FROM unnest({unnest_args}))"
+        records = execute(query, tuple(arrays)).fetchall()
+        get_key = lambda record: tuple(convert_values(record[name]) for name in column)
+    else:
+        statement = db_statements.select_by_keys_statement(table_name, column)
+        records = execute_statement(statement, (values,)).fetchall()
+        get_key = lambda record: convert_values(record[column])
+    result = dict()
+    for record in records:
+        result.setdefault(get_key(record), record)
+    logger.debug(f"Retrieved {len(result)} of {len(values)} keys from {table_name}")
+    return result
+
+def find_nearby(table_name, latitude, longitude, radius_m, limit=10, lat_column="latitude", lng_column="longitude"):
+    """
+    Fetches up to 'limit' records located within 'radius_m' meters of (latitude, longitude), nearest first.
+    each record has an extra 'distance_m' field.
+    Uses the GiST index on point(lng_column, lat_column) (see DB/spatial_indexes.sql) to scan only the bounding box,
+    and exact (haversine) distance to filter and sort.
+    Assumes that DB is connected (connect_db / connection()).
+    """
+    if not is_connected():
+        logger.error("find_nearby: DB is not connected")
+        return None
+    if not db_statements.is_allowed(table_name, [lat_column, lng_column]):
+        return None
+    if latitude is None or longitude is None:
+        return []
+    statement = db_statements.nearby_statement(table_name, lat_column, lng_column)
+    records = execute_statement(statement, db_statements.nearby_params(latitude, longitude, radius_m, limit)).fetchall()
+    logger.debug(f"Found {len(records)} records in {table_name} within {radius_m}m of {latitude},{longitude}")
     return records
 
 def insert_record(table_name, data):
     """
     Inserts a new record into the given table and returns it.
-    Assumes that `conn` and `cur` are already valid.
+    Assumes that DB is connected (connect_db / connection()).
     """
     if not is_connected():
         logger.error("insert_record: DB is not connected")
         return None
-    columns = ', '.join(data.keys())
-    values_placeholder = ', '.join(['%s'] * len(data))
-    query = f"INSERT INTO {table_name} ({columns}) VALUES ({values_placeholder}) RETURNING *"
-    cur.execute(query, tuple(data.values()))
-    conn.commit()
-    inserted_record = cur.fetchone()
+    if not db_statements.is_allowed(table_name, data.keys()):
+        return None
+    statement = db_statements.insert_statement(table_name, tuple(data.keys()))
+    inserted_record = execute_statement(statement, tuple(data.values()), commit=True).fetchone()
     logger.info(f"Inserted record into {table_name}: {inserted_record}")
     return inserted_record
 
 def update_record(table_name, data, filters):
     """
     Updates records in the given table that match the filters and returns the updated row.
-    Assumes that `conn` and `cur` are already valid.
+    Assumes that DB is connected (connect_db / connection()).
     """
     if not is_connected():
         logger.error("update_record: DB is not connected")
         return None
-    set_clause = ', '.join([f"{k} = %s" for k in data.keys()])
-    where_clause = " AND ".join([f"{k} = %s" for k in filters.keys()])
-    query = f"UPDATE {table_name} SET {set_clause} WHERE {where_clause} RETURNING *"
-    cur.execute(query, tuple(data.values()) + tuple(filters.values()))
-    conn.commit()
-    updated_record = cur.fetchone()
+    if not db_statements.is_allowed(table_name, list(data.keys()) + list(filters.keys())):
+        return None
+    statement = db_statements.update_statement(table_name, tuple(data.keys()), tuple(filters.keys()))
+    updated_record = execute_statement(statement, tuple(data.values()) + tuple(filters.values()), commit=True).fetchone()
     logger.info(f"Updated record in {table_name}: {updated_record}")
     return updated_record
 
 def delete_record(table_name, filters):
     """
     Deletes records from the given table that match the filters and returns the deleted row.
-    Assumes that `conn` and `cur` are already valid.
+    Assumes that DB is connected (connect_db / connection()).
     """
-    
-    where_clause = " AND ".join([f"{k} = %s" for k in filters.keys()])
-    query = f"DELETE FROM {table_name} WHERE {where_clause} RETURNING *"
-    cur.execute(query, tuple(filters.values()))
-    conn.commit()
-    deleted_record = cur.fetchone()
+    if not is_connected():
+        logger.error("delete_record: DB is not connected")
+        return None
+    if not db_statements.is_allowed(table_name, filters.keys()):
+        return None
+    statement = db_statements.delete_statement(table_name, tuple(filters.keys()))
+    deleted_record = execute_statement(statement, tuple(filters.values()), commit=True).fetchone()
     logger.info(f"Deleted record from {table_name}: {deleted_record}")
     return deleted_record
 
 
+BULK_PAGE_SIZE = 500  # rows per INSERT statement sent by insert_many / upsert_many
+
+
+def insert_many(table_name, rows, on_conflict=""):
+    """
+    Inserts a list of dicts with one statement (per BULK_PAGE_SIZE rows) and a single commit. returns the stored rows.
+    Assumes that DB is connected (connect_db / connection()).
+    """
+    if not rows:
+        return []
+    if not is_connected():
+        logger.error("insert_many: DB is not connected")
+        return None
+    columns = db_statements.get_columns(rows)
+    if not db_statements.is_allowed(table_name, columns):
+        return None
+    query = f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES %s {on_conflict} RETURNING *"
+    values = [tuple(row.get(column) for column in columns) for row in rows]
+    conn, cur = get_connection(), get_cursor()
+    try:
+        stored_records = psycopg2.extras.execute_values(cur, query, values, page_size=BULK_PAGE_SIZE, fetch=True)
+        conn.commit()
+    except psycopg2.Error:
+        if not conn.closed:
+            conn.rollback()
+        raise
+    logger.info(f"Inserted {len(stored_records)} records into {table_name}")
+    return stored_records
+
+def upsert_many(table_name, rows, conflict_columns=("place_id",), refresh_created_at=True):
+    """
+    Inserts a list of dicts, updating existing rows with the same 'conflict_columns' (unique key). returns the stored rows.
+    'refresh_created_at' - updated rows get a new created_at, so the weekly cleaner keeps places that are still in use.
+    Assumes that DB is connected (connect_db / connection()).
+    """
+    rows = db_statements.dedupe_rows(rows, conflict_columns)
+    on_conflict = db_statements.upsert_clause(db_statements.get_columns(rows), conflict_columns, refresh_created_at)
+    return insert_many(table_name, rows, on_conflict)
+
+
 # Convert to a list of dictionaries with proper types
 def convert_values(obj):
     if isinstance(obj, Decimal):
@@ -124,19 +457,17 @@ def convert_record(record):
 
 # Example Usage
 if __name__ == "__main__":
-    connect_db()  # Ensure connection is established
-
-    if conn is not None and cur is not None:  # Check before calling
-        inserted_record = insert_record("users", {"username": "Yaniv Raba", "email": "yaniv.raba@example.com", "chat_id": 112233})
-        logger.info(f"Inserted: {inserted_record}")
-
-        users = get_record("users", {"username": "Yaniv Raba"})
-        logger.info(f"Users: {users}")
+    with connection() as cur:  # connection is taken from the pool and returned at the end
+        if cur is not None:  # Check before calling
+            inserted_record = insert_record("users", {"username": "Yaniv Raba", "email": "yaniv.raba@example.com", "chat_id": 112233})
+            logger.info(f"Inserted: {inserted_record}")
 
-        updated_record = update_record("users", {"email": "new.yanivraba@example.com"}, {"username": "Yaniv Raba"})
-        logger.info(f"Updated: {updated_record}")
+            users = get_record("users", {"username": "Yaniv Raba"})
+            logger.info(f"Users: {users}")
 
-        deleted_record = delete_record("users", {"username": "Yaniv Raba"})
-        logger.info(f"Deleted: {deleted_record}")
+            updated_record = update_record("users", {"email": "new.yanivraba@example.com"}, {"username": "Yaniv Raba"})
+            logger.info(f"Updated: {updated_record}")
 
-    disconnect_db()  # Close connection at the end
+            deleted_record = delete_record("users", {"username": "Yaniv Raba"})
+            logger.info(f"Deleted: {deleted_record}")
+    close_pool()
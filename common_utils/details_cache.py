@@ -0,0 +1,52 @@
+"""
+Place-details cache with field level freshness (google place details api, the most expensive google SKU).
+
+Each field of a place is kept with its fetch time. Slow changing fields (address, website, price level ...) are
+fresh for DETAILS_SLOW_TTL_SEC, fast changing ones (opening hours) for DETAILS_FAST_TTL_SEC.
+lookup() returns the fresh fields and the stale ones, so the api is asked only for the stale fields (field mask).
+Fields missing in the api result are cached as missing, so they are not requested again until they get stale.
+"""
+import os
+import threading
+import time
+from common_utils.place_cache import TTLCache
+
+DETAILS_SLOW_TTL_SEC = int(os.getenv('DETAILS_SLOW_TTL_SEC', str(7 * 24 * 3600)))
+DETAILS_FAST_TTL_SEC = int(os.getenv('DETAILS_FAST_TTL_SEC', str(6 * 3600)))
+DETAILS_CACHE_SIZE = int(os.getenv('DETAILS_CACHE_SIZE', '20000'))
+
+fast_changing_fields = {"opening_hours"}  # of the fields requested by google_places (details_fields)
+
+MISSING = object()  # field not in api result
+
+details_cache = TTLCache("place_details", DETAILS_CACHE_SIZE, max(DETAILS_SLOW_TTL_SEC, DETAILS_FAST_TTL_SEC))
+put_lock = threading.Lock()  # concurrent fetches of the same place merge their fields one at a time
+
+
+def get_field_ttl(field):
+    return DETAILS_FAST_TTL_SEC if field in fast_changing_fields else DETAILS_SLOW_TTL_SEC
+
+
+def lookup(place_id, fields):
+    """ returns ({field: value} of fresh cached fields, [stale or not cached fields]) """
+    entry = details_cache.get(place_id) or {}
+    now = time.monotonic()
+    fresh = dict()
+    stale = []
+    for field in fields:
+        cached = entry.get(field)
+        if cached is None or now - cached[0] > get_field_ttl(field):
+            stale.append(field)
+        elif cached[1] is not MISSING:
+            fresh[field] = cached[1]
+    return fresh, stale
+
+
+def put(place_id, fields, details):
+    """ cache 'fields' of api result 'details' (merged with the other cached fields of the place) """
+    now = time.monotonic()
+    with put_lock:
+        entry = dict(details_cache.peek(place_id) or {})  # cached entries are shared - replaced, not changed
+        for field in fields:
+            entry[field] = (now, details.get(field, MISSING))
+        details_cache.put(place_id, entry)
@@ -0,0 +1,81 @@
+"""
+Replay dead-lettered messages back to their original topic.
+
+usage (from project root):
+    python -m common_utils.dlq_replay --topic user-requests-queue-v1 [--max-messages 100] [--dry-run]
+
+messages are read from '<topic>.dlq' with a dedicated consumer group, so each message is replayed once.
+replayed messages start again with a fresh attempts count.
+"""
+import argparse
+from kafka.structs import TopicPartition
+from common_utils.local_logger import logger
+import common_utils.kafka_common as kfk
+from common_utils import kafka_codec
+from common_utils import kafka_retry
+from common_utils.kafka_workers import make_offset_and_metadata
+from common_utils.kafka_producer import send_request_to_queue, flush_producer
+
+if kfk.TRANSPORT == kfk.TRANSPORT_MEMORY:
+    from common_utils.memory_broker import MemoryConsumer as KafkaConsumer
+else:
+    from kafka import KafkaConsumer
+
+REPLAY_GROUP_ID = "dlq-replay"
+HEADER_REPLAYED_FROM = "x-replayed-from"
+
+
+def replay_dead_letters(topic_name, max_messages=None, dry_run=False, idle_timeout_ms=5000):
+    """ move messages from dead-letter topic of 'topic_name' back to their original topic. returns number of messages replayed """
+    dlq_topic = kfk.get_dead_letter_topic_name(topic_name)
+    consumer = KafkaConsumer(
+        dlq_topic,
+        bootstrap_servers=kfk.KAFKA_BROKER,
+        value_deserializer=kafka_codec.decode,
+        auto_offset_reset='earliest',
+        enable_auto_commit=False,
+        group_id=REPLAY_GROUP_ID,
+        consumer_timeout_ms=idle_timeout_ms  # stop iterating when DLQ has no more messages
+    )
+    replayed = 0
+    next_offsets = dict()  # TopicPartition -> offset after last replayed message
+    delivery_errors = []
+
+    def on_delivery(record_metadata, error):
+        if error is not None:
+            delivery_errors.append(error)
+
+    try:
+        for message in consumer:
+            original_topic = kafka_retry.get_original_topic(message)
+            error = kafka_retry.get_header(message, kafka_retry.HEADER_ERROR, "unknown")
+            failed_at = kafka_retry.get_header(message, kafka_retry.HEADER_FAILED_AT, "unknown")
+            logger.info(f"DLQ {dlq_topic} offset {message.offset}: failed at {failed_at} with {error}")
+            if not dry_run:
+                headers = [(HEADER_REPLAYED_FROM, dlq_topic.encode("utf-8"))]
+                if not send_request_to_queue(message.value, original_topic, on_delivery, message.key, headers):
+                    logger.error(f"failed to replay DLQ offset {message.offset} - stopping")
+                    break
+            next_offsets[TopicPartition(message.topic, message.partition)] = make_offset_and_metadata(message.offset + 1)
+            replayed += 1
+            if max_messages and replayed >= max_messages:
+                break
+        if not dry_run and next_offsets:
+            flush_producer()
+            if delivery_errors:
+                logger.error(f"{len(delivery_errors)} replayed messages were not delivered - DLQ position not committed")
+            else:
+                consumer.commit(offsets=next_offsets)  # replayed messages are not read again by next replay
+    finally:
+        consumer.close()
+    logger.info(f"{'found' if dry_run else 'replayed'} {replayed} messages from {dlq_topic}")
+    return replayed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay dead-lettered messages back to their original topic")
+    parser.add_argument("--topic", required=True, choices=kfk.PIPELINE_TOPICS, help="original topic name")
+    parser.add_argument("--max-messages", type=int, default=None, help="max messages to replay (default - all)")
+    parser.add_argument("--dry-run", action="store_true", help="only list dead-lettered messages")
+    args = parser.parse_args()
+    replay_dead_letters(args.topic, args.max_messages, args.dry_run)
@@ -0,0 +1,153 @@
+"""
+Shared HTTP sessions for the outbound API clients (google places/routes, HERE, telegram, scrapers).
+
+get_session(name) returns one requests.Session per client name, shared by all threads of the process:
+  - keep-alive connection pool per host (no new TCP/TLS handshake per call)
+  - default (connect, read) timeouts for calls that don't pass their own
+  - retries with exponential backoff on connection errors, 429 and 5xx (honors Retry-After). after the last retry
+    the 429/5xx response is returned to the caller as before
+  - gzip/deflate responses (decoded by requests)
+  - optional rate limit / daily budget of the provider (rate_limiter). refused calls raise RateLimitExceeded.
+    each retry takes a token as well - see RateLimitedRetry for what the caller gets when a retry is refused
+Requests, errors, retries and latency are counted per client and host, and logged every HTTP_STATS_REPORT_SEC.
+"""
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError
+from urllib3.util.retry import Retry
+from common_utils.local_logger import logger
+from common_utils import rate_limiter
+
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '10'))                   # kept-alive connections per host
+HTTP_CONNECT_TIMEOUT_SEC = float(os.getenv('HTTP_CONNECT_TIMEOUT_SEC', '5'))
+HTTP_READ_TIMEOUT_SEC = float(os.getenv('HTTP_READ_TIMEOUT_SEC', '15'))
+HTTP_MAX_RETRIES = int(os.getenv('HTTP_MAX_RETRIES', '3'))
+HTTP_BACKOFF_SEC = float(os.getenv('HTTP_BACKOFF_SEC', '0.5'))             # retry delays: 0.5, 1, 2 ... seconds
+HTTP_STATS_REPORT_SEC = int(os.getenv('HTTP_STATS_REPORT_SEC', '300'))
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class RateLimitExceeded(requests.exceptions.RequestException):
+    """ call was refused by rate_limiter (daily budget used up or rate limit wait too long) """
+
+stats_lock = threading.Lock()
+stats = dict()  # (client name, host) -> {'requests', 'errors', 'retries', 'total_sec', 'max_sec'}
+last_report_time = time.monotonic()
+
+
+def record_request(name, url, elapsed, retries, error):
+    key = (name, urlsplit(url).netloc)
+    with stats_lock:
+        host_stats = stats.setdefault(key, {'requests': 0, 'errors': 0, 'retries': 0, 'total_sec': 0.0, 'max_sec': 0.0})
+        host_stats['requests'] += 1
+        host_stats['errors'] += 1 if error else 0
+        host_stats['retries'] += retries
+        host_stats['total_sec'] += elapsed
+        host_stats['max_sec'] = max(host_stats['max_sec'], elapsed)
+
+
+def get_stats():
+    """ returns {(client name, host): stats dict} """
+    with stats_lock:
+        return {key: dict(host_stats) for key, host_stats in stats.items()}
+
+
+def report_http_stats(force=False):
+    """ log per client/host stats. logs at most once every HTTP_STATS_REPORT_SEC unless forced """
+    global last_report_time
+    now = time.monotonic()
+    if not force and now - last_report_time < HTTP_STATS_REPORT_SEC:
+        return
+    last_report_time = now
+    for (name, host), host_stats in sorted(get_stats().items()):
+        avg_ms = host_stats['total_sec'] / host_stats['requests'] * 1000 if host_stats['requests'] else 0.0
+        logger.info(f"http {name} {host}: requests={host_stats['requests']} errors={host_stats['errors']} "
+                    f"retries={host_stats['retries']} avg={avg_ms:.0f}ms max={host_stats['max_sec'] * 1000:.0f}ms")
+
+
+class RateLimitedRetry(Retry):
+    """ urllib3 Retry that takes a rate_limiter token before each retry, so retries count towards the provider's
+        rate limit and daily budget. a refused retry raises MaxRetryError, the same as running out of retries:
+          - retry of a 429/5xx response - urllib3 returns that response (raise_on_status=False)
+          - retry of a connection/read error - requests raises ConnectionError (a RequestException)
+    """
+    def __init__(self, *args, rate_limit=None, **kwargs):
+        self.rate_limit = rate_limit
+        super().__init__(*args, **kwargs)
+
+    def new(self, **kwargs):
+        retry = super().new(**kwargs)
+        retry.rate_limit = self.rate_limit
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super().increment(method, url, response, error, _pool, _stacktrace)  # raises when out of retries
+        if self.rate_limit and not rate_limiter.acquire(self.rate_limit):
+            raise MaxRetryError(_pool, url, error)
+        return retry
+
+
+class PooledAdapter(HTTPAdapter):
+    """ HTTPAdapter that applies the default timeout and rate limit, and counts requests of its client """
+    def __init__(self, name, timeout, rate_limit=None, **kwargs):
+        self.name = name
+        self.timeout = timeout
+        self.rate_limit = rate_limit
+        super().__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self.rate_limit and not rate_limiter.acquire(self.rate_limit):
+            raise RateLimitExceeded(f"{self.rate_limit} call refused by rate limiter", request=request)
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        start_time = time.perf_counter()
+        response = None
+        try:
+            response = super().send(request, **kwargs)
+            return response
+        finally:
+            retry_state = getattr(getattr(response, 'raw', None), 'retries', None)
+            retries = len(retry_state.history) if retry_state is not None else 0
+            error = response is None or response.status_code >= 400
+            record_request(self.name, request.url, time.perf_counter() - start_time, retries, error)
+            report_http_stats()
+
+
+sessions = dict()  # client name -> requests.Session
+sessions_lock = threading.Lock()
+
+
+def get_session(name, pool_size=HTTP_POOL_SIZE, timeout=(HTTP_CONNECT_TIMEOUT_SEC, HTTP_READ_TIMEOUT_SEC),
+                max_retries=HTTP_MAX_RETRIES, retry_methods=("GET", "HEAD"), rate_limit=None):
+    """ shared session of client 'name' (created on first call - later calls ignore the other arguments).
+        'pool_size' should be >= the number of threads calling the same host.
+        'retry_methods' - only idempotent methods are retried by default
+        'rate_limit' - rate_limiter provider of the client's calls
+    """
+    with sessions_lock:
+        if name not in sessions:
+            retry = RateLimitedRetry(total=max_retries, connect=max_retries, read=max_retries, status=max_retries,
+                                     backoff_factor=HTTP_BACKOFF_SEC, status_forcelist=RETRY_STATUS_CODES,
+                                     allowed_methods=frozenset(retry_methods), respect_retry_after_header=True,
+                                     raise_on_status=False, rate_limit=rate_limit)
+            adapter = PooledAdapter(name, timeout, rate_limit, pool_connections=HTTP_POOL_SIZE, pool_maxsize=pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            sessions[name] = session
+            logger.info(f"http client {name} created (pool size {pool_size}, timeout {timeout}, retries {max_retries})")
+        return sessions[name]
+
+
+def close_sessions():
+    with sessions_lock:
+        for session in sessions.values():
+            session.close()
+        sessions.clear()
+    report_http_stats(force=True)
@@ -0,0 +1,86 @@
+"""
+Wire format (codec) for messages sent over the pipeline kafka topics.
+
+json    - compact JSON (no indentation/whitespace). uses 'orjson' if installed, otherwise std json. both produce
+          the same bytes: non-str dict keys become strings, datetime/date are ISO text and other values str()
+msgpack - binary MessagePack payload prefixed with a 2 bytes header: <codec marker><schema version>
+
+decode() detects the format by itself, so consumers can read both codecs as well as
+messages produced by older versions (pretty JSON that was encoded twice as a JSON string)
+"""
+import json
+import os
+from datetime import date, datetime
+from common_utils.local_logger import logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+SCHEMA_VERSION = 1
+MSGPACK_MARKER = 0x00  # JSON text never starts with a null byte, so it can't be mistaken for a JSON message
+
+CODEC_JSON = "json"
+CODEC_MSGPACK = "msgpack"
+
+codec_name = os.getenv('KAFKA_CODEC', CODEC_JSON).lower()
+if codec_name == CODEC_MSGPACK and msgpack is None:
+    logger.error("KAFKA_CODEC is msgpack but 'msgpack' package is not installed. using json")
+    codec_name = CODEC_JSON
+elif codec_name not in (CODEC_JSON, CODEC_MSGPACK):
+    logger.error(f"unknown KAFKA_CODEC {codec_name}. using json")
+    codec_name = CODEC_JSON
+
+
+def _json_default(value):
+    """ values json can't serialize (same for orjson and std json) """
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def _json_encode(data):
+    if orjson:
+        return orjson.dumps(data, default=_json_default, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'), default=_json_default).encode("utf-8")
+
+
+def _json_decode(raw):
+    if orjson:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+
+def _msgpack_encode(data):
+    return bytes([MSGPACK_MARKER, SCHEMA_VERSION]) + msgpack.packb(data, use_bin_type=True)
+
+
+def encode(data):
+    """ serialize a message (dict) to bytes using the configured codec """
+    if codec_name == CODEC_MSGPACK:
+        return _msgpack_encode(data)
+    return _json_encode(data)
+
+
+def decode(raw):
+    """ deserialize bytes received from kafka into a message (dict), whatever codec was used to send it """
+    if not raw:
+        return None
+    if raw[0] == MSGPACK_MARKER:
+        if msgpack is None:
+            raise ValueError("received msgpack message but 'msgpack' package is not installed")
+        version = raw[1]
+        if version > SCHEMA_VERSION:
+            logger.warning(f"received message with schema version {version}, newer than supported {SCHEMA_VERSION}")
+        return msgpack.unpackb(raw[2:], raw=False)
+
+    data = _json_decode(raw)
+    if isinstance(data, str):  # legacy format - JSON string holding pretty JSON
+        data = _json_decode(data)
+    return data
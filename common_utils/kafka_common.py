@@ -1,8 +1,13 @@
 import os
 
+# messages transport - 'kafka' or 'memory' (in-process broker, all services run in one process. see local_pipeline.py)
+TRANSPORT_KAFKA = "kafka"
+TRANSPORT_MEMORY = "memory"
+TRANSPORT = os.getenv('PIPELINE_TRANSPORT', TRANSPORT_KAFKA).lower()
+
 # Kafka broker (Change 'your-ec2-public-ip' to your actual EC2 public IP or hostname)
 KAFKA_BROKER_HOST = os.getenv('KAFKA_BROKER_HOST')
-if not KAFKA_BROKER_HOST:
+if not KAFKA_BROKER_HOST and TRANSPORT == TRANSPORT_KAFKA:
     raise ValueError("KAFKA_BROKER found!")
 KAFKA_BROKER_PORT = os.getenv('KAFKA_BROKER_PORT')
 
@@ -13,3 +18,56 @@ KAFKA_BROKER = f"{KAFKA_BROKER_HOST}:{KAFKA_BROKER_PORT}"
 USER_REQUESTS_TOPIC_NAME = "user-requests-queue-v1"
 TRANSFORMER_TOPIC_NAME = "intermediate_queue_v1"
 RESULTS_TOPIC_NAME = "results_queue_v1"
+
+# failed messages are retried through delay topics (one per delay tier), and moved to a dead-letter topic
+# after KAFKA_MAX_RETRIES attempts. set KAFKA_MAX_RETRIES=0 to disable retries
+RETRY_DELAYS_SEC = [int(delay) for delay in os.getenv('KAFKA_RETRY_DELAYS_SEC', '10,60,300').split(',') if delay.strip()]
+MAX_RETRIES = int(os.getenv('KAFKA_MAX_RETRIES', str(len(RETRY_DELAYS_SEC))))
+
+
+def get_retry_topic_name(topic_name, tier):
+    return f"{topic_name}.retry.{tier}"
+
+
+def get_retry_topic_names(topic_name):
+    return [get_retry_topic_name(topic_name, tier) for tier in range(len(RETRY_DELAYS_SEC))]
+
+
+def get_dead_letter_topic_name(topic_name):
+    return f"{topic_name}.dlq"
+
+
+PIPELINE_TOPICS = [USER_REQUESTS_TOPIC_NAME, TRANSFORMER_TOPIC_NAME, RESULTS_TOPIC_NAME]
+RETRY_TOPICS = [name for topic in PIPELINE_TOPICS for name in get_retry_topic_names(topic) + [get_dead_letter_topic_name(topic)]]
+
+# number of partitions per topic - this is the max number of instances per service that can consume in parallel
+TOPIC_PARTITIONS = int(os.getenv('KAFKA_TOPIC_PARTITIONS', '6'))
+TOPIC_REPLICATION_FACTOR = int(os.getenv('KAFKA_TOPIC_REPLICATION_FACTOR', '1'))
+
+
+def ensure_topics(topic_names=PIPELINE_TOPICS + RETRY_TOPICS, num_partitions=TOPIC_PARTITIONS):
+    """ create missing topics and add partitions to existing topics that have less than 'num_partitions' """
+    if TRANSPORT == TRANSPORT_MEMORY:
+        return  # in-process broker creates topics on first use
+    from kafka.admin import KafkaAdminClient, NewTopic, NewPartitions
+    from common_utils.local_logger import logger
+
+    admin = KafkaAdminClient(bootstrap_servers=KAFKA_BROKER)
+    try:
+        existing = set(admin.list_topics())
+        new_topics = [NewTopic(name, num_partitions, TOPIC_REPLICATION_FACTOR) for name in topic_names if name not in existing]
+        if new_topics:
+            admin.create_topics(new_topics)
+            logger.info(f"created topics {[topic.name for topic in new_topics]} with {num_partitions} partitions")
+
+        for description in admin.describe_topics([name for name in topic_names if name in existing]):
+            current = len(description["partitions"])
+            if current < num_partitions:
+                admin.create_partitions({description["topic"]: NewPartitions(num_partitions)})
+                logger.info(f"topic {description['topic']} partitions increased from {current} to {num_partitions}")
+    finally:
+        admin.close()
+
+
+if __name__ == "__main__":
+    ensure_topics()
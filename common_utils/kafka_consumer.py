@@ -1,36 +1,306 @@
-
-from kafka import KafkaConsumer
-import json
+from kafka import ConsumerRebalanceListener
+from kafka.errors import CommitFailedError, KafkaError
 import os
 import signal
+import socket
 import sys
+import threading
+import time
 from common_utils.local_logger import logger
 import common_utils.kafka_common as kfk
+from common_utils import kafka_codec
+from common_utils.kafka_workers import OffsetTracker, KeyedWorkerPool, BatchMessagesFailed, CONSUMER_MAX_PENDING
+from common_utils import cache_metrics
+from common_utils import kafka_retry
+from common_utils import tracing
 
-KAFKA_BROKER_HOST = os.getenv('KAFKA_BROKER_HOST')
-if not KAFKA_BROKER_HOST:
-    raise ValueError("KAFKA_BROKER found!")
-KAFKA_BROKER_PORT = os.getenv('KAFKA_BROKER_PORT')
+if kfk.TRANSPORT == kfk.TRANSPORT_MEMORY:
+    from common_utils.memory_broker import MemoryConsumer as KafkaConsumer
+else:
+    from kafka import KafkaConsumer
 
-KAFKA_BROKER = f"{KAFKA_BROKER_HOST}:{KAFKA_BROKER_PORT}"
+KAFKA_BROKER = kfk.KAFKA_BROKER
 
 #default_offset = 'earliest'
-default_offset = 'latest'
+default_offset = os.getenv('KAFKA_AUTO_OFFSET_RESET', 'latest')
+
+# consumer group - all instances of a service share the same group, so topic partitions are split between them.
+# when not set, each service uses its own default group (passed by service main)
+CONSUMER_GROUP_ID = os.getenv('KAFKA_CONSUMER_GROUP')
+# identifies this instance in broker & logs (i.e. when running several instances of the same service)
+SERVICE_INSTANCE_ID = os.getenv('SERVICE_INSTANCE_ID', f"{socket.gethostname()}-{os.getpid()}")
+
+# number of worker threads handling messages. 0 means messages are handled one by one in the polling thread
+CONSUMER_WORKERS = int(os.getenv('KAFKA_CONSUMER_WORKERS', '0'))
+# max messages waiting per worker. polling is blocked when a worker queue is full
+CONSUMER_QUEUE_SIZE = int(os.getenv('KAFKA_CONSUMER_QUEUE_SIZE', '10'))
+CONSUMER_POLL_TIMEOUT_MS = int(os.getenv('KAFKA_CONSUMER_POLL_TIMEOUT_MS', '1000'))
+# max messages passed together to a batch handler. 0 means services use the single message handlers
+CONSUMER_BATCH_MAX_RECORDS = int(os.getenv('KAFKA_CONSUMER_BATCH_MAX_RECORDS', '0'))
+
+# message fields used as ordering key of workers. the kafka key (i.e. route corridor) is used only when message has
+# none of them - it picks the partition, and a busy corridor must still be handled by several workers
+ordering_key_fields = ['route_id', 'user_id']
+
+
+def get_message_key(message):
+    """ messages with the same key are processed in order (by the same worker) """
+    data = message.value
+    if isinstance(data, dict):
+        for field in ordering_key_fields:
+            if data.get(field) is not None:
+                return data[field]
+    if message.key is not None:
+        return message.key
+    return message.partition
+
+
+class PartitionsAssignmentListener(ConsumerRebalanceListener):
+    """ logs partitions assigned to this instance and commits processed offsets before partitions move to another instance """
+    def __init__(self, consumer, tracker, group_id):
+        self.consumer = consumer
+        self.tracker = tracker
+        self.group_id = group_id
+
+    def on_partitions_revoked(self, revoked):
+        commit_processed(self.consumer, self.tracker)
+        if revoked:
+            logger.info(f"group {self.group_id} instance {SERVICE_INSTANCE_ID} revoked partitions {sorted(tp.partition for tp in revoked)}")
+
+    def on_partitions_assigned(self, assigned):
+        logger.info(f"group {self.group_id} instance {SERVICE_INSTANCE_ID} assigned partitions {sorted(tp.partition for tp in assigned)}")
 
-def poll_and_process_messages(topic_name, data_handler_func):
-    # Create Kafka Consumer
+
+def report_topic_partitions(consumer, topic_name):
+    """ startup check - log how many partitions topic has (this is the max number of instances that can share the work) """
+    partitions = consumer.partitions_for_topic(topic_name)
+    if not partitions:
+        logger.warning(f"topic {topic_name} not found or has no partitions yet")
+        return 0
+    logger.info(f"topic {topic_name} has {len(partitions)} partitions")
+    if len(partitions) < kfk.TOPIC_PARTITIONS:
+        logger.warning(f"topic {topic_name} has less partitions than configured {kfk.TOPIC_PARTITIONS}. "
+                       "run 'python -m common_utils.kafka_common' to add partitions")
+    return len(partitions)
+
+
+def create_consumer(topic_name, tracker, group_id=None):
+    # Create Kafka Consumer. offsets are committed manually, only after message was processed
+    group_id = CONSUMER_GROUP_ID or group_id or "json-consumer-group"
     consumer = KafkaConsumer(
-        topic_name,
         bootstrap_servers=KAFKA_BROKER,
-        value_deserializer=lambda x: json.loads(x.decode("utf-8")),
+        value_deserializer=kafka_codec.decode,  # handles all codecs, including legacy double-encoded json
         auto_offset_reset=default_offset,
-        enable_auto_commit=True,
-        group_id="json-consumer-group"
+        enable_auto_commit=False,
+        group_id=group_id,
+        client_id=SERVICE_INSTANCE_ID
+    )
+    consumer.subscribe([topic_name], listener=PartitionsAssignmentListener(consumer, tracker, group_id))
+    report_topic_partitions(consumer, topic_name)
+    return consumer
+
+
+def commit_processed(consumer, tracker):
+    """ commit offsets of messages that were fully processed """
+    assigned = consumer.assignment()
+    tracker.drop_partitions([tp for tp in tracker.tracked_partitions() if tp not in assigned])
+    offsets = tracker.pop_committable()
+    if not offsets:
+        return
+    try:
+        consumer.commit(offsets=offsets)
+    except (CommitFailedError, KafkaError) as e:
+        logger.error(f"failed to commit offsets {offsets}: {e}")
+
+
+def handle_failed_message(tracker, tp, message, exc):
+    """ forward failed message to retry/dead-letter topic. its offset is marked done once forwarded
+        (or once it was logged and dropped, if it can't be forwarded)
+    """
+    kafka_retry.forward_or_drop(message, exc, lambda: tracker.done(tp, message.offset))
+
+
+def process_message(data_handler_func, tracker, tp, message, as_batch=False):
+    """ run handler on a single message and mark its offset as done if handler succeeded.
+        'as_batch' - handler expects a list of messages
+    """
+    cache_metrics.set_current_partition(tp.partition)
+    tracing.mark(message.value, f"dequeue:{tp.topic}")
+    try:
+        if as_batch:
+            data_handler_func([message.value])
+        else:
+            data_handler_func(message.value)
+    except Exception as e:
+        logger.exception(f"handler failed on {tp.topic}:{tp.partition} offset {message.offset}: {e}")
+        handle_failed_message(tracker, tp, message, e)
+        return False
+    tracker.done(tp, message.offset)
+    return True
+
+
+def poll_and_retry_messages(topic_name, data_handler_func, group_id, stop_event, as_batch=False):
+    """ consume the retry (delay) topics of 'topic_name' and re-run the handler once each message delay expired.
+        a partition whose next message is not due yet is paused, so other retry partitions keep moving
+    """
+    retry_topics = kfk.get_retry_topic_names(topic_name)
+    group_id = f"{CONSUMER_GROUP_ID or group_id or 'json-consumer-group'}-retry"
+    tracker = OffsetTracker()
+    consumer = KafkaConsumer(
+        bootstrap_servers=KAFKA_BROKER,
+        value_deserializer=kafka_codec.decode,
+        auto_offset_reset='earliest',  # never skip messages waiting for retry
+        enable_auto_commit=False,
+        group_id=group_id,
+        client_id=f"{SERVICE_INSTANCE_ID}-retry"
     )
+    consumer.subscribe(retry_topics, listener=PartitionsAssignmentListener(consumer, tracker, group_id))
+    paused = dict()  # TopicPartition -> time it can be resumed
+    logger.info(f"Listening on retry topics {retry_topics}...")
+
+    try:
+        while not stop_event.is_set():
+            now = time.time()
+            assigned = consumer.assignment()
+            due = [tp for tp, resume_time in paused.items() if resume_time <= now or tp not in assigned]
+            for tp in due:
+                del paused[tp]
+            due = [tp for tp in due if tp in assigned]
+            if due:
+                consumer.resume(*due)
+
+            records = consumer.poll(timeout_ms=CONSUMER_POLL_TIMEOUT_MS)
+            for tp, messages in records.items():
+                for message in messages:
+                    not_before = kafka_retry.get_not_before(message)
+                    if not_before > time.time():
+                        # not due yet - wait on this partition, and read this message again when resumed
+                        consumer.pause(tp)
+                        consumer.seek(tp, message.offset)
+                        paused[tp] = not_before
+                        break
+                    tracker.add(tp, message.offset)
+                    logger.info(f"retrying message from {tp.topic} (attempt {kafka_retry.get_attempt(message)})")
+                    process_message(data_handler_func, tracker, tp, message, as_batch)
+            commit_processed(consumer, tracker)
+    finally:
+        commit_processed(consumer, tracker)
+        consumer.close()
+
+
+def start_retry_consumer(topic_name, data_handler_func, group_id, as_batch=False):
+    """ run retry consumer in a background thread. returns stop event and thread (None if retries are disabled) """
+    if kfk.MAX_RETRIES <= 0 or not kfk.RETRY_DELAYS_SEC:
+        return None, None
+    stop_event = threading.Event()
+    thread = threading.Thread(target=poll_and_retry_messages, name=f"retry-{topic_name}",
+                              args=(topic_name, data_handler_func, group_id, stop_event, as_batch), daemon=True)
+    thread.start()
+    return stop_event, thread
+
+
+def stop_retry_consumer(stop_event, thread):
+    if stop_event:
+        stop_event.set()
+        thread.join()
+
+
+def poll_and_process_messages(topic_name, data_handler_func, num_workers=None, group_id=None, stop_event=None):
+    """ consume messages from topic and call 'data_handler_func' with each message data.
+        with 'num_workers' > 0 messages are dispatched to a worker pool, keeping per key (route/user) order
+        runs until interrupted or 'stop_event' (threading.Event) is set
+    """
+    stop_event = stop_event or threading.Event()
+    if num_workers is None:
+        num_workers = CONSUMER_WORKERS
+
+    tracker = OffsetTracker()
+    consumer = create_consumer(topic_name, tracker, group_id)
+    retry_stop_event, retry_thread = start_retry_consumer(topic_name, data_handler_func, group_id)
+    pool = None
+    if num_workers > 0:
+        pool = KeyedWorkerPool(num_workers, CONSUMER_QUEUE_SIZE,
+                               lambda item: process_message(data_handler_func, tracker, *item))
 
     logger.info(f"Listening on topic {topic_name} for messages...")
 
-    for message in consumer:
-        #print(f"Received: {message.value}")
-        data = json.loads(message.value)
-        data_handler_func(data)
+    try:
+        while not stop_event.is_set():
+            records = consumer.poll(timeout_ms=CONSUMER_POLL_TIMEOUT_MS)
+            for tp, messages in records.items():
+                for message in messages:
+                    #print(f"Received: {message.value}")
+                    tracker.add(tp, message.offset)
+                    if pool:
+                        pool.submit(get_message_key(message), (tp, message))
+                    else:
+                        process_message(data_handler_func, tracker, tp, message)
+            commit_processed(consumer, tracker)
+            cache_metrics.report_cache_stats()
+    except KeyboardInterrupt:
+        logger.info(f"stopped listening on topic {topic_name}")
+    finally:
+        if pool:
+            pool.shutdown()  # let workers finish queued messages before final commit
+        stop_retry_consumer(retry_stop_event, retry_thread)
+        commit_processed(consumer, tracker)
+        cache_metrics.report_cache_stats(force=True)
+        consumer.close()
+
+
+def poll_and_process_batches(topic_name, batch_handler_func, max_records=None, timeout_ms=CONSUMER_POLL_TIMEOUT_MS, group_id=None, stop_event=None):
+    """ consume messages from topic in micro-batches - 'batch_handler_func' is called with a list of
+        up to 'max_records' messages data. offsets of a batch are committed after the handler completed.
+        a handler raising BatchMessagesFailed has handled the batch - only the failed messages are retried.
+        any other exception retries the whole batch (message by message)
+    """
+    stop_event = stop_event or threading.Event()
+    if not max_records:
+        max_records = CONSUMER_BATCH_MAX_RECORDS or 50
+
+    tracker = OffsetTracker(max(CONSUMER_MAX_PENDING, max_records))  # a whole batch is tracked before it is handled
+    consumer = create_consumer(topic_name, tracker, group_id)
+    # failed batches are retried message by message
+    retry_stop_event, retry_thread = start_retry_consumer(topic_name, batch_handler_func, group_id, as_batch=True)
+
+    logger.info(f"Listening on topic {topic_name} for batches of up to {max_records} messages...")
+
+    try:
+        while not stop_event.is_set():
+            records = consumer.poll(timeout_ms=timeout_ms, max_records=max_records)
+            batch = [(tp, message) for tp, messages in records.items() for message in messages]
+            if not batch:
+                continue
+            for tp, message in batch:
+                tracker.add(tp, message.offset)
+                tracing.mark(message.value, f"dequeue:{tp.topic}")
+            partitions = {tp.partition for tp in records}
+            cache_metrics.set_current_partition(partitions.pop() if len(partitions) == 1 else None)
+            try:
+                batch_handler_func([message.value for _, message in batch])
+            except BatchMessagesFailed as e:
+                logger.error(f"batch handler failed on {len(e.failures)} of {len(batch)} messages from {topic_name}")
+                for idx, (tp, message) in enumerate(batch):
+                    if idx in e.failures:
+                        handle_failed_message(tracker, tp, message, e.failures[idx])
+                    else:
+                        tracker.done(tp, message.offset)
+                commit_processed(consumer, tracker)
+                continue
+            except Exception as e:
+                logger.exception(f"batch handler failed on {len(batch)} messages from {topic_name}: {e}")
+                for tp, message in batch:
+                    handle_failed_message(tracker, tp, message, e)
+                commit_processed(consumer, tracker)
+                continue
+            for tp, message in batch:
+                tracker.done(tp, message.offset)
+            commit_processed(consumer, tracker)
+            cache_metrics.report_cache_stats()
+    except KeyboardInterrupt:
+        logger.info(f"stopped listening on topic {topic_name}")
+    finally:
+        stop_retry_consumer(retry_stop_event, retry_thread)
+        commit_processed(consumer, tracker)
+        cache_metrics.report_cache_stats(force=True)
+        consumer.close()
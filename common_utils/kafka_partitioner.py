@@ -0,0 +1,46 @@
+"""
+Pluggable partitioners for the kafka producer (selected with KAFKA_PARTITIONER env variable)
+
+default  - kafka-python default (murmur2 hash of key modulo number of partitions)
+corridor - jump consistent hash of key. when partitions are added only ~1/N of the keys (corridors)
+           move to another partition, so service instances keep their caches hot while scaling out
+"""
+import os
+import random
+import zlib
+from kafka.partitioner.default import DefaultPartitioner
+from common_utils.local_logger import logger
+
+
+def jump_consistent_hash(key, num_buckets):
+    """ Lamping & Veach jump consistent hash - maps 64 bit key to bucket in range [0, num_buckets) """
+    b, j = -1, 0
+    while j < num_buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
+
+
+class CorridorPartitioner:
+    """ maps corridor keys to partitions with consistent hashing. keyless messages go to a random available partition """
+    def __call__(self, key, all_partitions, available):
+        if key is None:
+            return random.choice(available) if available else random.choice(all_partitions)
+        partitions = sorted(all_partitions)
+        idx = jump_consistent_hash(zlib.crc32(key), len(partitions))
+        return partitions[idx]
+
+
+partitioners = {
+    "default": DefaultPartitioner,
+    "corridor": CorridorPartitioner,
+}
+
+
+def get_partitioner(name=None):
+    name = (name or os.getenv('KAFKA_PARTITIONER', 'default')).lower()
+    if name not in partitioners:
+        logger.error(f"unknown KAFKA_PARTITIONER {name}. using default")
+        name = "default"
+    return partitioners[name]()
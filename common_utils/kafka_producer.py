@@ -1,33 +1,234 @@
-from kafka import KafkaProducer
-import json
+from kafka.errors import KafkaTimeoutError
+import atexit
 import os
+import threading
+import time
 from common_utils.local_logger import logger
 from common_utils import kafka_common
+from common_utils import kafka_codec
+from common_utils.kafka_partitioner import get_partitioner
+from common_utils import tracing
+from common_utils.utils import compact_coordinates, UserRequestFieldNames
+
+if kafka_common.TRANSPORT == kafka_common.TRANSPORT_MEMORY:
+    from common_utils.memory_broker import MemoryProducer as KafkaProducer
+else:
+    from kafka import KafkaProducer
+
+# Batching settings - messages are grouped for up to 'linger' ms or until a batch is full
+PRODUCER_LINGER_MS = int(os.getenv('KAFKA_PRODUCER_LINGER_MS', '20'))
+PRODUCER_BATCH_SIZE = int(os.getenv('KAFKA_PRODUCER_BATCH_SIZE', str(64 * 1024)))  # bytes per partition batch
+# max messages sent but not yet acknowledged by broker. senders block (backpressure) when reached
+PRODUCER_MAX_IN_FLIGHT = int(os.getenv('KAFKA_PRODUCER_MAX_IN_FLIGHT', '1000'))
+PRODUCER_BLOCK_TIMEOUT_SEC = float(os.getenv('KAFKA_PRODUCER_BLOCK_TIMEOUT_SEC', '30'))
+PRODUCER_FLUSH_TIMEOUT_SEC = float(os.getenv('KAFKA_PRODUCER_FLUSH_TIMEOUT_SEC', '10'))
+# set to '1' to restore the old behavior of flushing after every message
+flush_each_message = os.getenv('KAFKA_PRODUCER_FLUSH_EACH', '0') == '1'
+# batch compression: none, gzip, snappy, lz4 or zstd (lz4/snappy/zstd need 'pip install lz4 / python-snappy / zstandard').
+# consumers decompress automatically
+PRODUCER_COMPRESSION_TYPE = os.getenv('KAFKA_COMPRESSION_TYPE', 'none').lower()
+# set to '0' to send full messages to all topics (see topic_drop_fields)
+slim_payloads = os.getenv('KAFKA_SLIM_PAYLOADS', '1') == '1'
+PAYLOAD_STATS_REPORT_SEC = int(os.getenv('KAFKA_PAYLOAD_STATS_REPORT_SEC', '300'))
+
+
+def get_compression_type(compression_type):
+    """ returns compression type for KafkaProducer, or None if not set or codec library is not installed """
+    if compression_type in ('', 'none'):
+        return None
+    if kafka_common.TRANSPORT == kafka_common.TRANSPORT_MEMORY:
+        return None  # in-process broker keeps messages uncompressed
+    from kafka import codec
+    codec_available = {'gzip': codec.has_gzip, 'snappy': codec.has_snappy, 'lz4': codec.has_lz4, 'zstd': codec.has_zstd}
+    if compression_type not in codec_available:
+        logger.error(f"unknown Kafka compression type '{compression_type}' - messages are sent uncompressed")
+        return None
+    if not codec_available[compression_type]():
+        logger.error(f"Kafka compression '{compression_type}' library is not installed - messages are sent uncompressed")
+        return None
+    return compression_type
+
 
 # Create Kafka Producer
 try:
     producer = KafkaProducer(
         bootstrap_servers=kafka_common.KAFKA_BROKER,
-        value_serializer=lambda v: json.dumps(v).encode("utf-8")  # Convert JSON to bytes
+        value_serializer=kafka_codec.encode,  # Convert message dict to bytes (compact json / msgpack)
+        key_serializer=lambda k: k if isinstance(k, bytes) else str(k).encode("utf-8"),
+        partitioner=get_partitioner(),
+        linger_ms=PRODUCER_LINGER_MS,
+        batch_size=PRODUCER_BATCH_SIZE,
+        max_block_ms=int(PRODUCER_BLOCK_TIMEOUT_SEC * 1000),
+        compression_type=get_compression_type(PRODUCER_COMPRESSION_TYPE)
     )
 except:
     producer = None
     logger.error("ERROR!!! Kafka Broker NOT Available")
 
+# bounds the number of un-acknowledged messages
+in_flight_slots = threading.BoundedSemaphore(PRODUCER_MAX_IN_FLIGHT)
 
-def send_request_to_queue(json_data, topic_name):
-    if producer:
-        # Send message to Kafka topic
-        producer.send(topic_name, json_data)
-        producer.flush()  # Ensure all messages are sent
-        logger.info(f"Message sent successfully to topic {topic_name}")
-        return True
-    else:
+
+def _release_slot(topic_name, callback):
+    """ create broker ack/error handlers that free the in-flight slot and notify the caller """
+    def on_success(record_metadata):
+        in_flight_slots.release()
+        record_payload_size(record_metadata.topic, record_metadata.serialized_value_size)
+        logger.debug(f"Message delivered to {record_metadata.topic}:{record_metadata.partition} offset {record_metadata.offset}")
+        if callback:
+            callback(record_metadata, None)
+
+    def on_error(exc):
+        in_flight_slots.release()
+        logger.error(f"Failed to deliver message to topic {topic_name}: {exc}")
+        if callback:
+            callback(None, exc)
+
+    return on_success, on_error
+
+
+# message fields used as default message key. messages with same key go to the same partition (and keep their order)
+message_key_fields = ['route_id', 'user_id']
+
+
+def get_message_key(json_data):
+    """ default message key - route id spreads load evenly between partitions (and service instances) """
+    if isinstance(json_data, dict):
+        for field in message_key_fields:
+            if json_data.get(field) is not None:
+                return json_data[field]
+    return None  # no key - producer spreads messages between partitions by itself
+
+
+# fields not used by the consuming service (and the ones after it). waypoints are only needed by api-service
+topic_drop_fields = {
+    kafka_common.TRANSFORMER_TOPIC_NAME: [UserRequestFieldNames.WAYPOINTS.value],
+    kafka_common.RESULTS_TOPIC_NAME: [UserRequestFieldNames.WAYPOINTS.value],
+}
+
+
+def slim_payload(json_data, topic_name):
+    """ returns a copy of message without the fields consumers of 'topic_name' don't need, and with places
+        coordinates as int micro-degrees (caller's dict and places are not changed)
+    """
+    if not slim_payloads or not isinstance(json_data, dict):
+        return json_data
+    drop_fields = topic_drop_fields.get(topic_name, [])
+    slim_data = {field: value for field, value in json_data.items() if field not in drop_fields}
+    if slim_data.get('places'):
+        slim_data['places'] = [compact_coordinates(place) if isinstance(place, dict) else place for place in slim_data['places']]
+    return slim_data
+
+
+# serialized message size histogram per topic (power of 2 buckets)
+payload_stats_lock = threading.Lock()
+payload_sizes = dict()  # topic -> {'count', 'total', 'max', 'buckets': {upper bound bytes: count}}
+last_payload_report_time = time.monotonic()
+
+
+def record_payload_size(topic_name, size):
+    if size is None or size < 0:
+        return
+    bucket = 1 << max(8, (size - 1).bit_length())  # smallest bucket is 256 bytes
+    with payload_stats_lock:
+        stats = payload_sizes.setdefault(topic_name, {'count': 0, 'total': 0, 'max': 0, 'buckets': dict()})
+        stats['count'] += 1
+        stats['total'] += size
+        stats['max'] = max(stats['max'], size)
+        stats['buckets'][bucket] = stats['buckets'].get(bucket, 0) + 1
+
+
+def format_size(size):
+    return f"{size // 1024}KB" if size >= 1024 else f"{size}B"
+
+
+def report_payload_sizes(force=False):
+    """ log message size histogram per topic. logs at most once every PAYLOAD_STATS_REPORT_SEC unless forced """
+    global last_payload_report_time
+    now = time.monotonic()
+    if not force and now - last_payload_report_time < PAYLOAD_STATS_REPORT_SEC:
+        return
+    last_payload_report_time = now
+    with payload_stats_lock:
+        snapshot = {topic: dict(stats, buckets=dict(stats['buckets'])) for topic, stats in payload_sizes.items()}
+    for topic_name, stats in sorted(snapshot.items()):
+        histogram = ' '.join(f"<={format_size(bucket)}:{count}" for bucket, count in sorted(stats['buckets'].items()))
+        logger.info(f"payload sizes {topic_name}: messages={stats['count']} avg={stats['total'] // stats['count']}B "
+                    f"max={stats['max']}B {histogram}")
+    if snapshot and producer is not None and hasattr(producer, 'metrics'):
+        compression_rate = producer.metrics().get('producer-metrics', {}).get('compression-rate-avg')
+        if compression_rate is not None:
+            logger.info(f"producer compression ({PRODUCER_COMPRESSION_TYPE}) rate avg: {compression_rate:.2f}")
+
+
+def send_request_async(json_data, topic_name, callback=None, key=None, headers=None):
+    """ send message without waiting for broker acknowledge.
+        returns a future (or None if message couldn't be queued).
+        'callback(record_metadata, exception)' is called once broker acks or fails the message
+        'key' selects the partition. default is taken from message route/user id
+        'headers' - optional list of (name, bytes) kafka headers
+    """
+    if not producer:
         logger.error("Kafka Producer is NOT available")
+        return None
+
+    # backpressure - wait for a free slot if too many messages are still in flight
+    if not in_flight_slots.acquire(timeout=PRODUCER_BLOCK_TIMEOUT_SEC):
+        logger.error(f"Kafka Producer in-flight queue is full ({PRODUCER_MAX_IN_FLIGHT}). message to {topic_name} dropped")
+        return None
+
+    on_success, on_error = _release_slot(topic_name, callback)
+    try:
+        if key is None:
+            key = get_message_key(json_data)
+        payload = tracing.fork(json_data) if isinstance(json_data, dict) else json_data  # caller's trace is not changed
+        tracing.mark(payload, f"enqueue:{topic_name}")
+        future = producer.send(topic_name, slim_payload(payload, topic_name), key=key, headers=headers)
+    except KafkaTimeoutError as e:
+        in_flight_slots.release()
+        logger.error(f"Kafka Producer buffer is full, message to {topic_name} dropped: {e}")
+        return None
+    except Exception as e:  # bad key/payload (serializer) or closed producer - the slot must not leak
+        in_flight_slots.release()
+        logger.error(f"Kafka Producer failed to queue message to {topic_name}, message dropped: {e}")
+        return None
+    future.add_callback(on_success)
+    future.add_errback(on_error)
+    return future
+
+
+def send_request_to_queue(json_data, topic_name, callback=None, key=None, headers=None):
+    future = send_request_async(json_data, topic_name, callback, key, headers)
+    if future is None:
         return False
+    if flush_each_message:
+        producer.flush(timeout=PRODUCER_FLUSH_TIMEOUT_SEC)  # Ensure all messages are sent
+    logger.info(f"Message queued successfully to topic {topic_name}")
+    report_payload_sizes()
+    return True
+
+
+def flush_producer(timeout=PRODUCER_FLUSH_TIMEOUT_SEC):
+    """ block until all queued messages are acknowledged (or timeout) """
+    if producer:
+        try:
+            producer.flush(timeout=timeout)
+        except KafkaTimeoutError as e:
+            logger.error(f"Kafka Producer flush timed out: {e}")
+
+
+def close_producer():
+    """ flush pending messages and close producer. registered to run on process exit """
+    global producer
+    if producer:
+        flush_producer()
+        report_payload_sizes(force=True)
+        producer.close(timeout=PRODUCER_FLUSH_TIMEOUT_SEC)
+        producer = None
+        logger.info("Kafka Producer closed")
+
+atexit.register(close_producer)
 
-# Close producer
-#producer.close()
 
 if __name__ == "__main__":
     # Example JSON message
@@ -42,5 +243,4 @@ if __name__ == "__main__":
         "attractions": "mix"
     }
     send_request_to_queue(message, kafka_common.USER_REQUESTS_TOPIC_NAME)
-    producer.close()
-
+    close_producer()
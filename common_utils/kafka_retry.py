@@ -0,0 +1,116 @@
+"""
+Non-blocking retries for messages whose handler failed.
+
+A failed message is forwarded to a delay topic ('<topic>.retry.<tier>') with headers holding the attempt number,
+the time it may be retried and the error. A retry consumer (see kafka_consumer) re-runs the handler when the
+delay expired. After MAX_RETRIES attempts the message is moved to the dead-letter topic ('<topic>.dlq').
+The failed message offset is marked as processed once it was forwarded, so the main partition keeps moving.
+A message that can't be forwarded (retries disabled, or the forward failed) is logged with its data and
+dropped - a failed offset that is never marked would hold back the partition commit position for good.
+"""
+import time
+import traceback
+from datetime import datetime
+from common_utils.local_logger import logger
+import common_utils.kafka_common as kfk
+from common_utils.kafka_producer import send_request_async
+
+HEADER_ORIGINAL_TOPIC = "x-original-topic"
+HEADER_ORIGINAL_PARTITION = "x-original-partition"
+HEADER_ORIGINAL_OFFSET = "x-original-offset"
+HEADER_ATTEMPT = "x-attempt"
+HEADER_NOT_BEFORE = "x-not-before"  # epoch time (seconds) from which message may be retried
+HEADER_ERROR = "x-error"
+HEADER_ERROR_TRACE = "x-error-trace"
+HEADER_FAILED_AT = "x-failed-at"
+
+MAX_ERROR_TRACE_LEN = 4000
+
+
+def get_header(message, name, default=None):
+    for key, value in (message.headers or []):
+        if key == name:
+            return value.decode("utf-8") if isinstance(value, bytes) else value
+    return default
+
+
+def get_original_topic(message):
+    return get_header(message, HEADER_ORIGINAL_TOPIC, message.topic)
+
+
+def get_attempt(message):
+    return int(get_header(message, HEADER_ATTEMPT, 0))
+
+
+def get_not_before(message):
+    return float(get_header(message, HEADER_NOT_BEFORE, 0))
+
+
+def get_retry_delay(attempt):
+    """ delay before retry number 'attempt' (1 based). attempts beyond configured tiers use the last delay """
+    tier = min(attempt, len(kfk.RETRY_DELAYS_SEC)) - 1
+    return tier, kfk.RETRY_DELAYS_SEC[tier]
+
+
+def build_headers(message, original_topic, attempt, exc, not_before=None):
+    headers = {
+        HEADER_ORIGINAL_TOPIC: original_topic,
+        HEADER_ORIGINAL_PARTITION: get_header(message, HEADER_ORIGINAL_PARTITION, message.partition),
+        HEADER_ORIGINAL_OFFSET: get_header(message, HEADER_ORIGINAL_OFFSET, message.offset),
+        HEADER_ATTEMPT: attempt,
+        HEADER_ERROR: f"{type(exc).__name__}: {exc}",
+        HEADER_ERROR_TRACE: ''.join(traceback.format_exception(type(exc), exc, exc.__traceback__))[-MAX_ERROR_TRACE_LEN:],
+        HEADER_FAILED_AT: datetime.now().isoformat(),
+    }
+    if not_before is not None:
+        headers[HEADER_NOT_BEFORE] = not_before
+    return [(name, str(value).encode("utf-8")) for name, value in headers.items()]
+
+
+def forward_failed_message(message, exc, on_forwarded, on_forward_failed=None):
+    """ send failed message to next retry topic (or dead-letter topic when out of attempts).
+        'on_forwarded()' is called once the broker acknowledged the forwarded message,
+        'on_forward_failed(error)' if the broker failed it.
+        returns False if retries are disabled or message couldn't be queued
+    """
+    if kfk.MAX_RETRIES <= 0 or not kfk.RETRY_DELAYS_SEC:
+        return False
+
+    original_topic = get_original_topic(message)
+    attempt = get_attempt(message) + 1
+    if attempt <= kfk.MAX_RETRIES:
+        tier, delay = get_retry_delay(attempt)
+        target_topic = kfk.get_retry_topic_name(original_topic, tier)
+        headers = build_headers(message, original_topic, attempt, exc, time.time() + delay)
+        logger.warning(f"message from {original_topic} failed (attempt {attempt}/{kfk.MAX_RETRIES}), retry in {delay}s via {target_topic}")
+    else:
+        target_topic = kfk.get_dead_letter_topic_name(original_topic)
+        headers = build_headers(message, original_topic, attempt - 1, exc)
+        logger.error(f"message from {original_topic} failed {attempt - 1} times - moved to dead-letter topic {target_topic}")
+
+    def on_delivery(record_metadata, error):
+        if error is None:
+            on_forwarded()
+        elif on_forward_failed:
+            on_forward_failed(error)
+
+    future = send_request_async(message.value, target_topic, on_delivery, message.key, headers)
+    return future is not None
+
+
+def log_dropped_message(message, reason):
+    logger.error(f"message {message.topic}:{message.partition} offset {message.offset} key {message.key} dropped "
+                 f"({reason}): {message.value}")
+
+
+def forward_or_drop(message, exc, mark_done):
+    """ forward failed message for retry and call 'mark_done()' once it was forwarded.
+        if it can't be forwarded it is logged and dropped ('mark_done()' is called as well)
+    """
+    def on_forward_failed(error):
+        log_dropped_message(message, f"forward for retry failed: {error}")
+        mark_done()
+
+    if not forward_failed_message(message, exc, mark_done, on_forward_failed):
+        log_dropped_message(message, f"not forwarded for retry: {type(exc).__name__}: {exc}")
+        mark_done()
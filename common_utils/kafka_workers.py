@@ -0,0 +1,159 @@
+"""
+Helpers for concurrent processing of kafka messages:
+  OffsetTracker   - tracks processed offsets per partition so only completed work is committed
+  KeyedWorkerPool - bounded thread pool that keeps messages with the same key in order
+  handle_each / BatchMessagesFailed - batch handlers report which messages of a batch failed
+"""
+import os
+import queue
+import threading
+import zlib
+from collections import OrderedDict
+from kafka.structs import OffsetAndMetadata
+from common_utils.local_logger import logger
+
+# max offsets tracked by a consumer (in work, or done but behind an offset still in work). polling waits above it
+CONSUMER_MAX_PENDING = int(os.getenv('KAFKA_CONSUMER_MAX_PENDING', '10000'))
+PENDING_WARNING_SEC = 30
+
+
+def make_offset_and_metadata(offset):
+    """ OffsetAndMetadata has an extra 'leader_epoch' field on newer kafka-python versions """
+    if len(OffsetAndMetadata._fields) > 2:
+        return OffsetAndMetadata(offset, "", -1)
+    return OffsetAndMetadata(offset, "")
+
+
+class OffsetTracker:
+    """ Keeps the offsets that were dispatched per partition and marks them when processing succeeds.
+        Commit position of a partition advances only over a contiguous run of completed offsets,
+        so a message that is still in work is re-delivered after a crash/restart.
+        At most 'max_pending' offsets are tracked - add() blocks while the tracker is full (backpressure)
+    """
+    def __init__(self, max_pending=None):
+        self.max_pending = max_pending or CONSUMER_MAX_PENDING
+        self.lock = threading.Lock()
+        self.room = threading.Condition(self.lock)  # notified when tracked offsets are released
+        self.partitions = dict()  # TopicPartition -> OrderedDict(offset -> completed), from first not completed offset
+        self.commit_positions = dict()  # TopicPartition -> next offset to read (not committed yet)
+        self.pending = 0
+
+    def has_room(self):
+        with self.lock:
+            return self.pending < self.max_pending
+
+    def add(self, tp, offset):
+        """ track offset of a dispatched message. waits while 'max_pending' offsets are tracked """
+        with self.room:
+            while not self.room.wait_for(lambda: self.pending < self.max_pending, PENDING_WARNING_SEC):
+                logger.warning(f"{self.pending} offsets pending, waiting for messages in work - oldest {self.oldest_pending()}")
+            self.partitions.setdefault(tp, OrderedDict())[offset] = False
+            self.pending += 1
+
+    def done(self, tp, offset):
+        with self.room:
+            offsets = self.partitions.get(tp)
+            if offsets is None or offset not in offsets:
+                return
+            offsets[offset] = True
+            released = 0
+            while offsets:  # move commit position over completed offsets at the head
+                head, completed = next(iter(offsets.items()))
+                if not completed:
+                    break
+                offsets.popitem(last=False)
+                self.commit_positions[tp] = head + 1  # commit = next offset to read
+                released += 1
+            if released:
+                self.pending -= released
+                self.room.notify_all()
+
+    def oldest_pending(self):
+        """ {tp: first offset not completed} - caller holds the lock """
+        return {tp: next(iter(offsets)) for tp, offsets in self.partitions.items() if offsets}
+
+    def pending_count(self):
+        with self.lock:
+            return self.pending
+
+    def tracked_partitions(self):
+        with self.lock:
+            return set(self.partitions) | set(self.commit_positions)
+
+    def drop_partitions(self, tps):
+        """ forget partitions that are no longer assigned to this consumer """
+        with self.room:
+            for tp in tps:
+                self.pending -= len(self.partitions.pop(tp, ()))
+                self.commit_positions.pop(tp, None)
+            self.room.notify_all()
+
+    def pop_committable(self):
+        """ returns {tp: OffsetAndMetadata} for partitions whose commit position moved forward """
+        with self.lock:
+            result = {tp: make_offset_and_metadata(position) for tp, position in self.commit_positions.items()}
+            self.commit_positions.clear()
+        return result
+
+
+class KeyedWorkerPool:
+    """ Fixed number of worker threads, each with its own bounded queue.
+        Items are routed to a worker by hash of their key, so items of the same key are handled in order.
+        submit() blocks when the worker queue is full, which throttles the kafka poll loop (backpressure)
+    """
+    def __init__(self, num_workers, queue_size, work_func, name="kafka-worker"):
+        self.work_func = work_func
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(num_workers)]
+        self.threads = []
+        for idx in range(num_workers):
+            thread = threading.Thread(target=self._worker_loop, args=(idx,), name=f"{name}-{idx}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        logger.info(f"started {num_workers} workers with queue size {queue_size}")
+
+    def _worker_loop(self, idx):
+        work_queue = self.queues[idx]
+        while True:
+            item = work_queue.get()
+            if item is None:  # shutdown signal
+                break
+            try:
+                self.work_func(item)
+            except Exception as e:
+                logger.exception(f"worker {idx} failed: {e}")
+
+    def submit(self, key, item):
+        idx = zlib.crc32(str(key).encode("utf-8")) % len(self.queues)
+        self.queues[idx].put(item)
+
+    def shutdown(self, wait=True):
+        for work_queue in self.queues:
+            work_queue.put(None)
+        if wait:
+            for thread in self.threads:
+                thread.join()
+
+
+class BatchMessagesFailed(Exception):
+    """ raised by a batch handler after the rest of the batch was handled.
+        only the messages in 'failures' ({index in batch: exception}) are sent for retry
+    """
+    def __init__(self, failures):
+        self.failures = failures
+        super().__init__(f"{len(failures)} messages of batch failed: {list(failures.values())[:3]}")
+
+
+def handle_each(json_messages, handler):
+    """ call handler(json_message) for each message of a batch - a failing message doesn't stop the rest.
+        returns (handler results, {index: exception} of failed messages)
+    """
+    results = []
+    failures = dict()
+    for idx, json_message in enumerate(json_messages):
+        try:
+            results.append(handler(json_message))
+        except Exception as e:
+            logger.exception(f"handler failed on message {idx} of batch: {e}")
+            failures[idx] = e
+            results.append(False)
+    return results, failures
@@ -1,54 +1,144 @@
 import os
+import time
 import psycopg2
 from datetime import datetime, timedelta
+from common_utils.local_logger import logger
+from common_utils import db_utils
+
+# Environment variables (set these in AWS Lambda): DB_HOST, DB_NAME, DB_USER, DB_PASSWORD, DB_PORT (or RDS_DB_* as
+# in the services). the connection pool lives in the module, so warm Lambda invocations reuse the DB connection.
+# set RDS_DB_POOL_MAX = "1" - a Lambda instance handles one event at a time
+RETENTION_DAYS = int(os.getenv("CLEANER_RETENTION_DAYS", "5"))
+DELETE_CHUNK_SIZE = int(os.getenv("CLEANER_DELETE_CHUNK_SIZE", "5000"))        # rows per DELETE (and commit)
+DELETE_CHUNK_PAUSE_SEC = float(os.getenv("CLEANER_DELETE_CHUNK_PAUSE_SEC", "0.1"))  # let service queries run between chunks
+PARTITIONS_AHEAD_WEEKS = int(os.getenv("CLEANER_PARTITIONS_AHEAD_WEEKS", "2"))
+
+# results tables. partitioned ones (see DB/partition_attractions.sql) get old partitions dropped, others chunked deletes.
+# restaurants_res/gas_stations_res keep a unique place_id (needed by upserts), which a partitioned table can't have
+db_tables = ["restaurants_res", "gas_stations_res", "attractions_res"]
+
+
+def is_partitioned(table):
+    cur = db_utils.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = %s::regclass", (table,))
+    return cur.fetchone() is not None
+
+
+def week_start(day):
+    """ partitions are weekly, starting on monday """
+    return datetime(day.year, day.month, day.day) - timedelta(days=day.weekday())
+
+
+def partition_name(table, start):
+    return f"{table}_p{start:%Y%m%d}"
+
+
+def get_stored_columns(table):
+    """ columns that can be inserted - generated columns (i.e. lat_e6) are computed by postgres """
+    cur = db_utils.execute("SELECT attname FROM pg_attribute WHERE attrelid = %s::regclass AND attnum > 0 "
+                           "AND NOT attisdropped AND attgenerated = '' ORDER BY attnum", (table,))
+    return [record["attname"] for record in cur.fetchall()]
+
+
+def create_partition(table, start, end):
+    """ create weekly partition. rows of that week already in the default partition are moved into it first """
+    name = partition_name(table, start)
+    if db_utils.execute("SELECT to_regclass(%s) AS oid", (name,)).fetchone()["oid"] is not None:
+        return
+    db_utils.execute(f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED)")
+    columns = ', '.join(get_stored_columns(table))
+    db_utils.execute(f"WITH moved AS (DELETE FROM {table}_default WHERE created_at >= %s AND created_at < %s RETURNING *) "
+                     f"INSERT INTO {name} ({columns}) SELECT {columns} FROM moved", (start, end))
+    db_utils.execute(f"ALTER TABLE {table} ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (start, end), commit=True)
+    logger.info(f"created partition {name}")
+
+
+def create_partitions(table, now):
+    """ make sure current and next weeks have their partition (so new rows don't go to the default partition) """
+    start = week_start(now)
+    for _ in range(PARTITIONS_AHEAD_WEEKS + 1):
+        end = start + timedelta(days=7)
+        try:
+            create_partition(table, start, end)
+        except psycopg2.Error as e:
+            logger.error(f"failed to create partition {partition_name(table, start)}: {e}")  # rows stay in default partition
+        start = end
+
+
+def drop_old_partitions(table, cutoff):
+    """ detach and drop weekly partitions that end before cutoff. returns number of dropped rows """
+    cur = db_utils.execute("""
+        SELECT child.relname AS name FROM pg_inherits
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE pg_inherits.inhparent = %s::regclass AND child.relname LIKE %s""", (table, f"{table}_p%"))
+    deleted_rows = 0
+    for record in cur.fetchall():
+        name = record["name"]
+        try:
+            start = datetime.strptime(name[len(table) + 2:], "%Y%m%d")
+        except ValueError:
+            continue  # not a weekly partition
+        if start + timedelta(days=7) > cutoff:
+            continue
+        deleted_rows += db_utils.execute(f"SELECT count(*) AS rows FROM {name}").fetchone()["rows"]
+        db_utils.execute(f"ALTER TABLE {table} DETACH PARTITION {name}", commit=True)
+        db_utils.execute(f"DROP TABLE {name}", commit=True)
+        logger.info(f"dropped partition {name}")
+    return deleted_rows
+
+
+def delete_in_chunks(table, cutoff):
+    """ delete old rows DELETE_CHUNK_SIZE at a time, each chunk in its own short transaction. returns number of deleted rows """
+    deleted_rows = 0
+    while True:
+        # (tableoid, ctid) identifies a row also in partitioned tables (ctid alone is per partition)
+        cur = db_utils.execute(f"DELETE FROM {table} WHERE (tableoid, ctid) IN "
+                               f"(SELECT tableoid, ctid FROM {table} WHERE created_at < %s LIMIT %s)",
+                               (cutoff, DELETE_CHUNK_SIZE), commit=True)
+        deleted_rows += cur.rowcount
+        if cur.rowcount < DELETE_CHUNK_SIZE:
+            return deleted_rows
+        time.sleep(DELETE_CHUNK_PAUSE_SEC)
+
+
+def clean_table(table, now):
+    cutoff = now - timedelta(days=RETENTION_DAYS)
+    if is_partitioned(table):
+        create_partitions(table, now)
+        deleted_rows = drop_old_partitions(table, cutoff)
+        deleted_rows += delete_in_chunks(table, cutoff)  # old rows left in partly expired week / default partition
+    else:
+        deleted_rows = delete_in_chunks(table, cutoff)
+    return deleted_rows
 
-# Environment variables (set these in AWS Lambda)
-DB_HOST = os.getenv("DB_HOST")
-DB_NAME = os.getenv("DB_NAME", "")
-DB_USER = os.getenv("DB_USER")
-DB_PASSWORD = os.getenv("DB_PASSWORD")
-DB_PORT = os.getenv("DB_PORT", "5432")  # Default PostgreSQL port
 
 def lambda_handler(event, context):
-    db_tables = ["restaurants_res", "gas_stations_res"]
     text_body = []
-    
+
     try:
-        # Connect to PostgreSQL RDS
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            port=DB_PORT
-        )
-        cur = conn.cursor()
-
-        # Calculate the date 5 days ago
-        five_days_ago = datetime.now() - timedelta(days=5)
-
-        for idx, table in enumerate(db_tables):
-            # Execute DELETE query
-            cur.execute(f"DELETE FROM {table} WHERE created_at < %s;", (five_days_ago,))
-            # Commit changes
-            conn.commit()
-            # Get the number of rows affected
-            deleted_rows = cur.rowcount
-
-            # Log the number of deleted records
-            text_body.append(f"Deleted {deleted_rows} old records from {table}. ")
-
-        # Close connection
-        cur.close()
-        conn.close()
+        # Take connection from the pool (connects to PostgreSQL RDS on first invocation)
+        with db_utils.connection() as cur:
+            if cur is None:
+                raise ConnectionError("PostgreSQL is not available")
+
+            now = datetime.now()
+            for table in db_tables:
+                start_time = time.perf_counter()
+                deleted_rows = clean_table(table, now)
+                elapsed = time.perf_counter() - start_time
+
+                # Log the number of deleted records and time per table
+                text = f"Deleted {deleted_rows} old records from {table} in {elapsed:.2f} sec. "
+                logger.info(text)
+                text_body.append(text)
 
         return {
             "statusCode": 200,
             "body": "\n".join(text_body)
-        }    
+        }
     except Exception as e:
+        logger.error(f"RDS cleaner failed: {e}")
         return {
             "statusCode": 500,
             "body": f"Error: {str(e)}"
         }
-        
\ No newline at end of file
+
@@ -22,7 +22,10 @@ class Logger:
                 current_file_name = os.path.splitext(os.path.basename(module.__file__))[0] if module else "default_log"
 
             log_file = f"logs/{current_file_name}.log"
-            os.makedirs("logs", exist_ok=True)  # Ensure logs directory exists
+            try:
+                os.makedirs("logs", exist_ok=True)  # Ensure logs directory exists
+            except OSError:
+                log_file = None  # read-only file system (i.e. AWS Lambda) - log to stderr
 
             logging.basicConfig(
                 filename=log_file,
@@ -0,0 +1,253 @@
+"""
+In-process stand-in for the kafka broker (selected with PIPELINE_TRANSPORT=memory).
+
+MemoryProducer / MemoryConsumer implement the subset of kafka-python KafkaProducer / KafkaConsumer API used by
+kafka_producer, kafka_consumer and dlq_replay (partitions, keys, headers, consumer groups, manual commits,
+pause/resume/seek, rebalance listeners), so all services can run as threads of a single python process -
+for end-to-end benchmarks on a laptop or as a low overhead single node deployment.
+Messages are serialized on send exactly like with kafka, so codec cost is included in measurements.
+"""
+import itertools
+import threading
+import time
+from collections import namedtuple
+from kafka.structs import TopicPartition
+from common_utils.local_logger import logger
+import common_utils.kafka_common as kfk
+
+ConsumerRecord = namedtuple("ConsumerRecord", ["topic", "partition", "offset", "timestamp", "key", "value", "headers"])
+RecordMetadata = namedtuple("RecordMetadata", ["topic", "partition", "offset", "timestamp", "serialized_value_size"])
+
+
+class MemoryBroker:
+    """ holds topics (list of partitions, each a list of raw records), committed offsets and group members """
+    def __init__(self, num_partitions=kfk.TOPIC_PARTITIONS):
+        self.num_partitions = num_partitions
+        self.condition = threading.Condition()
+        self.topics = dict()     # topic -> [partition records list]
+        self.committed = dict()  # (group_id, TopicPartition) -> next offset to read
+        self.groups = dict()     # group_id -> [MemoryConsumer]
+
+    def get_partitions(self, topic):
+        """ topics are auto-created on first use. caller must hold the condition lock """
+        if topic not in self.topics:
+            self.topics[topic] = [[] for _ in range(self.num_partitions)]
+        return self.topics[topic]
+
+    def append(self, topic, partition, key, value, headers):
+        with self.condition:
+            log = self.get_partitions(topic)[partition]
+            offset = len(log)
+            timestamp = int(time.time() * 1000)
+            log.append(ConsumerRecord(topic, partition, offset, timestamp, key, value, headers or []))
+            self.condition.notify_all()
+        return RecordMetadata(topic, partition, offset, timestamp, len(value) if value is not None else -1)
+
+    def join(self, group_id, consumer):
+        with self.condition:
+            members = self.groups.setdefault(group_id, [])
+            if consumer not in members:
+                members.append(consumer)
+            self.rebalance(group_id)
+
+    def leave(self, group_id, consumer):
+        with self.condition:
+            members = self.groups.get(group_id, [])
+            if consumer in members:
+                members.remove(consumer)
+            self.rebalance(group_id)
+
+    def rebalance(self, group_id):
+        """ spread partitions of subscribed topics between group members (round robin). caller holds lock """
+        members = self.groups.get(group_id, [])
+        assignments = {member: set() for member in members}
+        topics = sorted({topic for member in members for topic in member.topics})
+        for topic in topics:
+            subscribers = [member for member in members if topic in member.topics]
+            for partition in range(len(self.get_partitions(topic))):
+                assignments[subscribers[partition % len(subscribers)]].add(TopicPartition(topic, partition))
+        for member, assigned in assignments.items():
+            member.pending_assignment = assigned
+        self.condition.notify_all()  # wake polling members so they apply the new assignment
+
+    def end_offset(self, tp):
+        return len(self.get_partitions(tp.topic)[tp.partition])
+
+
+broker = MemoryBroker()
+
+
+class MemoryFuture:
+    """ already completed send result, with kafka-python future callbacks API """
+    def __init__(self, record_metadata=None, exception=None):
+        self.value = record_metadata
+        self.exception = exception
+
+    def add_callback(self, func):
+        if self.exception is None:
+            func(self.value)
+        return self
+
+    def add_errback(self, func):
+        if self.exception is not None:
+            func(self.exception)
+        return self
+
+    def get(self, timeout=None):
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+
+class MemoryProducer:
+    def __init__(self, value_serializer=None, key_serializer=None, partitioner=None, **configs):
+        self.value_serializer = value_serializer
+        self.key_serializer = key_serializer
+        self.partitioner = partitioner
+        self.round_robin = itertools.count()
+
+    def partitions_for(self, topic):
+        with broker.condition:
+            return set(range(len(broker.get_partitions(topic))))
+
+    def send(self, topic, value=None, key=None, headers=None, partition=None):
+        try:
+            key_bytes = self.key_serializer(key) if (key is not None and self.key_serializer) else key
+            value_bytes = self.value_serializer(value) if self.value_serializer else value
+            if partition is None:
+                all_partitions = sorted(self.partitions_for(topic))
+                if key_bytes is not None and self.partitioner:
+                    partition = self.partitioner(key_bytes, all_partitions, all_partitions)
+                else:
+                    partition = all_partitions[next(self.round_robin) % len(all_partitions)]
+            return MemoryFuture(broker.append(topic, partition, key_bytes, value_bytes, headers))
+        except Exception as e:
+            return MemoryFuture(exception=e)
+
+    def flush(self, timeout=None):
+        pass  # messages are stored on send
+
+    def close(self, timeout=None):
+        pass
+
+
+class MemoryConsumer:
+    def __init__(self, *topics, value_deserializer=None, key_deserializer=None, auto_offset_reset='latest',
+                 group_id=None, consumer_timeout_ms=None, **configs):
+        self.value_deserializer = value_deserializer
+        self.key_deserializer = key_deserializer
+        self.auto_offset_reset = auto_offset_reset
+        self.group_id = group_id or f"memory-{id(self)}"
+        self.consumer_timeout_ms = consumer_timeout_ms
+        self.topics = set()
+        self.listener = None
+        self.assigned = set()
+        self.pending_assignment = None
+        self.positions = dict()  # TopicPartition -> next offset to read
+        self.paused = set()
+        if topics:
+            self.subscribe(list(topics))
+
+    def subscribe(self, topics, listener=None):
+        self.topics = set(topics)
+        self.listener = listener
+        broker.join(self.group_id, self)
+
+    def partitions_for_topic(self, topic):
+        with broker.condition:
+            return set(range(len(broker.get_partitions(topic))))
+
+    def assignment(self):
+        return set(self.assigned)
+
+    def apply_pending_assignment(self):
+        """ run rebalance callbacks in the polling thread, like kafka-python does """
+        with broker.condition:
+            new_assignment, self.pending_assignment = self.pending_assignment, None
+        if new_assignment is None or new_assignment == self.assigned:
+            return
+        if self.listener:
+            self.listener.on_partitions_revoked(set(self.assigned))
+        with broker.condition:
+            self.assigned = new_assignment
+            self.paused &= new_assignment
+            for tp in list(self.positions):
+                if tp not in new_assignment:
+                    del self.positions[tp]
+            for tp in new_assignment:
+                if tp not in self.positions:
+                    committed = broker.committed.get((self.group_id, tp))
+                    if committed is not None:
+                        self.positions[tp] = committed
+                    else:
+                        self.positions[tp] = 0 if self.auto_offset_reset == 'earliest' else broker.end_offset(tp)
+        if self.listener:
+            self.listener.on_partitions_assigned(set(self.assigned))
+
+    def fetch(self, max_records):
+        """ collect available records from assigned, not paused partitions. caller holds lock """
+        records = dict()
+        count = 0
+        for tp in sorted(self.assigned - self.paused):
+            log = broker.get_partitions(tp.topic)[tp.partition]
+            position = self.positions[tp]
+            batch = log[position:position + max_records - count]
+            if not batch:
+                continue
+            self.positions[tp] = position + len(batch)
+            records[tp] = batch
+            count += len(batch)
+            if count >= max_records:
+                break
+        return records
+
+    def poll(self, timeout_ms=0, max_records=None):
+        self.apply_pending_assignment()
+        max_records = max_records or 500
+        deadline = time.monotonic() + timeout_ms / 1000
+        with broker.condition:
+            raw_records = self.fetch(max_records)
+            while not raw_records and self.pending_assignment is None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                broker.condition.wait(remaining)
+                raw_records = self.fetch(max_records)
+        return {tp: [self.deserialize(record) for record in batch] for tp, batch in raw_records.items()}
+
+    def deserialize(self, record):
+        key = self.key_deserializer(record.key) if (record.key is not None and self.key_deserializer) else record.key
+        value = self.value_deserializer(record.value) if self.value_deserializer else record.value
+        return record._replace(key=key, value=value)
+
+    def __iter__(self):
+        while True:
+            records = self.poll(timeout_ms=self.consumer_timeout_ms or 1000)
+            if not records:
+                if self.consumer_timeout_ms:
+                    return
+                continue
+            for batch in records.values():
+                yield from batch
+
+    def commit(self, offsets=None):
+        with broker.condition:
+            if offsets is None:
+                offsets = {tp: position for tp, position in self.positions.items()}
+            for tp, offset in offsets.items():
+                broker.committed[(self.group_id, tp)] = getattr(offset, 'offset', offset)
+
+    def pause(self, *partitions):
+        self.paused.update(partitions)
+
+    def resume(self, *partitions):
+        self.paused.difference_update(partitions)
+        with broker.condition:
+            broker.condition.notify_all()
+
+    def seek(self, partition, offset):
+        self.positions[partition] = offset
+
+    def close(self, autocommit=False):
+        broker.leave(self.group_id, self)
+        logger.info(f"memory consumer of group {self.group_id} closed")
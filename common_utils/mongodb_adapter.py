@@ -18,6 +18,7 @@ class CollectionType(Enum):
     MONGO_TEST_COLLECTION = "testing"
     MONGO_ROUTES_REQUESTS_COLLECTION = "route_requests"
     MONGO_ROUTES_DATA_COLLECTION = "routes_data"
+    MONGO_NEARBY_SEARCH_COLLECTION = "nearby_search_cache"
 
 client = None
 my_db = None
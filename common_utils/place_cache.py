@@ -0,0 +1,223 @@
+"""
+Read-through in-process cache in front of the places tables (restaurants_res, gas_stations_res, attractions_res).
+
+Popular corridors ask for the same places many times a day, so DB records are kept in a bounded LRU cache for
+the time they live in the DB (until created_at + lambda_rds_cleaner retention). Places known to be missing from the DB are kept
+as negative entries (shorter TTL, as another service instance may add them), and places written by this process
+are put in the cache (write-through). Hit/miss counters are reported by cache_metrics.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from common_utils import cache_metrics
+from common_utils import db_utils
+from common_utils.utils import haversine_distance
+
+PLACE_CACHE_SIZE = int(os.getenv('PLACE_CACHE_SIZE', '20000'))                      # entries per table
+PLACE_CACHE_TTL_SEC = int(os.getenv('PLACE_CACHE_TTL_SEC', str(5 * 24 * 3600)))     # same as DB retention (5 days)
+PLACE_CACHE_NEGATIVE_TTL_SEC = int(os.getenv('PLACE_CACHE_NEGATIVE_TTL_SEC', '3600'))
+PLACE_CACHE_NEARBY_TTL_SEC = int(os.getenv('PLACE_CACHE_NEARBY_TTL_SEC', '600'))      # nearby searches (other instances add places)
+RETENTION_DAYS = int(os.getenv('CLEANER_RETENTION_DAYS', '5'))                        # same as lambda_rds_cleaner
+# per table TTL override, i.e. "attractions_res=3600,gas_stations_res=86400"
+table_ttl_sec = {table: int(ttl) for table, ttl in (item.split('=') for item in os.getenv('PLACE_CACHE_TABLE_TTL_SEC', '').split(',') if '=' in item)}
+
+NOT_FOUND = None  # value of negative entries
+
+
+class TTLCache:
+    """ thread-safe LRU cache with a size bound and per entry expiry time """
+    def __init__(self, name, max_size, ttl_sec, negative_ttl_sec=None):
+        self.name = name
+        self.max_size = max_size
+        self.ttl_sec = ttl_sec
+        self.negative_ttl_sec = ttl_sec if negative_ttl_sec is None else negative_ttl_sec
+        self.entries = OrderedDict()  # key -> (expires_at, value) ; kept in LRU order
+        self.lock = threading.Lock()
+
+    def lookup(self, key):
+        """ returns (found, value). a negative entry is found with value NOT_FOUND. counts hit/miss """
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= now:
+                del self.entries[key]  # expired
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        cache_metrics.record(self.name, entry is not None)
+        return (True, entry[1]) if entry is not None else (False, None)
+
+    def get(self, key, default=None):
+        found, value = self.lookup(key)
+        return value if found else default
+
+    def peek(self, key, default=None):
+        """ value of unexpired entry, without counting a hit/miss or changing LRU order """
+        with self.lock:
+            entry = self.entries.get(key)
+        return entry[1] if entry is not None and entry[0] > time.monotonic() else default
+
+    def put(self, key, value, ttl_sec=None):
+        if ttl_sec is None:
+            ttl_sec = self.negative_ttl_sec if value is NOT_FOUND else self.ttl_sec
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl_sec, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def delete_matching(self, predicate):
+        """ drop all entries whose key matches predicate(key). returns number of dropped entries """
+        with self.lock:
+            keys = [key for key in self.entries if predicate(key)]
+            for key in keys:
+                del self.entries[key]
+        return len(keys)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+caches = dict()  # (table, key columns) -> TTLCache
+caches_lock = threading.Lock()
+
+
+def get_cache(table_name, column):
+    key = (table_name, column)
+    with caches_lock:
+        if key not in caches:
+            column_name = '+'.join(column) if isinstance(column, (tuple, list)) else column
+            ttl_sec = table_ttl_sec.get(table_name, PLACE_CACHE_TTL_SEC)
+            if column == "nearby":
+                ttl_sec = min(ttl_sec, PLACE_CACHE_NEARBY_TTL_SEC)
+            caches[key] = TTLCache(f"{table_name}.{column_name}", PLACE_CACHE_SIZE, ttl_sec,
+                                   min(PLACE_CACHE_NEGATIVE_TTL_SEC, ttl_sec))
+        return caches[key]
+
+
+def get_record_ttl(cache, record):
+    """ TTL of a DB record - it is not kept after the cleaner deletes it from DB (created_at + retention) """
+    created_at = record.get("created_at") if isinstance(record, dict) else None
+    if isinstance(created_at, str):
+        try:
+            created_at = datetime.fromisoformat(created_at)
+        except ValueError:
+            created_at = None
+    if not isinstance(created_at, datetime):
+        return cache.ttl_sec  # negative entry, or record without created_at (just written)
+    expires_at = created_at + timedelta(days=RETENTION_DAYS)
+    return min(cache.ttl_sec, (expires_at - datetime.now(created_at.tzinfo)).total_seconds())
+
+
+def put_record(cache, key, record):
+    """ cache DB record (or negative entry) - records about to be deleted by the cleaner are not cached """
+    ttl_sec = cache.negative_ttl_sec if record is NOT_FOUND else get_record_ttl(cache, record)
+    if ttl_sec > 0:
+        cache.put(key, record, ttl_sec)
+    else:
+        cache.delete(key)
+
+
+def lookup_records(table_name, column, values):
+    """ returns ({key: record} of cached records, [keys to read from DB]) """
+    cache = get_cache(table_name, column)
+    result = dict()
+    missing = []
+    for value in dict.fromkeys(values):
+        found, record = cache.lookup(value)
+        if not found:
+            missing.append(value)
+        elif record is not NOT_FOUND:
+            result[value] = record
+    return result, missing
+
+
+def put_db_records(table_name, column, missing, db_records, result):
+    """ cache records read from DB for 'missing' keys (keys not in db_records are negative entries) and add them to result """
+    if db_records is None:
+        return result  # DB not available - nothing is cached
+    cache = get_cache(table_name, column)
+    for value in missing:
+        record = db_records.get(value, NOT_FOUND)
+        put_record(cache, value, record)
+        if record is not NOT_FOUND:
+            result[value] = record
+    return result
+
+
+def get_records_by_keys(table_name, column, values):
+    """
+    Same as db_utils.get_records_by_keys (returns {key: record} of keys found in DB), reading only the keys
+    that are not cached. returned records are shared - don't change them.
+    """
+    result, missing = lookup_records(table_name, column, values)
+    if not missing:
+        return result
+    return put_db_records(table_name, column, missing, db_utils.get_records_by_keys(table_name, column, missing), result)
+
+
+def store_records(table_name, column, records):
+    """ write-through - put records just written to DB in the cache (replacing negative entries) """
+    cache = get_cache(table_name, column)
+    for record in records or []:
+        if isinstance(column, (tuple, list)):
+            key = tuple(db_utils.convert_values(record[name]) for name in column)
+        else:
+            key = db_utils.convert_values(record[column])
+        put_record(cache, key, record)
+
+
+NEARBY_KEY_DECIMALS = 4  # ~10m - searches from (almost) the same point share the cached result
+
+
+def get_nearby_key(latitude, longitude, radius_m, limit):
+    return (round(latitude, NEARBY_KEY_DECIMALS), round(longitude, NEARBY_KEY_DECIMALS), radius_m, limit)
+
+
+def lookup_nearby(table_name, latitude, longitude, radius_m, limit=10):
+    """ returns (found, records) of cached search """
+    return get_cache(table_name, "nearby").lookup(get_nearby_key(latitude, longitude, radius_m, limit))
+
+
+def put_nearby(table_name, latitude, longitude, radius_m, limit, records):
+    """ cache DB search result (empty result is kept for the negative TTL). the search is kept until the first of
+        its records expires from DB, and at most PLACE_CACHE_NEARBY_TTL_SEC (places added by other instances)
+    """
+    if records is not None:
+        cache = get_cache(table_name, "nearby")
+        ttl_sec = min([get_record_ttl(cache, record) for record in records], default=cache.negative_ttl_sec)
+        if ttl_sec > 0:
+            cache.put(get_nearby_key(latitude, longitude, radius_m, limit), records, ttl_sec)
+    return records
+
+
+def find_nearby(table_name, latitude, longitude, radius_m, limit=10):
+    """ cached db_utils.find_nearby. returned records are shared - don't change them """
+    if latitude is None or longitude is None:
+        return []
+    found, records = lookup_nearby(table_name, latitude, longitude, radius_m, limit)
+    if found:
+        return records
+    return put_nearby(table_name, latitude, longitude, radius_m, limit,
+                      db_utils.find_nearby(table_name, latitude, longitude, radius_m, limit))
+
+
+def invalidate_nearby(table_name, latitude, longitude, radius_m, limit=10):
+    """ drop cached search results after records were added within 'radius_m' of this point -
+        every cached search whose area overlaps that circle may now miss them
+    """
+    def overlaps(key):
+        key_lat, key_lng, key_radius_m = key[:3]
+        return haversine_distance(latitude, longitude, key_lat, key_lng) * 1000 <= radius_m + key_radius_m
+
+    get_cache(table_name, "nearby").delete_matching(overlaps)
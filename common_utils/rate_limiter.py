@@ -0,0 +1,172 @@
+"""
+Token-bucket rate limiter and daily quota budget of the third-party APIs, shared by all threads and processes
+of the host (each provider's state is kept in a small locked file under RATE_LIMIT_DIR).
+
+acquire(provider) takes a token, waiting until one is available. it refuses (returns False) when the daily
+budget of the provider is used up or the wait would be longer than RATE_LIMIT_MAX_WAIT_SEC. callers treat a
+refused call as a failed one, and check is_budget_low() to do less work (fewer waypoints, no details) before
+the budget runs out. budgets are counted per UTC day.
+"""
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from common_utils.local_logger import logger
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+    import msvcrt
+
+GOOGLE_PLACES = "google_places"
+GOOGLE_DIRECTIONS = "google_directions"
+HERE_DISCOVER = "here_discover"
+GOOGLE_TRANSLATE = "google_translate"
+TELEGRAM = "telegram"
+
+# provider -> (requests per second, daily budget - 0 for no budget)
+default_limits = {
+    GOOGLE_PLACES: (10, 5000),
+    GOOGLE_DIRECTIONS: (5, 2000),
+    HERE_DISCOVER: (5, 1000),
+    GOOGLE_TRANSLATE: (5, 10000),
+    TELEGRAM: (20, 0),
+}
+
+
+def parse_limits(env_name):
+    """ "google_places=10,here_discover=5" -> {provider: float} """
+    return {name: float(value) for name, value in (item.split('=') for item in os.getenv(env_name, '').split(',') if '=' in item)}
+
+
+RATE_LIMIT_DIR = os.getenv('RATE_LIMIT_DIR', os.path.join(tempfile.gettempdir(), "route-planner-rate-limits"))
+RATE_LIMIT_MAX_WAIT_SEC = float(os.getenv('RATE_LIMIT_MAX_WAIT_SEC', '10'))           # longer waits are refused
+RATE_LIMIT_LOW_BUDGET_FRACTION = float(os.getenv('RATE_LIMIT_LOW_BUDGET_FRACTION', '0.2'))
+RATE_LIMIT_BUDGET_CACHE_SEC = float(os.getenv('RATE_LIMIT_BUDGET_CACHE_SEC', '5'))   # budget checks reuse last known usage
+qps_limits = {provider: limits[0] for provider, limits in default_limits.items()} | parse_limits('RATE_LIMIT_QPS')
+daily_budgets = {provider: limits[1] for provider, limits in default_limits.items()} | parse_limits('RATE_LIMIT_DAILY_BUDGET')
+
+thread_locks = {provider: threading.Lock() for provider in qps_limits}  # file locks are per process on windows
+known_usage = dict()  # provider -> (today's used budget, time.monotonic() it was read) - updated by every reserve()
+
+
+def lock_file(file):
+    if fcntl:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+
+
+def unlock_file(file):
+    if fcntl:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+    else:
+        file.seek(0)
+        msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def update_state(provider, update):
+    """ call update(state, qps) under the provider lock and save the state. returns its result """
+    os.makedirs(RATE_LIMIT_DIR, exist_ok=True)
+    file_name = os.path.join(RATE_LIMIT_DIR, f"{provider}.json")
+    with thread_locks.setdefault(provider, threading.Lock()):
+        with os.fdopen(os.open(file_name, os.O_RDWR | os.O_CREAT), "r+") as file:
+            lock_file(file)
+            try:
+                file.seek(0)
+                try:
+                    state = json.loads(file.read() or "{}")
+                except ValueError:
+                    state = {}
+                now = time.time()
+                today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+                if state.get("day") != today:
+                    state["day"] = today
+                    state["used"] = 0
+                qps = qps_limits.get(provider, 0)
+                if qps > 0:  # refill bucket (capacity - one second of requests)
+                    capacity = max(qps, 1)
+                    tokens = state.get("tokens", capacity) + (now - state.get("updated", now)) * qps
+                    state["tokens"] = min(tokens, capacity)
+                state["updated"] = now
+                result = update(state, qps)
+                known_usage[provider] = (state["used"], time.monotonic())
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps(state))
+                file.flush()
+            finally:
+                unlock_file(file)
+    return result
+
+
+def reserve(provider, cost=1):
+    """ take 'cost' tokens. returns seconds to wait before the call, None if refused """
+    def take_tokens(state, qps):
+        budget = daily_budgets.get(provider, 0)
+        if budget and state["used"] + cost > budget:
+            return None
+        wait_sec = 0.0
+        if qps > 0:
+            wait_sec = max(0.0, (cost - state["tokens"]) / qps)  # tokens may go negative - later calls wait longer
+            if wait_sec > RATE_LIMIT_MAX_WAIT_SEC:
+                return None
+            state["tokens"] -= cost
+        state["used"] += cost
+        return wait_sec
+
+    try:
+        wait_sec = update_state(provider, take_tokens)
+    except OSError as e:
+        logger.error(f"rate limiter of {provider} is not available - call is not limited: {e}")
+        return 0.0
+    if wait_sec is None:
+        logger.warning(f"{provider} call refused - daily budget {daily_budgets.get(provider, 0):g} used or rate limit wait too long")
+    return wait_sec
+
+
+def acquire(provider, cost=1):
+    """ wait for rate limit of provider. returns False if call should not be made """
+    wait_sec = reserve(provider, cost)
+    if wait_sec:
+        time.sleep(wait_sec)
+    return wait_sec is not None
+
+
+async def acquire_async(provider, cost=1):
+    """ acquire() for asyncio callers (state file is locked and read in a worker thread) """
+    wait_sec = await asyncio.to_thread(reserve, provider, cost)
+    if wait_sec:
+        await asyncio.sleep(wait_sec)
+    return wait_sec is not None
+
+
+def get_budget_remaining(provider):
+    """ fraction of today's budget left (1.0 for providers with no budget) """
+    budget = daily_budgets.get(provider, 0)
+    if not budget:
+        return 1.0
+    used, read_at = known_usage.get(provider, (0, None))
+    if read_at is None or time.monotonic() - read_at > RATE_LIMIT_BUDGET_CACHE_SEC:
+        try:
+            used = update_state(provider, lambda state, qps: state["used"])
+        except OSError:
+            return 1.0
+    return max(0.0, 1 - used / budget)
+
+
+def is_budget_low(provider):
+    """ may read the state file (once in RATE_LIMIT_BUDGET_CACHE_SEC) - asyncio callers run it with asyncio.to_thread """
+    return get_budget_remaining(provider) < RATE_LIMIT_LOW_BUDGET_FRACTION
+
+
+if __name__ == "__main__":
+    start_time = time.time()
+    for _ in range(15):
+        acquire(GOOGLE_PLACES)
+    print(f"15 calls at {qps_limits[GOOGLE_PLACES]}/sec took {time.time() - start_time:.2f}s, "
+          f"budget left {get_budget_remaining(GOOGLE_PLACES):.1%}")
@@ -0,0 +1,141 @@
+"""
+Geo-tiled cache of google nearby-search responses.
+
+Waypoints of popular corridors land within a few hundred meters of each other request after request, so the
+search point is snapped to the center of a grid cell (NEARBY_SEARCH_CELL_M) and the response is cached by
+(place type, radius, cell). The search itself is sent with the cell center, so a cached response is exactly what
+google returns for that key. With a 3km search radius the snapped point moves by at most ~0.7 cell size.
+
+Responses are kept in an in-process TTL cache and, with NEARBY_SEARCH_CACHE_STORE = "mongo", also in a mongo
+collection (expired by a TTL index), shared by all api-service instances. When mongo is down it is skipped for
+NEARBY_SEARCH_MONGO_RETRY_SEC, so searches don't wait on a connect timeout each time.
+"""
+import math
+import os
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from common_utils.local_logger import logger
+from common_utils import cache_metrics
+from common_utils.place_cache import TTLCache
+from common_utils.db_statements import METERS_PER_DEGREE_LAT
+
+NEARBY_SEARCH_CACHE_STORE = os.getenv('NEARBY_SEARCH_CACHE_STORE', 'memory')           # 'memory', 'mongo' or 'none'
+NEARBY_SEARCH_CELL_M = float(os.getenv('NEARBY_SEARCH_CELL_M', '500'))                 # grid cell size (meters)
+NEARBY_SEARCH_CACHE_TTL_SEC = int(os.getenv('NEARBY_SEARCH_CACHE_TTL_SEC', str(24 * 3600)))
+NEARBY_SEARCH_EMPTY_TTL_SEC = int(os.getenv('NEARBY_SEARCH_EMPTY_TTL_SEC', '3600'))    # cells with no places
+NEARBY_SEARCH_CACHE_SIZE = int(os.getenv('NEARBY_SEARCH_CACHE_SIZE', '20000'))
+NEARBY_SEARCH_MONGO_RETRY_SEC = int(os.getenv('NEARBY_SEARCH_MONGO_RETRY_SEC', '60'))  # skip mongo after a failure
+
+STORE_MEMORY = 'memory'
+STORE_MONGO = 'mongo'
+STORE_NONE = 'none'
+
+memory_cache = TTLCache("nearby_search", NEARBY_SEARCH_CACHE_SIZE, NEARBY_SEARCH_CACHE_TTL_SEC, NEARBY_SEARCH_EMPTY_TTL_SEC)
+mongo_ready = False
+mongo_lock = threading.Lock()  # one connect at a time (mongodb_adapter client is global)
+mongo_retry_at = 0  # time.monotonic() from which mongo is used again after a failure
+
+
+def get_cell(latitude, longitude, cell_m=NEARBY_SEARCH_CELL_M):
+    """ returns ((row, column), (center latitude, center longitude)) of the grid cell of point """
+    lat_step = cell_m / METERS_PER_DEGREE_LAT
+    row = math.floor(latitude / lat_step)
+    center_lat = (row + 0.5) * lat_step
+    lng_step = cell_m / (METERS_PER_DEGREE_LAT * max(math.cos(math.radians(center_lat)), 0.01))  # cells of a row are ~square
+    column = math.floor(longitude / lng_step)
+    return (row, column), (round(center_lat, 6), round((column + 0.5) * lng_step, 6))
+
+
+def get_key(place_type, radius_m, cell):
+    return f"{place_type}:{int(radius_m)}:{int(NEARBY_SEARCH_CELL_M)}:{cell[0]}:{cell[1]}"
+
+
+def get_search_point(latitude, longitude):
+    """ point to send to google for this waypoint (cell center, or the waypoint itself when cache is off) """
+    if NEARBY_SEARCH_CACHE_STORE == STORE_NONE:
+        return latitude, longitude
+    return get_cell(float(latitude), float(longitude))[1]
+
+
+def mongo_failed(error):
+    """ skip mongo for NEARBY_SEARCH_MONGO_RETRY_SEC """
+    global mongo_retry_at
+    mongo_retry_at = time.monotonic() + NEARBY_SEARCH_MONGO_RETRY_SEC
+    logger.error(f"nearby search cache: mongo not available ({error}) - using memory cache only for {NEARBY_SEARCH_MONGO_RETRY_SEC}s")
+
+
+def get_collection():
+    """ mongo collection of cached responses, None if mongo is not available (or failed recently) """
+    global mongo_ready
+    if time.monotonic() < mongo_retry_at:
+        return None
+    from common_utils import mongodb_adapter  # mongo settings are required only for mongo store
+    with mongo_lock:
+        if time.monotonic() < mongo_retry_at:
+            return None  # failed while waiting for the lock
+        if mongodb_adapter.my_db is None:
+            mongodb_adapter.connect_db()
+            if mongodb_adapter.my_db is None:
+                mongo_failed("connect failed")
+                return None
+        collection = mongodb_adapter.get_collection(mongodb_adapter.CollectionType.MONGO_NEARBY_SEARCH_COLLECTION)
+        if not mongo_ready:
+            collection.create_index("expires_at", expireAfterSeconds=0)
+            mongo_ready = True
+    return collection
+
+
+def lookup_mongo(key):
+    try:
+        collection = get_collection()
+        document = collection.find_one({"_id": key}) if collection is not None else None
+    except Exception as e:
+        mongo_failed(f"lookup of {key} failed: {e}")
+        return False, None
+    # TTL index removes expired documents about once a minute
+    if document is None or document["expires_at"].replace(tzinfo=timezone.utc) <= datetime.now(timezone.utc):
+        return False, None
+    return True, document["results"]
+
+
+def put_mongo(key, results, ttl_sec):
+    try:
+        collection = get_collection()
+        if collection is not None:
+            expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl_sec)
+            collection.replace_one({"_id": key}, {"_id": key, "results": results, "expires_at": expires_at}, upsert=True)
+    except Exception as e:
+        mongo_failed(f"write of {key} failed: {e}")
+
+
+def lookup(place_type, radius_m, latitude, longitude):
+    """ returns (found, results) of cached search of the waypoint cell. results are shared - don't change them """
+    if NEARBY_SEARCH_CACHE_STORE == STORE_NONE:
+        return False, None
+    key = get_key(place_type, radius_m, get_cell(float(latitude), float(longitude))[0])
+    found, results = memory_cache.lookup(key)
+    if found or NEARBY_SEARCH_CACHE_STORE != STORE_MONGO:
+        return found, results
+    found, results = lookup_mongo(key)
+    cache_metrics.record("nearby_search.mongo", found)
+    if found:
+        memory_cache.put(key, results, NEARBY_SEARCH_CACHE_TTL_SEC if results else NEARBY_SEARCH_EMPTY_TTL_SEC)
+    return found, results
+
+
+def put(place_type, radius_m, latitude, longitude, results):
+    """ cache google results of the waypoint cell (failed searches - None - are not cached) """
+    if NEARBY_SEARCH_CACHE_STORE == STORE_NONE or results is None:
+        return
+    key = get_key(place_type, radius_m, get_cell(float(latitude), float(longitude))[0])
+    ttl_sec = NEARBY_SEARCH_CACHE_TTL_SEC if results else NEARBY_SEARCH_EMPTY_TTL_SEC
+    memory_cache.put(key, results, ttl_sec)
+    if NEARBY_SEARCH_CACHE_STORE == STORE_MONGO:
+        put_mongo(key, results, ttl_sec)
+
+
+if __name__ == "__main__":
+    # waypoints ~100m apart share the cell (and the cached search)
+    for point in [(32.0853, 34.7818), (32.0860, 34.7825), (32.1000, 34.8000)]:
+        print(point, get_cell(*point))
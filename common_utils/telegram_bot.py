@@ -3,9 +3,11 @@ Telegram BOT handlers
 initialize the bot, listen on requests, and support responses through handlers
 """
 
-import requests
 import json
+from requests.exceptions import RequestException
 from common_utils.local_logger import logger
+from common_utils.http_client import get_session
+from common_utils import rate_limiter
 import os
 import telebot
 
@@ -27,12 +29,16 @@ def send_message(chat_id, text):
     # put your chat id and send a message
     bot_url = f'https://api.telegram.org/bot{test_token}/'
 
-    url = bot_url + f'sendMessage?chat_id={chat_id}&text={text}'
-    #print(url)
-    logger.info(url)
-    
-    # # Print the get request
-    resp = requests.get(url)
+    url = bot_url + 'sendMessage'
+    logger.info(f"sendMessage to chat {chat_id}: {text}")
+
+    # text is sent as query param (url encoded) on the shared telegram connection.
+    # sendMessage is not idempotent - a retried request after a lost response would send the text twice, so no retries
+    try:
+        resp = get_session("telegram", max_retries=0, rate_limit=rate_limiter.TELEGRAM).get(url, params={'chat_id': chat_id, 'text': text})
+    except RequestException as e:
+        logger.error(f"failed to send text of len {len(text)} to BOT: {e}")
+        return False
     #print(resp.text)
 
     if resp.status_code == 200:
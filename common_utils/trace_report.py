@@ -0,0 +1,81 @@
+"""
+Aggregates 'TRACE_PATH' log lines (see tracing.py) into latency percentiles per stage.
+
+usage (from project root):
+    python -m common_utils.trace_report [log files...]      (default: logs/*.log)
+
+time of a stage = time from previous stamp in the message path to the stage stamp, so for example
+'api_fetch_end:restaurant' is google restaurants fetch time, and 'dequeue:<topic>' is the time message
+waited in kafka (including the previous service enqueue).
+"""
+import argparse
+import glob
+import json
+from collections import defaultdict
+from common_utils.tracing import TRACE_LOG_PREFIX
+
+PERCENTILES = [50, 95, 99]
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def read_trace_paths(file_names):
+    """ yields trace records logged by tracing.log_trace. same path logged twice (i.e. re-delivery) is read once """
+    seen = set()
+    for file_name in file_names:
+        with open(file_name, "r", encoding="utf-8", errors="replace") as file:
+            for line in file:
+                pos = line.find(TRACE_LOG_PREFIX)
+                if pos < 0:
+                    continue
+                try:
+                    record = json.loads(line[pos + len(TRACE_LOG_PREFIX):])
+                except ValueError:
+                    continue
+                key = (record.get('trace_id'), record.get('place_type'))
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield record
+
+
+def aggregate(records):
+    """ returns ({stage: [seconds]}, [end to end seconds]) """
+    stage_times = defaultdict(list)
+    end_to_end = []
+    for record in records:
+        stamps = record.get('stamps', [])  # kept in path order
+        if len(stamps) < 2:
+            continue
+        for (_, prev_ts), (stage, ts) in zip(stamps, stamps[1:]):
+            stage_times[stage].append(ts - prev_ts)
+        end_to_end.append(stamps[-1][1] - stamps[0][1])
+    return stage_times, end_to_end
+
+
+def format_row(name, values):
+    cells = ' '.join(f"p{pct}={percentile(values, pct) * 1000:9.1f}ms" for pct in PERCENTILES)
+    return f"{name:45s} n={len(values):6d} {cells}"
+
+
+def print_report(file_names):
+    stage_times, end_to_end = aggregate(read_trace_paths(file_names))
+    if not end_to_end:
+        print("no traces found")
+        return
+    for stage, values in sorted(stage_times.items(), key=lambda item: -percentile(item[1], 50)):
+        print(format_row(stage, values))
+    print(format_row("END-TO-END", end_to_end))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="latency percentiles per pipeline stage from trace logs")
+    parser.add_argument("files", nargs="*", help="log files (default: logs/*.log)")
+    args = parser.parse_args()
+    print_report(args.files or glob.glob("logs/*.log"))
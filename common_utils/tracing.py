@@ -0,0 +1,78 @@
+"""
+End-to-end request tracing.
+
+A trace id and a list of per-stage timestamps travel inside the message dict (field 'trace'), from the bot
+request through api, spark and results services. Each stamp is [stage, timestamp] where timestamp is epoch
+seconds derived from a monotonic clock (never goes backwards within a process, comparable between services).
+When the results service finished with a message, it logs the whole path as one 'TRACE_PATH' line -
+see trace_report.py for p50/p95/p99 per stage.
+"""
+import json
+import time
+import uuid
+from contextlib import contextmanager
+from common_utils.local_logger import logger
+
+TRACE_FIELD = 'trace'
+TRACE_LOG_PREFIX = 'TRACE_PATH '
+
+# anchor monotonic clock to wall clock once per process
+clock_anchor_wall = time.time()
+clock_anchor_monotonic = time.perf_counter()
+
+
+def now():
+    return clock_anchor_wall + (time.perf_counter() - clock_anchor_monotonic)
+
+
+def start_trace(message):
+    """ add a new trace to message (request created by the bot) """
+    message[TRACE_FIELD] = {'trace_id': uuid.uuid4().hex, 'stamps': []}
+    return message[TRACE_FIELD]['trace_id']
+
+
+def fork(message):
+    """ copy of message with its own trace stamps - for results sent on separate paths (one per place type),
+        so stamps of one path don't show up in the others
+    """
+    forked = dict(message)
+    trace = message.get(TRACE_FIELD)
+    if trace is not None:
+        forked[TRACE_FIELD] = dict(trace, stamps=list(trace['stamps']))
+    return forked
+
+
+def get_trace_id(message):
+    trace = message.get(TRACE_FIELD) if isinstance(message, dict) else None
+    return trace.get('trace_id') if trace else None
+
+
+def mark(message, stage, timestamp=None):
+    """ add stage timestamp to message trace (ignored for messages without trace).
+        'timestamp' (from now()) - stage happened earlier, i.e. concurrent stages are added in order when all ended
+    """
+    trace = message.get(TRACE_FIELD) if isinstance(message, dict) else None
+    if trace is not None:
+        trace['stamps'].append([stage, round(now() if timestamp is None else timestamp, 6)])
+
+
+@contextmanager
+def span(message, stage):
+    """ mark '<stage>_start' and '<stage>_end' around a block. 'stage' may include place type i.e. 'api_fetch:restaurant' """
+    name, _, suffix = stage.partition(':')
+    suffix = f":{suffix}" if suffix else ""
+    mark(message, f"{name}_start{suffix}")
+    try:
+        yield
+    finally:
+        mark(message, f"{name}_end{suffix}")
+
+
+def log_trace(message):
+    """ log the full trace path of a message that reached the end of the pipeline """
+    trace = message.get(TRACE_FIELD) if isinstance(message, dict) else None
+    if not trace:
+        return
+    record = {'trace_id': trace['trace_id'], 'route_id': message.get('route_id'),
+              'place_type': message.get('place_type'), 'stamps': trace['stamps']}
+    logger.info(TRACE_LOG_PREFIX + json.dumps(record))
@@ -2,14 +2,21 @@
 import pandas as pd
 #from googletrans import Translator
 from deep_translator import GoogleTranslator
-import time
+import os
+import threading
+from collections import OrderedDict
 from common_utils.local_logger import logger
+from common_utils import cache_metrics
+from common_utils import rate_limiter
 import re
 
 # Initialize the translator
 #translator = Translator()
 
-translate_counter = 0
+# in-process cache of translations (place names, addresses repeat a lot on the same corridors)
+TRANSLATION_CACHE_SIZE = int(os.getenv('TRANSLATION_CACHE_SIZE', '5000'))
+translation_cache = OrderedDict()  # (text, src_lang, dest_lang) -> translated text ; kept in LRU order
+translation_cache_lock = threading.Lock()
 
 #print(GoogleTranslator().get_supported_languages())
 
@@ -25,23 +32,35 @@ def is_mostly_english(text):
 
 
 def translate_text(text, src_lang='auto', dest_lang='en'):
-    global translate_counter  # Declare that you're using the global variable
     try:
         if not text or str(text).strip() == "":  # Handle empty values
             return ""
         translated_text = text
         
         if (dest_lang != 'en') or not is_mostly_english(text):
+            cache_key = (text, src_lang, dest_lang)
+            with translation_cache_lock:
+                cached_text = translation_cache.get(cache_key)
+                if cached_text is not None:
+                    translation_cache.move_to_end(cache_key)
+            cache_metrics.record("translations", cached_text is not None)
+            if cached_text is not None:
+                return cached_text
+
+            # rate limit prevents bursts on translator, which may cause errors
+            if not rate_limiter.acquire(rate_limiter.GOOGLE_TRANSLATE):
+                return text  # budget used up - keep original text
             result_text =  GoogleTranslator(source=src_lang, target=dest_lang).translate(text)
             if result_text.lower().startswith("error"):
                 logger.warning(f"Failed to translate text {text}. got error {result_text}")
             else:
                 translated_text = result_text
+                with translation_cache_lock:
+                    translation_cache[cache_key] = translated_text
+                    if len(translation_cache) > TRANSLATION_CACHE_SIZE:
+                        translation_cache.popitem(last=False)
                 
  #       translated_texts_list.append(tmp_translate)
-        translate_counter += 1
-        if not translate_counter % 20:
-            time.sleep(1)   # this is needed to prevent bursts on translator, which may cause errors
         return translated_text   
     except Exception as e:
         logger.warning(f"Error translating text {text}: {e}")
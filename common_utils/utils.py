@@ -29,6 +29,8 @@ class UserRequestFieldNames(Enum):
     TOTAL_DISTANCE = 'total-distance'
     LATITUDE = 'lat'
     LONGITUDE = 'lng'
+    LATITUDE_E6 = 'lat_e6'    # waypoint coordinates as int micro-degrees (see to_e6)
+    LONGITUDE_E6 = 'lng_e6'
         
 class BreakPointName(Enum):
     NONE = "none"    
@@ -115,6 +117,115 @@ def haversine_distance(lat1, lon1, lat2, lon2):
     return R * c  # Distance in km
 
 
+GEOHASH_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+def geohash_encode(lat, lng, precision=6):
+    """ encode coordinates to geohash string. precision 4 ~ 39x20km cell, 5 ~ 5x5km, 6 ~ 1.2x0.6km """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    geohash = []
+    bits, bit_count, even_bit = 0, 0, True
+    while len(geohash) < precision:
+        value_range, value = (lng_range, lng) if even_bit else (lat_range, lat)
+        mid = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= mid:
+            bits |= 1
+            value_range[0] = mid
+        else:
+            value_range[1] = mid
+        even_bit = not even_bit
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_BASE32[bits])
+            bits, bit_count = 0, 0
+    return ''.join(geohash)
+
+
+# Coordinates canonical form - int32 micro-degrees (degrees * 10^6, ~11cm). same as DB columns lat_e6/lng_e6
+# (see DB/coordinates_e6.sql), so keys compare exactly everywhere and messages carry short ints instead of long floats
+COORD_E6_SCALE = 1000000
+
+# place coordinate fields -> int micro-degrees fields used in messages (and DB where available)
+coordinate_e6_fields = {'latitude': 'lat_e6', 'longitude': 'lng_e6', 'wp_latitude': 'wp_lat_e6', 'wp_longitude': 'wp_lng_e6'}
+
+
+def to_e6(value):
+    """ degrees (float, Decimal or str) to int micro-degrees """
+    return None if value is None else int(round(float(value) * COORD_E6_SCALE))
+
+
+def from_e6(value):
+    """ int micro-degrees to float degrees """
+    return None if value is None else value / COORD_E6_SCALE
+
+
+def coord_e6(latitude, longitude):
+    """ exact (hashable) key of a location """
+    return (to_e6(latitude), to_e6(longitude))
+
+
+def get_coordinate(place, field):
+    """ float degrees of coordinate 'field' (i.e. 'latitude') of a place dict or DB record, from its micro-degrees field when present """
+    e6_field = coordinate_e6_fields.get(field)
+    if e6_field and place.get(e6_field) is not None:
+        return from_e6(place[e6_field])
+    value = place.get(field)
+    return None if value is None else float(value)
+
+
+def decode_coordinates(record):
+    """ copy of DB record with float degrees coordinates (taken from micro-degrees columns - no Decimal arithmetic) """
+    place = dict(record)
+    for field, e6_field in coordinate_e6_fields.items():
+        if place.get(e6_field) is not None:
+            place[field] = from_e6(place.pop(e6_field))
+    return place
+
+
+def compact_coordinates(place):
+    """ copy of place dict with coordinates as micro-degrees fields only (message form) """
+    compact = {field: value for field, value in place.items() if field not in coordinate_e6_fields}
+    for field, e6_field in coordinate_e6_fields.items():
+        if compact.get(e6_field) is None and place.get(field) is not None:
+            compact[e6_field] = to_e6(place[field])
+    return compact
+
+
+def make_waypoint(latitude, longitude):
+    """ route waypoint in message form """
+    return {UserRequestFieldNames.LATITUDE_E6.value: to_e6(latitude), UserRequestFieldNames.LONGITUDE_E6.value: to_e6(longitude)}
+
+
+def get_waypoint(waypoint):
+    """ (latitude, longitude) float degrees of a waypoint. older messages have float 'lat'/'lng' fields """
+    if UserRequestFieldNames.LATITUDE_E6.value in waypoint:
+        return from_e6(waypoint[UserRequestFieldNames.LATITUDE_E6.value]), from_e6(waypoint[UserRequestFieldNames.LONGITUDE_E6.value])
+    return waypoint[UserRequestFieldNames.LATITUDE.value], waypoint[UserRequestFieldNames.LONGITUDE.value]
+
+
+def get_waypoints(route_request):
+    """ [(latitude, longitude)] of route request waypoints """
+    return [get_waypoint(waypoint) for waypoint in route_request.get(UserRequestFieldNames.WAYPOINTS.value) or []]
+
+
+CORRIDOR_KEY_MODE = os.getenv('CORRIDOR_KEY_MODE', 'cities')  # 'cities' or 'geohash'
+CORRIDOR_GEOHASH_PRECISION = int(os.getenv('CORRIDOR_GEOHASH_PRECISION', '4'))
+
+def get_corridor_key(route_request, mode=None):
+    """ normalized key of the route geography - same corridor (in any direction) gives the same key.
+        'cities' mode uses origin/destination names, 'geohash' mode uses coarse geohash cells of the waypoints
+    """
+    mode = mode or CORRIDOR_KEY_MODE
+    waypoints = get_waypoints(route_request)
+    if mode == 'geohash' and waypoints:
+        cells = {geohash_encode(lat, lng, CORRIDOR_GEOHASH_PRECISION) for lat, lng in waypoints}
+        return '|'.join(sorted(cells))
+
+    origin = normalize_city_name(str(route_request.get(UserRequestFieldNames.ORIGIN.value, ""))).strip()
+    destination = normalize_city_name(str(route_request.get(UserRequestFieldNames.DESTINATION.value, ""))).strip()
+    return '|'.join(sorted([origin, destination]))
+
+
 if __name__ == "__main__":
     print(validate_datetime("07/02 11:50"))
     print(parse_numbers("1 ,3 ,7 ,a b 18 ", 1, 7))
@@ -122,8 +233,7 @@ if __name__ == "__main__":
     with open("route_data.json", "r", encoding="utf-8") as file:
         data = json.load(file)  # Parse JSON
         # Extract coordinates of waypoints 0 & 1
-        lat1, lon1 = data["waypoints"][0]["lat"], data["waypoints"][0]["lng"]
-        lat2, lon2 = data["waypoints"][1]["lat"], data["waypoints"][1]["lng"]
+        (lat1, lon1), (lat2, lon2) = get_waypoints(data)[:2]
         # Calculate distance
         distance = haversine_distance(lat1, lon1, lat2, lon2)
         print(f"Distance between waypoints 0 & 1: {distance:.2f} km")
\ No newline at end of file
@@ -0,0 +1,190 @@
+"""
+Run the whole pipeline (bot -> api -> spark -> results services) in one python process,
+using the in-process broker instead of Kafka (no Kafka/Zookeeper needed).
+
+    python local_pipeline.py serve                       # single node deployment - telegram bot + all services
+    python local_pipeline.py bench --requests 50         # inject sample route requests and measure end-to-end latency
+
+'bench' injects copies of a json_samples route request (each with its own route id) the same way the bot does,
+and reports latency from injection until the last result message of each request, plus throughput.
+a request is complete when api-service finished it and all result messages it sent (place types with no places
+send nothing) reached the results service.
+with --dry-results results are not sent to telegram/email (results service only records arrival).
+"""
+import argparse
+import copy
+import importlib.util
+import json
+import os
+import sys
+import threading
+import time
+
+# must be set before common_utils modules are imported
+os.environ['PIPELINE_TRANSPORT'] = 'memory'
+os.environ.setdefault('KAFKA_AUTO_OFFSET_RESET', 'earliest')  # consumers may join after first messages were sent
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT_DIR)
+sys.path.append(os.path.join(ROOT_DIR, "api-service"))  # google_places, heremaps_attractions
+sys.path.append(os.path.join(ROOT_DIR, "bot-service"))  # bot modules, user_request
+
+from common_utils.local_logger import logger
+import common_utils.kafka_common as kfk
+from common_utils.kafka_consumer import poll_and_process_messages
+from common_utils.utils import UserRequestFieldNames
+from common_utils.trace_report import percentile
+
+DEFAULT_SAMPLE = "./json_samples/route_request_haifa_tel aviv.json"
+
+
+def load_service_module(service_dir, module_name, alias):
+    """ services have modules with the same name (message_handler) - load each under a unique name (once) """
+    if alias in sys.modules:
+        return sys.modules[alias]
+    path = os.path.join(ROOT_DIR, service_dir, f"{module_name}.py")
+    spec = importlib.util.spec_from_file_location(alias, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[alias] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def start_service(topic_name, handler_func, group_id, stop_event):
+    thread = threading.Thread(target=poll_and_process_messages, name=group_id,
+                              args=(topic_name, handler_func), kwargs={"group_id": group_id, "stop_event": stop_event},
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def start_services(stop_event, results_handler=None, api_handler=None):
+    """ start api, spark and results services as threads. returns threads list """
+    if api_handler is None:
+        api_handler = load_service_module("api-service", "message_handler", "api_message_handler").api_process_message
+    spark_handler = load_service_module("spark_service", "message_handler", "spark_message_handler")
+    if results_handler is None:
+        results_handler = load_service_module("results_service", "message_handler", "results_message_handler").results_process_message
+    return [
+        start_service(kfk.USER_REQUESTS_TOPIC_NAME, api_handler, "api-service", stop_event),
+        start_service(kfk.TRANSFORMER_TOPIC_NAME, spark_handler.spark_process_message, "spark-service", stop_event),
+        start_service(kfk.RESULTS_TOPIC_NAME, results_handler, "results-service", stop_event),
+    ]
+
+
+def serve():
+    """ single node deployment - telegram bot runs in main thread, services in background threads """
+    from common_utils import utils
+    import my_bot
+
+    stop_event = threading.Event()
+    start_services(stop_event)
+    logger.info("Starting local pipeline (in-process broker)")
+    utils.load_israeli_cities()
+    try:
+        my_bot.start_bot()
+    finally:
+        stop_event.set()
+
+
+def bench(num_requests, sample_file, dry_results, timeout_sec):
+    import user_request
+
+    with open(sample_file, "r", encoding="utf-8") as file:
+        sample = json.load(file)
+
+    lock = threading.Lock()
+    sent_at = dict()      # route_id -> injection time
+    pending = dict()      # route_id -> result messages sent by api-service and not received yet
+    api_done = set()      # route ids api-service finished (no more result messages will be sent)
+    latencies = []
+    all_done = threading.Event()
+
+    def check_done(route_id):
+        """ caller holds the lock """
+        if route_id in api_done and pending.get(route_id) == 0:
+            del pending[route_id]
+            latencies.append(time.perf_counter() - sent_at[route_id])
+            if not pending:
+                all_done.set()
+
+    # count the result messages api-service actually sends (place types with no places send nothing)
+    api_module = load_service_module("api-service", "message_handler", "api_message_handler")
+    send_places_data_to_queue = api_module.send_places_data_to_queue
+
+    def counted_send(original_message, *args):
+        status = send_places_data_to_queue(original_message, *args)
+        with lock:
+            route_id = original_message.get(UserRequestFieldNames.ROUTE_ID.value)
+            if status and route_id in pending:
+                pending[route_id] += 1
+        return status
+
+    api_module.send_places_data_to_queue = counted_send
+
+    def api_handler(json_message):
+        status = api_module.api_process_message(json_message)  # a failed request is retried - not done yet
+        route_id = json_message.get(UserRequestFieldNames.ROUTE_ID.value)
+        with lock:
+            if route_id in pending:
+                api_done.add(route_id)
+                check_done(route_id)
+        return status
+
+    def record_result(json_message):
+        route_id = json_message.get(UserRequestFieldNames.ROUTE_ID.value)
+        with lock:
+            if route_id in pending:
+                pending[route_id] -= 1
+                check_done(route_id)
+        return True
+
+    if dry_results:
+        results_handler = record_result
+    else:
+        results_module = load_service_module("results_service", "message_handler", "results_message_handler")
+
+        def send_and_record(json_message):
+            status = results_module.results_process_message(json_message)
+            record_result(json_message)
+            return status
+        results_handler = send_and_record
+
+    stop_event = threading.Event()
+    start_services(stop_event, results_handler, api_handler)
+
+    start_time = time.perf_counter()
+    for idx in range(num_requests):
+        request = copy.deepcopy(sample)
+        request[UserRequestFieldNames.ROUTE_ID.value] = int(time.time() * 1000) * 1000 + idx
+        with lock:
+            sent_at[request[UserRequestFieldNames.ROUTE_ID.value]] = time.perf_counter()
+            pending[request[UserRequestFieldNames.ROUTE_ID.value]] = 0
+        user_request.process_user_request(request)
+
+    all_done.wait(timeout_sec)
+    elapsed = time.perf_counter() - start_time
+    stop_event.set()
+
+    completed = len(latencies)
+    print(f"completed {completed}/{num_requests} requests in {elapsed:.2f}s ({completed / elapsed:.2f} requests/sec)")
+    if latencies:
+        print(f"end-to-end latency: p50={percentile(latencies, 50):.3f}s p95={percentile(latencies, 95):.3f}s "
+              f"p99={percentile(latencies, 99):.3f}s max={max(latencies):.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run route planner pipeline in a single process")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("serve", help="run telegram bot and all services")
+    bench_parser = subparsers.add_parser("bench", help="measure end-to-end latency and throughput")
+    bench_parser.add_argument("--requests", type=int, default=20, help="number of requests to inject")
+    bench_parser.add_argument("--sample", default=DEFAULT_SAMPLE, help="route request json to inject")
+    bench_parser.add_argument("--dry-results", action="store_true", help="don't send results to telegram/email")
+    bench_parser.add_argument("--timeout", type=float, default=300, help="max seconds to wait for all results")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        serve()
+    else:
+        bench(args.requests, args.sample, args.dry_results, args.timeout)
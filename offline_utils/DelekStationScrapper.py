@@ -7,7 +7,7 @@ URL = "https://delek.co.il/%d7%90%d7%99%d7%aa%d7%95%d7%a8-%d7%aa%d7%97%d7%a0%d7%
 
 # Send HTTP request
 headers = {"User-Agent": "Mozilla/5.0"}
-response = requests.get(URL, headers=headers)
+response = requests.get(URL, headers=headers, timeout=60)
 response.raise_for_status()  # Raise an error if request fails
 
 # Parse the page with BeautifulSoup
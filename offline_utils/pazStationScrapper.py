@@ -10,7 +10,7 @@ headers = {
 
 payload = {}  # Some APIs require a body, even if empty
 
-response = requests.post(url, headers=headers, json=payload)
+response = requests.post(url, headers=headers, json=payload, timeout=60)
 #print(response.json())
 
 if response.status_code == 200:
@@ -5,16 +5,21 @@ import sys
 import os
 from common_utils.local_logger import logger
 import common_utils.kafka_common as kfk
-from common_utils.kafka_consumer import poll_and_process_messages
-from message_handler import results_process_message
+from common_utils.kafka_consumer import poll_and_process_messages, poll_and_process_batches, CONSUMER_BATCH_MAX_RECORDS
+from message_handler import results_process_message, results_process_message_batch
 
 # Add the parent folder to sys.path
 #sys.path.append(os.path.abspath("../common_utils"))
 sys.path.append(os.path.abspath("."))
 #print(sys.path)
 
+SERVICE_GROUP_ID = "results-service"  # all results_service instances share this consumer group
+
 
 if __name__ == "__main__":
    logger.info("Starting Results Service")
-   poll_and_process_messages(kfk.RESULTS_TOPIC_NAME, results_process_message)
+   if CONSUMER_BATCH_MAX_RECORDS > 1:
+      poll_and_process_batches(kfk.RESULTS_TOPIC_NAME, results_process_message_batch, group_id=SERVICE_GROUP_ID)
+   else:
+      poll_and_process_messages(kfk.RESULTS_TOPIC_NAME, results_process_message, group_id=SERVICE_GROUP_ID)
    
\ No newline at end of file
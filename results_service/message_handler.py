@@ -7,6 +7,8 @@ from common_utils.utils import UserRequestFieldNames, BreakPointName
 import common_utils.db_utils as db
 from common_utils.telegram_bot import send_message
 from common_utils.sendgrid_mail import send_email
+from common_utils import tracing
+from common_utils.kafka_workers import handle_each, BatchMessagesFailed
 
 
 def send_route_details_on_email(json_message, text_to_send):
@@ -99,14 +101,22 @@ def send_attractions_list(json_message, chat_id):
     return True
 
 
-def results_process_message(json_message):
+def results_process_message(json_message, send_summary=True):
     if not json_message:
         logger.error("process_message was called with no message")
         return False
 
+    with tracing.span(json_message, f"results_send:{json_message.get('place_type')}"):
+        status = send_results(json_message, send_summary)
+    tracing.log_trace(json_message)  # end of pipeline for this message
+    return status
+
+
+def send_results(json_message, send_summary=True):
     chat_id = json_message['user_id']
     
-    send_route_summary(json_message, chat_id)
+    if send_summary:
+        send_route_summary(json_message, chat_id)
     
     place_type = json_message['place_type']
     
@@ -123,6 +133,25 @@ def results_process_message(json_message):
     return False
 
 
+def results_process_message_batch(json_messages):
+    """ send results of a batch of messages. route summary is sent once per route, 
+        even if the batch holds several place-types of the same route.
+        a failing message doesn't stop the rest, and only failed messages are retried (so users don't get duplicates)
+    """
+    summarized_routes = set()
+
+    def process_summarized_once(json_message):  # route summary only with first message of the route
+        route_key = (json_message.get('user_id'), json_message.get(UserRequestFieldNames.ROUTE_ID.value))
+        result = results_process_message(json_message, route_key not in summarized_routes)
+        summarized_routes.add(route_key)
+        return result
+
+    results, failures = handle_each(json_messages, process_summarized_once)
+    if failures:
+        raise BatchMessagesFailed(failures)
+    return all(results)
+
+
 if __name__ == "__main__":
     # Load the JSON file
     file_names = [
@@ -1,4 +1,11 @@
-start python ./results_service/main.py
-start python ./spark_service/main.py
-start python ./api-service/main.py
+@echo off
+rem number of instances per service (each instance gets part of the topic partitions)
+if "%API_INSTANCES%"=="" set API_INSTANCES=1
+if "%SPARK_INSTANCES%"=="" set SPARK_INSTANCES=1
+if "%RESULTS_INSTANCES%"=="" set RESULTS_INSTANCES=1
+
+python -m common_utils.kafka_common
+for /L %%i in (1,1,%RESULTS_INSTANCES%) do start python ./results_service/main.py
+for /L %%i in (1,1,%SPARK_INSTANCES%) do start python ./spark_service/main.py
+for /L %%i in (1,1,%API_INSTANCES%) do start python ./api-service/main.py
 start python ./bot-service/main.py
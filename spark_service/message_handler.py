@@ -1,35 +1,47 @@
 import json
 import os
 from pyspark.sql import SparkSession
-from common_utils.db_utils import connect_db, disconnect_db, get_record, convert_record
+from common_utils.db_utils import connection, find_nearby, convert_record
 from common_utils.local_logger import logger
+from common_utils.utils import BreakPointName, coord_e6, get_coordinate, decode_coordinates
 import common_utils.kafka_common as kfk
 from common_utils.kafka_producer import send_request_to_queue
+from common_utils import tracing
+from common_utils.kafka_workers import handle_each, BatchMessagesFailed
 
-def enrich_json_with_postgres(json_data):
+# google and vendors coordinates of the same station differ slightly - match the nearest vendor station within radius
+STATION_MATCH_RADIUS_M = float(os.getenv('STATION_MATCH_RADIUS_M', '150'))
+
+def get_station_record(latitude, longitude, stations_cache=None):
     """
-    Enriches JSON data by filling NULL values with data from PostgreSQL and returns the enriched JSON.
+    Fetches static gas station data for the given coordinates.
+    'stations_cache' (optional dict) keeps results so same station is queried only once per batch.
+    """
+    key = coord_e6(latitude, longitude)
+    if stations_cache is not None and key in stations_cache:
+        return stations_cache[key]
+    # ✅ Query gas_stations table for the nearest station to the given latitude and longitude
+    db_record = find_nearby("gas_stations", latitude, longitude, STATION_MATCH_RADIUS_M, limit=1)
+    db_record = convert_record([decode_coordinates(db_record[0])])[0] if db_record else None  # Convert DB record to dictionary
+    if stations_cache is not None:
+        stations_cache[key] = db_record
+    return db_record
 
-    :param json_path: Path to input JSON file.
-    :return: Enriched JSON as a Python dictionary.
+
+def enrich_places(json_data, stations_cache=None):
     """
-        
-    # ✅ Initialize Spark Session
-    spark = SparkSession.builder.appName("GasStationEnrichment").getOrCreate()
-    # ✅ Connect to the database
-    connect_db()
-   
+    Fills NULL values of JSON places with static gas stations data. assumes DB is connected.
+    only gas station places are enriched - other place types are passed as is.
+    """
+    if json_data.get("place_type") != BreakPointName.FUELING.value:
+        return json_data
     # ✅ Extract the `places` list from JSON
     places = json_data.get("places", [])
     enriched_places = []
 
     for place in places:
-        latitude = place.get("latitude")
-        longitude = place.get("longitude")
-        # ✅ Query gas_stations table for the given latitude and longitude
-        db_record = get_record("gas_stations", {"latitude": latitude, "longitude": longitude})
+        db_record = get_station_record(get_coordinate(place, "latitude"), get_coordinate(place, "longitude"), stations_cache)
         if db_record:
-            db_record = convert_record(db_record)[0]  # Convert DB record to dictionary
             # ✅ Fill missing (NULL) values in JSON with values from PostgreSQL
             place["working_hours"] = place.get("working_hours") or db_record.get("working_hours")
             place["petrol98"] = place.get("petrol98") or db_record.get("petrol98")
@@ -40,18 +52,56 @@ def enrich_json_with_postgres(json_data):
 
     # ✅ Update JSON with enriched places
     json_data["places"] = enriched_places
-    # ✅ Disconnect from DB
-    disconnect_db()
-    # ✅ Stop Spark session
-    spark.stop()
+    return json_data
+
+
+def enrich_json_with_postgres(json_data):
+    """
+    Enriches JSON data by filling NULL values with data from PostgreSQL and returns the enriched JSON.
+
+    :param json_path: Path to input JSON file.
+    :return: Enriched JSON as a Python dictionary.
+    """
+        
+    # ✅ Initialize Spark Session
+    spark = SparkSession.builder.appName("GasStationEnrichment").getOrCreate()
+    try:
+        # ✅ Take a pooled DB connection (returned to the pool at the end of the block)
+        with connection():
+            json_data = enrich_places(json_data)
+    finally:
+        # ✅ Stop Spark session
+        spark.stop()
     # ✅ Return the enriched JSON as a Python dictionary
     return json_data
 
 def spark_process_message(json_message):
-    json_enriched = enrich_json_with_postgres(json_message)
-    pretty_json = json.dumps(json_enriched, indent=4, ensure_ascii=False)
+    with tracing.span(json_message, "spark_enrich"):
+        json_enriched = enrich_json_with_postgres(json_message)
     topic_name = kfk.RESULTS_TOPIC_NAME
-    return send_request_to_queue(pretty_json, topic_name)
+    return send_request_to_queue(json_enriched, topic_name)
+
+def spark_process_message_batch(json_messages):
+    """
+    Enriches a batch of messages using a single Spark session and DB connection.
+    stations that appear in several messages of the batch are fetched from DB once.
+    """
+    def enrich_and_send(json_message):
+        with tracing.span(json_message, "spark_enrich"):
+            json_enriched = enrich_places(json_message, stations_cache)
+        return send_request_to_queue(json_enriched, kfk.RESULTS_TOPIC_NAME)
+
+    spark = SparkSession.builder.appName("GasStationEnrichment").getOrCreate()
+    stations_cache = dict()
+    try:
+        with connection():
+            results, failures = handle_each(json_messages, enrich_and_send)
+    finally:
+        spark.stop()
+    logger.info(f"enriched batch of {len(json_messages)} messages using {len(stations_cache)} station lookups")
+    if failures:
+        raise BatchMessagesFailed(failures)  # only failed messages are retried - others were already sent
+    return all(results)
 
 def main():
     """
@@ -0,0 +1,43 @@
+"""
+kafka_codec json - orjson and std json fallback accept the same messages and produce the same bytes.
+run from project root:  python -m pytest tests
+"""
+from datetime import date, datetime, timezone
+from decimal import Decimal
+import pytest
+from common_utils import kafka_codec
+
+MESSAGE = {
+    "route_id": 17,
+    "created_at": datetime(2024, 5, 1, 10, 30, 15, 250000),
+    "sent_at": datetime(2024, 5, 1, 8, 0, tzinfo=timezone.utc),
+    "day": date(2024, 5, 1),
+    "rating": Decimal("4.5"),
+    "places_by_index": {1: "first", 2: "second"},
+    "name": "חיפה",
+}
+EXPECTED = {
+    "route_id": 17,
+    "created_at": "2024-05-01T10:30:15.250000",
+    "sent_at": "2024-05-01T08:00:00+00:00",
+    "day": "2024-05-01",
+    "rating": "4.5",
+    "places_by_index": {"1": "first", "2": "second"},
+    "name": "חיפה",
+}
+
+
+def encode_with_std_json(monkeypatch, data):
+    monkeypatch.setattr(kafka_codec, "orjson", None)
+    return kafka_codec._json_encode(data)
+
+
+def test_std_json_encodes_datetime_and_int_keys(monkeypatch):
+    raw = encode_with_std_json(monkeypatch, MESSAGE)
+    assert kafka_codec.decode(raw) == EXPECTED
+
+
+def test_orjson_and_std_json_produce_same_bytes(monkeypatch):
+    pytest.importorskip("orjson")
+    raw = kafka_codec._json_encode(MESSAGE)
+    assert raw == encode_with_std_json(monkeypatch, MESSAGE)
@@ -0,0 +1,50 @@
+"""
+kafka_consumer worker keys - requests of one corridor (same kafka key) are still handled by several workers.
+run from project root:  python -m pytest tests
+"""
+import os
+os.environ.setdefault('PIPELINE_TRANSPORT', 'memory')  # no broker needed
+import threading
+import zlib
+from types import SimpleNamespace
+from common_utils.kafka_consumer import get_message_key
+from common_utils.kafka_workers import KeyedWorkerPool
+
+CORRIDOR_KEY = b"haifa|tel aviv"
+NUM_WORKERS = 4
+
+
+def make_message(value, key=CORRIDOR_KEY, partition=0):
+    return SimpleNamespace(key=key, value=value, partition=partition)
+
+
+def get_worker(key):
+    return zlib.crc32(str(key).encode("utf-8")) % NUM_WORKERS  # same as KeyedWorkerPool.submit
+
+
+def test_ordering_key_prefers_route_over_kafka_key():
+    assert get_message_key(make_message({"route_id": "r1", "user_id": 7})) == "r1"
+    assert get_message_key(make_message({"user_id": 7})) == 7
+    assert get_message_key(make_message({})) == CORRIDOR_KEY
+    assert get_message_key(make_message({}, key=None, partition=3)) == 3
+
+
+def test_routes_of_same_corridor_run_concurrently():
+    first_route = "route-0"
+    second_route = next(f"route-{idx}" for idx in range(1, 100) if get_worker(f"route-{idx}") != get_worker(first_route))
+    messages = [make_message({"route_id": first_route}), make_message({"route_id": second_route})]
+    second_started = threading.Event()
+    first_finished = threading.Event()
+
+    def work(message):
+        if message.value["route_id"] == first_route:
+            if second_started.wait(2):  # second route runs meanwhile on another worker
+                first_finished.set()
+        else:
+            second_started.set()
+
+    pool = KeyedWorkerPool(NUM_WORKERS, 5, work)
+    for message in messages:
+        pool.submit(get_message_key(message), message)
+    pool.shutdown()
+    assert first_finished.is_set()
@@ -0,0 +1,25 @@
+"""
+kafka_producer - the enqueue stamp goes on the sent message only, so a message dict sent again (retry, replay)
+doesn't collect stamps of earlier sends.
+run from project root:  python -m pytest tests
+"""
+import os
+os.environ.setdefault('PIPELINE_TRANSPORT', 'memory')  # no broker needed
+from common_utils import kafka_producer, tracing
+
+
+def test_enqueue_stamp_is_not_added_to_callers_message(monkeypatch):
+    sent = []
+    original_send = kafka_producer.producer.send
+
+    def send(topic, value, **kwargs):
+        sent.append(value)
+        return original_send(topic, value, **kwargs)
+
+    monkeypatch.setattr(kafka_producer.producer, "send", send)
+    message = {"route_id": 1, "user_id": 2}
+    tracing.start_trace(message)
+    for _ in range(2):
+        assert kafka_producer.send_request_async(message, "test_topic") is not None
+    assert message[tracing.TRACE_FIELD]["stamps"] == []
+    assert [[stage for stage, _ in value[tracing.TRACE_FIELD]["stamps"]] for value in sent] == [["enqueue:test_topic"]] * 2
@@ -0,0 +1,152 @@
+"""
+OffsetTracker, KeyedWorkerPool and batch helpers - commit positions, backpressure, per key ordering and
+per message failures of a batch.
+run from project root:  python -m pytest tests
+"""
+import threading
+import time
+from kafka.structs import TopicPartition
+from common_utils.kafka_workers import OffsetTracker, KeyedWorkerPool, BatchMessagesFailed, handle_each
+
+TP0 = TopicPartition("user_requests", 0)
+TP1 = TopicPartition("user_requests", 1)
+
+
+def committed_offsets(tracker):
+    return {tp: offset_and_metadata.offset for tp, offset_and_metadata in tracker.pop_committable().items()}
+
+
+def test_commit_moves_only_over_contiguous_done_offsets():
+    tracker = OffsetTracker()
+    for offset in range(10, 14):
+        tracker.add(TP0, offset)
+    tracker.done(TP0, 11)
+    tracker.done(TP0, 12)
+    assert committed_offsets(tracker) == {}  # 10 still in work
+    tracker.done(TP0, 10)
+    assert committed_offsets(tracker) == {TP0: 13}  # next offset to read
+    assert committed_offsets(tracker) == {}  # reported once
+    tracker.done(TP0, 13)
+    assert committed_offsets(tracker) == {TP0: 14}
+    assert tracker.pending_count() == 0
+
+
+def test_partitions_are_committed_independently():
+    tracker = OffsetTracker()
+    tracker.add(TP0, 5)
+    tracker.add(TP1, 7)
+    tracker.done(TP1, 7)
+    assert committed_offsets(tracker) == {TP1: 8}
+    assert tracker.pending_count() == 1
+
+
+def test_done_of_unknown_offset_is_ignored():
+    tracker = OffsetTracker()
+    tracker.add(TP0, 1)
+    tracker.done(TP0, 2)
+    tracker.done(TP1, 1)
+    assert committed_offsets(tracker) == {}
+    assert tracker.pending_count() == 1
+
+
+def test_drop_partitions_forgets_offsets_and_positions():
+    tracker = OffsetTracker()
+    tracker.add(TP0, 1)
+    tracker.add(TP0, 2)
+    tracker.add(TP1, 1)
+    tracker.done(TP1, 1)
+    tracker.drop_partitions([TP0, TP1])
+    assert tracker.pending_count() == 0
+    assert tracker.tracked_partitions() == set()
+    assert committed_offsets(tracker) == {}
+
+
+def test_add_waits_for_room():
+    tracker = OffsetTracker(max_pending=2)
+    tracker.add(TP0, 1)
+    tracker.add(TP0, 2)
+    assert not tracker.has_room()
+    added = threading.Event()
+    thread = threading.Thread(target=lambda: (tracker.add(TP0, 3), added.set()))
+    thread.start()
+    assert not added.wait(0.2)  # blocked - tracker is full
+    tracker.done(TP0, 2)
+    assert not added.wait(0.2)  # offset 2 is done but still held behind offset 1
+    tracker.done(TP0, 1)
+    assert added.wait(2)
+    thread.join()
+    assert tracker.pending_count() == 1
+    assert committed_offsets(tracker) == {TP0: 3}
+
+
+def test_worker_pool_keeps_order_per_key():
+    handled = dict()  # key -> handled values
+    lock = threading.Lock()
+
+    def work(item):
+        key, value = item
+        time.sleep(0.001 * (value % 3))  # uneven work time
+        with lock:
+            handled.setdefault(key, []).append(value)
+
+    pool = KeyedWorkerPool(4, 5, work)
+    for value in range(60):
+        key = f"route-{value % 6}"
+        pool.submit(key, (key, value))
+    pool.shutdown()
+    assert sum(len(values) for values in handled.values()) == 60
+    for key, values in handled.items():
+        assert values == sorted(values), key
+
+
+def test_worker_pool_commits_after_out_of_order_completion():
+    tracker = OffsetTracker()
+    release_first = threading.Event()
+
+    def work(item):
+        tp, offset = item
+        if offset == 0:
+            release_first.wait(2)  # first message is slow, others complete before it
+        tracker.done(tp, offset)
+
+    pool = KeyedWorkerPool(3, 10, work)
+    for offset in range(6):
+        tracker.add(TP0, offset)
+        pool.submit(offset, (TP0, offset))
+    time.sleep(0.2)
+    assert committed_offsets(tracker) == {}
+    release_first.set()
+    pool.shutdown()
+    assert committed_offsets(tracker) == {TP0: 6}
+
+
+def test_worker_pool_survives_handler_errors():
+    handled = []
+
+    def work(value):
+        if value == 1:
+            raise ValueError("bad message")
+        handled.append(value)
+
+    pool = KeyedWorkerPool(1, 5, work)
+    for value in range(3):
+        pool.submit("key", value)
+    pool.shutdown()
+    assert handled == [0, 2]
+
+
+def test_handle_each_reports_failed_messages_only():
+    sent = []
+
+    def send(message):
+        if message["route_id"] == 2:
+            raise RuntimeError("send failed")
+        sent.append(message["route_id"])
+        return True
+
+    results, failures = handle_each([{"route_id": idx} for idx in range(4)], send)
+    assert sent == [0, 1, 3]  # messages after the failure are still handled
+    assert results == [True, True, False, True]
+    assert list(failures) == [2]
+    error = BatchMessagesFailed(failures)
+    assert error.failures[2].args == ("send failed",)
@@ -0,0 +1,36 @@
+"""
+place_cache - records expire with DB retention (created_at), nearby searches are invalidated by area.
+run from project root:  python -m pytest tests
+"""
+import time
+from datetime import datetime, timedelta
+from common_utils import place_cache
+
+
+def remaining_ttl(cache, key):
+    return cache.entries[key][0] - time.monotonic()
+
+
+def test_record_expires_with_db_retention():
+    cache = place_cache.TTLCache("test", 10, 10 * 24 * 3600, 60)
+    retention = timedelta(days=place_cache.RETENTION_DAYS)
+    place_cache.put_record(cache, "old", {"created_at": datetime.now() - retention + timedelta(hours=1)})
+    place_cache.put_record(cache, "expired", {"created_at": datetime.now() - retention - timedelta(hours=1)})
+    place_cache.put_record(cache, "new", {"place_id": "new"})  # just written - no created_at
+    place_cache.put_record(cache, "missing", place_cache.NOT_FOUND)
+    assert 3500 < remaining_ttl(cache, "old") <= 3600
+    assert "expired" not in cache.entries
+    assert remaining_ttl(cache, "new") > 9 * 24 * 3600
+    assert remaining_ttl(cache, "missing") <= 60
+
+
+def test_invalidate_nearby_drops_overlapping_searches():
+    table = "test_nearby"
+    now = datetime.now()
+    place_cache.put_nearby(table, 32.0, 34.0, 1000, 5, [{"created_at": now}])
+    place_cache.put_nearby(table, 32.015, 34.0, 1000, 5, [{"created_at": now}])  # ~1.7km away - overlaps
+    place_cache.put_nearby(table, 32.1, 34.0, 1000, 5, [{"created_at": now}])  # ~11km away
+    cache = place_cache.get_cache(table, "nearby")
+    assert max(remaining_ttl(cache, key) for key in cache.entries) <= place_cache.PLACE_CACHE_NEARBY_TTL_SEC
+    place_cache.invalidate_nearby(table, 32.0, 34.0, 1000, 5)
+    assert list(cache.entries) == [(32.1, 34.0, 1000, 5)]